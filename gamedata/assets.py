@@ -0,0 +1,140 @@
+"""
+Loading of textures, images and fonts.
+"""
+import pygame
+import model
+
+# terrain palette index used for pixels outside the map
+OUTSIDE_COLOR_INDEX = 255
+
+
+class AssetManager(object):
+    """
+    Loads game assets once the display is up, converted to the display format
+    so blitting them needs no per pixel conversion.
+    Tile textures are packed into one atlas surface by initialize(),
+    GUI images and fonts are loaded on first use.
+    """
+
+    def __init__(self, tileSize = 32):
+        """
+        Attributes:
+        atlas (pygame.Surface): every terrain and resource texture side by side.
+        """
+        self.tileSize = tileSize
+        self.atlas = None
+        # tileId: area of its texture in the atlas
+        self.terrainAreas = {}
+        # recId: area of its texture in the atlas
+        self.resourceAreas = {}
+        self.errorArea = None
+        # tile size in pixels: atlas scaled to it, see getAtlas()
+        self.scaledAtlases = {}
+        self.terrainPalette = None
+        self.images = {}
+        self.fonts = {}
+
+    def initialize(self):
+        """
+        Loads the tile textures into the atlas. Call after pygame.display.set_mode().
+        """
+        size = self.tileSize
+        textures = []
+        for tileId, fileName in sorted(model.terrainTextureFiles.items()):
+            textures.append((self.terrainAreas, tileId, fileName))
+        for recId, fileName in sorted(model.resourceTextureFiles.items()):
+            textures.append((self.resourceAreas, recId, fileName))
+        atlas = pygame.Surface((size * (len(textures) + 1), size), pygame.SRCALPHA)
+        for i, (areas, key, fileName) in enumerate(textures):
+            areas[key] = self.packTexture(atlas, i, fileName)
+        self.errorArea = self.packTexture(atlas, len(textures), model.errorTextureFile)
+        self.atlas = atlas.convert_alpha()
+        self.scaledAtlases = {size: self.atlas}
+        self.terrainPalette = None
+
+    def packTexture(self, atlas, slot, fileName):
+        """
+        Loads a texture into slot of the atlas, scaled to the tile size.
+        Returns its area in the atlas.
+        """
+        size = self.tileSize
+        texture = pygame.image.load(fileName)
+        if texture.get_size() != (size, size):
+            texture = pygame.transform.scale(texture, (size, size))
+        area = pygame.Rect(slot * size, 0, size, size)
+        atlas.blit(texture, area)
+        return area
+
+    def getAtlas(self, tilePixels = None):
+        """
+        Returns the atlas with its textures scaled to tilePixels wide tiles.
+        Like mipmaps, each size is made once by halving the next larger one.
+        """
+        if tilePixels is None:
+            return self.atlas
+        atlas = self.scaledAtlases.get(tilePixels)
+        if atlas is None:
+            larger = self.getAtlas(min(self.tileSize, tilePixels * 2))
+            width = self.atlas.get_width() * tilePixels // self.tileSize
+            atlas = pygame.transform.smoothscale(larger, (width, tilePixels))
+            self.scaledAtlases[tilePixels] = atlas
+        return atlas
+
+    def scaleArea(self, area, tilePixels):
+        if tilePixels is None or tilePixels == self.tileSize:
+            return area
+        return pygame.Rect(area.x * tilePixels // self.tileSize, 0, tilePixels, tilePixels)
+
+    def getTerrainArea(self, tileId, tilePixels = None):
+        """
+        Returns the atlas area of a terrain texture, or of the error texture,
+        in the atlas of getAtlas(tilePixels).
+        """
+        return self.scaleArea(self.terrainAreas.get(tileId, self.errorArea), tilePixels)
+
+    def getResourceArea(self, recId, tilePixels = None):
+        """
+        Returns the atlas area of a resource texture, or of the error texture,
+        in the atlas of getAtlas(tilePixels).
+        """
+        return self.scaleArea(self.resourceAreas.get(recId, self.errorArea), tilePixels)
+
+    def getTerrainPalette(self):
+        """
+        Returns a 256 color palette indexed by tileId, with the average color
+        of each terrain texture. Unknown tileIds get the error texture's color,
+        except index OUTSIDE_COLOR_INDEX which is black, for outside the map.
+        """
+        if self.terrainPalette is None:
+            errorColor = pygame.transform.average_color(self.atlas, self.errorArea)[:3]
+            palette = [errorColor] * 256
+            for tileId, area in self.terrainAreas.items():
+                palette[tileId] = pygame.transform.average_color(self.atlas, area)[:3]
+            palette[OUTSIDE_COLOR_INDEX] = (0, 0, 0)
+            self.terrainPalette = palette
+        return self.terrainPalette
+
+    def getImage(self, name):
+        """
+        Returns a GUI image from model.guiImageFiles, loading it on first use.
+        """
+        image = self.images.get(name)
+        if image is None:
+            image = pygame.image.load(model.guiImageFiles[name]).convert_alpha()
+            self.images[name] = image
+        return image
+
+    def getFont(self, name, size):
+        """
+        Returns a system font, or pygame's default font if name is None,
+        loading it on first use.
+        """
+        key = (name, size)
+        font = self.fonts.get(key)
+        if font is None:
+            if name is None:
+                font = pygame.font.Font(None, size)
+            else:
+                font = pygame.font.SysFont(name, size)
+            self.fonts[key] = font
+        return font
@@ -0,0 +1,491 @@
+"""
+Performance benchmarks. Run from the gamedata folder:
+
+    python benchmark.py [name ...]
+
+With no names every benchmark in BENCHMARKS runs.
+The frame benchmarks run a headless game through a scripted scenario
+and report frame time percentiles, mean time per phase and peak memory.
+"""
+import os
+# benchmarks never need a real window
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import asyncio
+import csv
+import math
+import random
+import sys
+import tempfile
+import time
+from array import array
+import pygame
+import ecs
+import eventmanager
+import model
+import mapgen
+import pathfinding
+import replay
+import savegame
+import server
+import streaming
+import view
+import controller
+import yields
+
+CLASSIC_MEDIUM = "assets/maps/classic-medium.csv"
+
+
+def loadTileIds(csvFileName):
+    """
+    Returns the rows of tileIds stored in a CSV map.
+    """
+    with open(csvFileName) as csvFile:
+        return [[int(tileId) for tileId in line] for line in csv.reader(csvFile)]
+
+
+def buildTileMap(tileIds, repeatx = 1, repeaty = 1, tileSize = 32):
+    """
+    Builds a TileMap that repeats tileIds repeatx times across and repeaty times down.
+    """
+    rows = [row * repeatx for row in tileIds] * repeaty
+    terrain = array('B')
+    for row in rows:
+        terrain.extend(row)
+    return model.TileMap(len(rows[0]), len(rows), terrain, tileSize = tileSize)
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest rank percentile of values, fraction from 0 to 1.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def peakMemoryMb():
+    """
+    Returns the peak resident memory of the process in MB, or None if it is unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+class FrameBench(object):
+    """
+    A headless game driven frame by frame by a script,
+    timing the input, model and render phases of every frame.
+    """
+
+    def __init__(self, tileMap = None, seed = 1, inputSource = None, mapFileName = CLASSIC_MEDIUM, render = True,
+                 saveFileName = None):
+        """
+        tileMap (TileMap): map to play on, mapFileName if None.
+        seed (int): resource seed of mapFileName.
+        inputSource: where Keyboard reads input from, a controller.ScriptedInput() if None.
+        render (bool): render a frame after every tick.
+        saveFileName (str): where F5 saves the game and F9 loads it from, None to ignore them.
+        Never savegame.SAVE_FILE_NAME, a benchmark must not overwrite the player's game.
+        """
+        self.evManager = eventmanager.EventManager(queued = True)
+        self.model = model.GameEngine(self.evManager)
+        self.input = inputSource if inputSource is not None else controller.ScriptedInput()
+        self.render = render
+        self.keyboard = controller.Keyboard(self.evManager, self.model, self.input)
+        # the input phase is called directly to time it apart from the model
+        self.evManager.Unsubscribe(eventmanager.TickEvent, self.keyboard.onTick)
+        self.view = view.GraphicalView(self.evManager, self.model, headless = True)
+        self.saves = None
+        if saveFileName:
+            self.saves = savegame.SaveManager(self.evManager, self.model, saveFileName, autosaveTicks = 0)
+        if tileMap:
+            self.model.tileMap = tileMap
+        else:
+            self.keyboard.loadMap(mapFileName, seed)
+        self.evManager.Post(eventmanager.InitializeEvent())
+        self.evManager.Pump(eventmanager.PUMP_LIMIT)
+        self.model.state.push(model.STATE_MENU)
+        self.frameTimes = []
+        self.phaseTimes = {'input': [], 'model': [], 'render': []}
+
+    def runFrame(self):
+        """
+        Runs and times one tick and one render.
+        """
+        tick = eventmanager.TickEvent()
+        start = time.perf_counter()
+        self.keyboard.onTick(tick)
+        inputDone = time.perf_counter()
+        self.evManager.Post(tick)
+        self.evManager.Pump(eventmanager.PUMP_LIMIT)
+        modelDone = time.perf_counter()
+        if self.render:
+            self.evManager.Post(eventmanager.RenderEvent(1.0))
+            self.evManager.Pump(eventmanager.PUMP_LIMIT)
+        renderDone = time.perf_counter()
+        self.phaseTimes['input'].append(inputDone - start)
+        self.phaseTimes['model'].append(modelDone - inputDone)
+        self.phaseTimes['render'].append(renderDone - modelDone)
+        self.frameTimes.append(renderDone - start)
+
+    def run(self, frames, script = None):
+        """
+        Runs frames frames, calling script(bench, frame) before each one.
+        """
+        for frame in range(frames):
+            if script:
+                script(self, frame)
+            self.runFrame()
+
+    def stopSaving(self):
+        """
+        Waits for the saves asked for so far to be written, and stops saving.
+        """
+        if self.saves and self.saves.writer.is_alive():
+            self.saves.writer.stop()
+
+    def report(self, name):
+        """
+        Prints frame time percentiles, mean time per phase and peak memory.
+        """
+        ms = 1000.0
+        print("%-12s frames %5d  p50 %7.3f  p95 %7.3f  p99 %7.3f ms" % (
+            name, len(self.frameTimes),
+            percentile(self.frameTimes, 0.50) * ms,
+            percentile(self.frameTimes, 0.95) * ms,
+            percentile(self.frameTimes, 0.99) * ms))
+        phases = "  ".join("%s %7.3f" % (phase, ms * sum(times) / max(1, len(times)))
+            for phase, times in self.phaseTimes.items())
+        peak = peakMemoryMb()
+        print("%-12s mean ms: %s  peak rss %s MB" % (
+            "", phases, "%.1f" % peak if peak is not None else "n/a"))
+
+
+def playScript(bench, frame):
+    """
+    Script step that enters the play state on the first frame.
+    """
+    if frame == 0:
+        bench.model.state.push(model.STATE_PLAY)
+
+
+def wasdScript(bench, frame):
+    """
+    Holds D, S, A then W for 60 frames each, panning a loop across the map.
+    """
+    playScript(bench, frame)
+    keys = [pygame.K_d, pygame.K_s, pygame.K_a, pygame.K_w]
+    bench.input.pressed = set([keys[(frame // 60) % len(keys)]])
+
+
+def mouseSweepScript(bench, frame):
+    """
+    Sweeps the mouse across the screen in rows, one motion event per frame.
+    """
+    playScript(bench, frame)
+    step = 24
+    columns = model.SCREEN_WIDTH // step
+    x = (frame % columns) * step
+    y = ((frame // columns) * step) % model.SCREEN_HEIGHT
+    bench.input.moveMouse((x, y))
+
+
+def sessionScript(source, frame):
+    """
+    Plays a session through the input only: space starts the game, then WASD
+    pans while the mouse sweeps the screen, zooming out and back every 120 frames.
+    """
+    if frame == 0:
+        source.post(pygame.event.Event(pygame.KEYDOWN, key = pygame.K_SPACE, mod = 0, unicode = ' '))
+    keys = [pygame.K_d, pygame.K_s, pygame.K_a, pygame.K_w]
+    source.pressed = set([keys[(frame // 60) % len(keys)]])
+    source.moveMouse(((frame * 24) % model.SCREEN_WIDTH, (frame * 8) % model.SCREEN_HEIGHT))
+    if frame % 120 == 60:
+        source.post(pygame.event.Event(pygame.MOUSEWHEEL, x = 0, y = -1))
+    elif frame % 120 == 90:
+        source.post(pygame.event.Event(pygame.MOUSEWHEEL, x = 0, y = 1))
+
+
+def benchIdleMenu(frames = 300):
+    """
+    The menu with no input.
+    """
+    bench = FrameBench()
+    bench.run(frames)
+    bench.report('idle-menu')
+
+
+def benchWasdPan(frames = 480):
+    """
+    Panning with WASD across classic-medium.csv.
+    """
+    bench = FrameBench()
+    bench.run(frames, wasdScript)
+    bench.report('wasd-pan')
+
+
+def benchMouseSweep(frames = 300):
+    """
+    Moving the mouse over the map in the play state.
+    """
+    bench = FrameBench()
+    bench.run(frames, mouseSweepScript)
+    bench.report('mouse-sweep')
+
+
+def benchBigMap(frames = 480):
+    """
+    Panning with WASD across a 1000x1000 map.
+    """
+    tileMap = buildTileMap(loadTileIds(CLASSIC_MEDIUM), 5, 8)
+    tileMap.resources = mapgen.generateResources(tileMap.terrain, 1)
+    bench = FrameBench(tileMap)
+    bench.run(frames, wasdScript)
+    bench.report('big-map')
+
+
+def benchReplay(frames = 480):
+    """
+    Records a scripted session, writes its log and replays it, once rendering
+    every tick and once ticking only.
+    """
+    source = controller.ScriptedInput()
+    recorder = replay.InputRecorder(source, seed = 1)
+    bench = FrameBench(seed = 1, inputSource = recorder)
+    bench.run(frames, lambda bench, frame: sessionScript(source, frame))
+    bench.report('recorded')
+    fileName = os.path.join(tempfile.mkdtemp(), "session.rec")
+    replay.writeLog(fileName, recorder.log)
+    log = replay.readLog(fileName)
+    print("%-12s log %d ticks  %d bytes" % ("", len(log), os.path.getsize(fileName)))
+    os.remove(fileName)
+    os.rmdir(os.path.dirname(fileName))
+    for render in (True, False):
+        replayed = replay.replay(log, render)
+        replayed.report('replay' if render else 'replay-tick')
+
+
+def benchEntities(count = 100000, frames = 480):
+    """
+    100k entities on a 1000x1000 map: creating them, iterating over a component set,
+    finding the ones in the camera, and panning with WASD while they are drawn.
+    """
+    tileMap = buildTileMap(loadTileIds(CLASSIC_MEDIUM), 5, 8)
+    bench = FrameBench(tileMap)
+    entities = bench.model.entities
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for i in range(count):
+        entities.create(rng.randrange(tileMap.width), rng.randrange(tileMap.height), owner = rng.randrange(1, 9),
+            structure = rng.choice((ecs.FARM, ecs.MINE, ecs.TOWN)), rate = rng.randrange(1, 4),
+            health = rng.randrange(50, 101))
+    createTime = time.perf_counter() - start
+    start = time.perf_counter()
+    damaged = sum(1 for entity in entities.query(ecs.POSITION | ecs.HEALTH) if entities.health[entity] < 100)
+    queryTime = time.perf_counter() - start
+    camera = bench.model.camera
+    tileRange = tileMap.getTileRange(camera.rect)
+    start = time.perf_counter()
+    for i in range(100):
+        visible = entities.getEntitiesInRange(tileRange)
+    rangeTime = (time.perf_counter() - start) / 100
+    print("entities: %d  create %.2f s  query %.1f ms (%d damaged)  camera range %.3f ms (%d visible)" % (
+        len(entities), createTime, queryTime * 1000, damaged, rangeTime * 1000, len(visible)))
+    bench.run(frames, wasdScript)
+    bench.report('entities')
+
+
+def benchWorldGen():
+    """
+    Generating worlds of growing size, in this process and with a worker per CPU.
+    """
+    print("world-gen: procedural world generation")
+    print("%12s %10s %12s %12s" % ("size", "tiles", "1 worker (s)", "%d workers (s)" % (os.cpu_count() or 1)))
+    for width, height in [(1024, 1024), (4096, 2048), (4096, 4096)]:
+        times = []
+        for workers in (1, None):
+            start = time.perf_counter()
+            mapgen.generateTileMap(width, height, seed = 1, workers = workers)
+            times.append(time.perf_counter() - start)
+        print("%12s %10d %12.2f %12.2f" % ("%dx%d" % (width, height), width * height, times[0], times[1]))
+
+
+def benchStreamPan(frames = 480):
+    """
+    Panning with WASD across a generated 4096x4096 map file streamed around the camera.
+    """
+    fileName = os.path.join(tempfile.mkdtemp(), "stream.map")
+    mapgen.generateMapFile(fileName, 4096, 4096, seed = 1)
+    tileMap = streaming.StreamingTileMap(fileName)
+    bench = FrameBench(tileMap)
+    bench.run(frames, wasdScript)
+    bench.report('stream-pan')
+    print("%-12s resident chunks %d  stalled loads %d" % ("", len(tileMap.chunks), tileMap.stalls))
+    tileMap.close()
+    os.remove(fileName)
+    os.rmdir(os.path.dirname(fileName))
+
+
+def benchYields(ticks = 300, changes = 1000):
+    """
+    Yield engine on a generated 4096x4096 map: building the rates and sums,
+    ticking with a few owners, and changing tiles one by one.
+    Also the slowest tick while another engine builds them in the background.
+    """
+    evManager = eventmanager.EventManager()
+    gameModel = model.GameEngine(evManager)
+    gameModel.tileMap, seed = mapgen.generateTileMap(4096, 4096, seed = 1)
+    economy = yields.YieldEngine(evManager, gameModel)
+    start = time.perf_counter()
+    economy.build(gameModel.tileMap)
+    buildTime = time.perf_counter() - start
+    tickManager = eventmanager.EventManager()
+    background = yields.YieldEngine(tickManager, gameModel)
+    slowestTick = 0.0
+    while background.tileMap is not gameModel.tileMap:
+        start = time.perf_counter()
+        tickManager.Post(eventmanager.TickEvent())
+        slowestTick = max(slowestTick, time.perf_counter() - start)
+        time.sleep(gameModel.scheduler.tickTime)
+    for owner in range(1, 9):
+        for col in range(64):
+            economy.setOwner(owner * 400 + col, 2000, owner)
+    start = time.perf_counter()
+    for tick in range(ticks):
+        evManager.Post(eventmanager.TickEvent())
+    tickTime = (time.perf_counter() - start) / ticks
+    start = time.perf_counter()
+    for change in range(changes):
+        gameModel.changeTile(change % 4096, change // 4096 * 7, model.PLAINS, model.WHEAT)
+    changeTime = (time.perf_counter() - start) / changes
+    print("yields: %d tiles  build %.2f s  slowest tick while built %.1f ms  tick %.3f ms  tile change %.3f ms" % (
+        len(gameModel.tileMap), buildTime, slowestTick * 1000, tickTime * 1000, changeTime * 1000))
+
+
+def benchSaveGame(changes = 1000):
+    """
+    Saving and loading a game on a generated 4096x4096 map: the time the game thread
+    spends on a snapshot and on a delta save, the time the writer takes, and loading.
+    """
+    directory = tempfile.mkdtemp()
+    fileName = os.path.join(directory, "bench.sav")
+    evManager = eventmanager.EventManager()
+    gameModel = model.GameEngine(evManager)
+    gameModel.tileMap, gameModel.seed = mapgen.generateTileMap(4096, 4096, seed = 1)
+    saves = savegame.SaveManager(evManager, gameModel, fileName, autosaveTicks = 0)
+    times = []
+    for full in (True, False):
+        if not full:
+            for change in range(changes):
+                gameModel.changeTile(change % 4096, change // 4096 * 7, model.PLAINS, model.WHEAT)
+        start = time.perf_counter()
+        saves.save(full)
+        queued = time.perf_counter() - start
+        saves.writer.flush()
+        times.append((queued, time.perf_counter() - start))
+    start = time.perf_counter()
+    savegame.load(fileName)
+    loadTime = time.perf_counter() - start
+    saves.writer.stop()
+    sizes = [os.path.getsize(name) for name in (fileName, savegame.deltaFileName(fileName))]
+    print("savegame: %d tiles, %d changed" % (len(gameModel.tileMap), changes))
+    print("%-12s game thread %8.2f ms  written after %8.2f ms  %10d bytes" % (
+        "snapshot", times[0][0] * 1000, times[0][1] * 1000, sizes[0]))
+    print("%-12s game thread %8.2f ms  written after %8.2f ms  %10d bytes" % (
+        "delta", times[1][0] * 1000, times[1][1] * 1000, sizes[1]))
+    print("%-12s %.2f s" % ("load", loadTime))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+def benchServer(clients = 200, seconds = 5.0):
+    """
+    The simulation server with many local clients panning around classic-medium.csv.
+    """
+    asyncio.run(server.loadTest(clients, seconds))
+
+
+def timeQueries(query, pairs):
+    """
+    Returns queries per second of query(start, goal) over pairs.
+    """
+    start = time.perf_counter()
+    for pair in pairs:
+        query(*pair)
+    return len(pairs) / (time.perf_counter() - start)
+
+
+def benchPathfinding(queries = 100):
+    """
+    Path queries per second on classic-medium.csv and a generated 2048x2048 map,
+    between random tiles that can reach each other, plus distance field use.
+    """
+    print("pathfinding: queries per second")
+    print("%-16s %10s %10s %10s %10s %12s" % ("map", "A*", "long cold", "long warm", "field (s)", "unit steps"))
+    classic = buildTileMap(loadTileIds(CLASSIC_MEDIUM))
+    generated, seed = mapgen.generateTileMap(2048, 2048, seed = 1)
+    for name, tileMap, maxDistance in [("classic-medium", classic, None), ("generated-2048", generated, 300)]:
+        evManager = eventmanager.EventManager()
+        gameModel = model.GameEngine(evManager)
+        gameModel.tileMap = tileMap
+        finder = pathfinding.Pathfinder(evManager, gameModel)
+        finder.update()
+        rand = random.Random(1)
+        pairs = []
+        while len(pairs) < queries:
+            start = (rand.randrange(tileMap.width), rand.randrange(tileMap.height))
+            if maxDistance:
+                goal = (min(tileMap.width - 1, max(0, start[0] + rand.randrange(-maxDistance, maxDistance))),
+                    min(tileMap.height - 1, max(0, start[1] + rand.randrange(-maxDistance, maxDistance))))
+            else:
+                goal = (rand.randrange(tileMap.width), rand.randrange(tileMap.height))
+            if finder.costs[finder.toIndex(start)] and finder.findLongPath(start, goal):
+                pairs.append((start, goal))
+        warm = timeQueries(finder.findLongPath, pairs)
+        finder.clusters.clear()
+        finder.borders.clear()
+        cold = timeQueries(finder.findLongPath, pairs)
+        astar = timeQueries(finder.findPath, pairs)
+        # many units heading for the first goal
+        goal = pairs[0][1]
+        fieldStart = time.perf_counter()
+        field = finder.getDistanceField(goal, maxCost = 400 * pathfinding.STRAIGHT)
+        fieldTime = time.perf_counter() - fieldStart
+        units = [finder.toPos(index) for index in list(field.distances)[:1000]]
+        stepStart = time.perf_counter()
+        for unit in units:
+            field.nextStep(unit)
+        steps = len(units) / (time.perf_counter() - stepStart)
+        print("%-16s %10.1f %10.1f %10.1f %10.2f %12.0f" % (name, astar, cold, warm, fieldTime, steps))
+
+
+BENCHMARKS = {
+    'idle-menu': benchIdleMenu,
+    'wasd-pan': benchWasdPan,
+    'mouse-sweep': benchMouseSweep,
+    'big-map': benchBigMap,
+    'entities': benchEntities,
+    'replay': benchReplay,
+    'world-gen': benchWorldGen,
+    'stream-pan': benchStreamPan,
+    'yields': benchYields,
+    'pathfinding': benchPathfinding,
+    'savegame': benchSaveGame,
+    'server': benchServer,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
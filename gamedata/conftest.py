@@ -0,0 +1,19 @@
+"""
+Shared pytest setup: the tests run headless and from the gamedata folder, like the game.
+Run them from the repository or the gamedata folder with:
+
+    python -m pytest -q
+"""
+import os
+# tests never need a real window
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pytest
+
+GAMEDATA = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(autouse = True)
+def gamedataFolder(monkeypatch):
+    # maps and images are found relative to the gamedata folder
+    monkeypatch.chdir(GAMEDATA)
@@ -1,68 +1,166 @@
 import pygame
 import model
-import csv
-from random import random
+import mapgen
+import streaming
 from eventmanager import *
 
+class PygameInput(object):
+    """
+    Reads input from pygame. This is where Keyboard gets its input from
+    unless it is given another input source.
+    """
+
+    def getEvents(self):
+        """
+        Returns the pygame events since the last call.
+        """
+        return pygame.event.get()
+
+    def getPressed(self):
+        """
+        Returns the pressed state of every key, indexed by pygame key constant.
+        """
+        return pygame.key.get_pressed()
+
+    def getMousePos(self):
+        """
+        Returns the mouse position on screen.
+        """
+        return pygame.mouse.get_pos()
+
+
+class ScriptedInput(object):
+    """
+    Input source driven by code instead of devices, for headless runs.
+    Set pressed keys and the mouse position and queue events before each tick.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pressed = set()
+        self.mousePos = (0, 0)
+
+    def post(self, event):
+        """
+        Queues a pygame event for the next tick.
+        """
+        self.events.append(event)
+
+    def moveMouse(self, pos):
+        """
+        Moves the mouse and queues the MOUSEMOTION event for it.
+        """
+        self.mousePos = pos
+        self.post(pygame.event.Event(pygame.MOUSEMOTION, pos = pos, rel = (0, 0), buttons = (0, 0, 0)))
+
+    def getEvents(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def getPressed(self):
+        return ScriptedKeys(self.pressed)
+
+    def getMousePos(self):
+        return self.mousePos
+
+
+class ScriptedKeys(object):
+    """
+    Pressed key states of a ScriptedInput, indexed like pygame.key.get_pressed().
+    """
+
+    def __init__(self, pressed):
+        self.pressed = pressed
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
 class Keyboard(object):
     """
     Handles keyboard input.
     """
 
-    def __init__(self, evManager, model):
+    def __init__(self, evManager, model, inputSource = None):
         """
         evManager (EventManager): Allows posting messages to the event queue.
         model (GameEngine): a strong reference to the game Model.
+        inputSource: where input is read from, PygameInput() if None.
         """
         self.evManager = evManager
-        evManager.RegisterListener(self)
+        evManager.Subscribe(TickEvent, self.onTick)
         self.model = model
+        self.input = inputSource if inputSource is not None else PygameInput()
         self.loadMap("assets/maps/classic-medium.csv")
-        self.updateTilesOnScreen()
 
-    def notify(self, event):
+    def onTick(self, event):
         """
-        Receive events posted to the message queue. 
+        Called for each game tick. We check our keyboard presses, mouse clicks, and mouse movement here.
         """
-
-        if isinstance(event, TickEvent):
-            # Called for each game tick. We check our keyboard presses, mouse clicks, and mouse movement here.
-            for event in pygame.event.get():
-                # handle window manager closing our window
-                if event.type == pygame.QUIT:
-                    self.evManager.Post(QuitEvent())
-                # handle key down events
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_ESCAPE:
-                        self.evManager.Post(StateChangeEvent(None))
-                    else:
-                        currentstate = self.model.state.peek()
-                        if currentstate == model.STATE_MENU:
-                            self.keydownmenu(event)
-                        if currentstate == model.STATE_PLAY:
-                            self.keydownplay(event)
-                        if currentstate == model.STATE_HELP:
-                            self.keydownhelp(event)
-                # handle mouse up events
-                if event.type == pygame.MOUSEBUTTONUP:
-                    currentstate = self.model.state.peek()
-                    if currentstate == model.STATE_MENU:
-                        self.mouseupmenu(event)
-                # handle mouse move events
-                if event.type == pygame.MOUSEMOTION:
+        for event in self.input.getEvents():
+            # handle window manager closing our window
+            if event.type == pygame.QUIT:
+                self.evManager.Post(QuitEvent())
+            # handle key down events
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    self.evManager.Post(StateChangeEvent(None))
+                # F3 toggles the debug overlay, F4 saves the profiler stats
+                elif event.key == pygame.K_F3:
+                    self.model.showDebugOverlay = not self.model.showDebugOverlay
+                    # the overlay shows the profiler stats, so they are recorded while it is up
+                    profiler = self.evManager.profiler
+                    if profiler:
+                        profiler.enabled = profiler.pinned or self.model.showDebugOverlay
+                elif event.key == pygame.K_F4:
+                    self.exportProfile()
+                # F5 saves the whole game, F9 loads the last save
+                elif event.key == pygame.K_F5:
+                    self.evManager.Post(SaveEvent(full = True))
+                elif event.key == pygame.K_F9:
+                    self.evManager.Post(LoadEvent())
+                else:
                     currentstate = self.model.state.peek()
                     if currentstate == model.STATE_MENU:
-                        self.mousemovemenu(event)
+                        self.keydownmenu(event)
                     if currentstate == model.STATE_PLAY:
-                        self.mousemoveplay(event)
-            # We check for keyboard keys that are held down here.
-            try: # try so we don't get an error after exiting
-                keys = pygame.key.get_pressed()
+                        self.keydownplay(event)
+                    if currentstate == model.STATE_HELP:
+                        self.keydownhelp(event)
+            # handle mouse up events
+            if event.type == pygame.MOUSEBUTTONUP:
                 currentstate = self.model.state.peek()
+                if currentstate == model.STATE_MENU:
+                    self.mouseupmenu(event)
                 if currentstate == model.STATE_PLAY:
-                    self.keyhelddownplay(keys)
-            except:
-                pass
+                    self.mouseupplay(event)
+            # handle mouse move events
+            if event.type == pygame.MOUSEMOTION:
+                currentstate = self.model.state.peek()
+                if currentstate == model.STATE_MENU:
+                    self.mousemovemenu(event)
+                if currentstate == model.STATE_PLAY:
+                    self.mousemoveplay(event)
+            # handle mouse wheel events
+            if event.type == pygame.MOUSEWHEEL:
+                if self.model.state.peek() == model.STATE_PLAY:
+                    self.mousewheelplay(event)
+        # We check for keyboard keys that are held down here.
+        try: # try so we don't get an error after exiting
+            keys = self.input.getPressed()
+            currentstate = self.model.state.peek()
+            if currentstate == model.STATE_PLAY:
+                self.keyhelddownplay(keys)
+        except:
+            pass
+
+    def exportProfile(self, fileName = "profile.json"):
+        """
+        Writes the profiler stats to a JSON (or .csv) trace file.
+        """
+        if self.evManager.profiler:
+            self.evManager.profiler.export(fileName)
 
     def keydownmenu(self, event):
         """
@@ -94,34 +192,39 @@ class Keyboard(object):
         # F1 shows the help
         if event.key == pygame.K_F1:    
             self.evManager.Post(StateChangeEvent(model.STATE_HELP))
+        # + and - zoom around the screen center
+        elif event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+            self.zoom(-1)
+        elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+            self.zoom(1)
+        # M shows or hides the minimap
+        elif event.key == pygame.K_m:
+            self.model.minimap.visible = not self.model.minimap.visible
         else:
             self.evManager.Post(InputEvent(event.unicode, None))
     def keyhelddownplay(self, keys):
         """
         Handles key held down events when playing
         """
-        # WASD: move camera
+        # WASD: move camera 16 screen pixels, whatever the zoom
+        camera = self.model.camera
+        step = 16 * camera.tileSize // camera.getTilePixels()
         if keys[pygame.K_w]:
-            self.model.camera.rect.y -= 16
-            self.updateTilesOnScreen()
+            camera.rect.y -= step
         if keys[pygame.K_s]:
-            self.model.camera.rect.y += 16
-            self.updateTilesOnScreen()
+            camera.rect.y += step
         if keys[pygame.K_a]:
-            self.model.camera.rect.x -= 16
-            self.updateTilesOnScreen()
+            camera.rect.x -= step
         if keys[pygame.K_d]:
-            self.model.camera.rect.x += 16
-            self.updateTilesOnScreen()
+            camera.rect.x += step
         self.updateTilesHovered()
-        # update tilesOnScreen
 
     def mouseupmenu(self, event):
         """
         Handles menu mouse up events
         """
         menu = self.model.mainMenu
-        mousePos = pygame.mouse.get_pos()
+        mousePos = self.input.getMousePos()
         # if mouse is on button, do something.
         for button in menu.buttons:
             if (button.rect.collidepoint(mousePos)):
@@ -132,12 +235,27 @@ class Keyboard(object):
                 if (button.text == "EXIT"):
                     self.evManager.Post(QuitEvent())
     
+    def mouseupplay(self, event):
+        """
+        Handles play mouse up events: clicking the minimap moves the camera there,
+        left clicking a tile of the map claims it for the local player.
+        """
+        minimap = self.model.minimap
+        tileMap = self.model.tileMap
+        mousePos = self.input.getMousePos()
+        if minimap.visible and minimap.getRect(tileMap).collidepoint(mousePos):
+            self.model.camera.jumpTo(minimap.screenToMap(mousePos, tileMap))
+            self.updateTilesHovered()
+        elif event.button == 1 and self.model.tileHover.tile:
+            tile = self.model.tileHover.tile
+            self.evManager.Post(ClaimTileEvent(tile.col, tile.row, model.LOCAL_PLAYER))
+
     def mousemovemenu(self, event):
         """
         Handles menu mouse move events
         """
         menu = self.model.mainMenu
-        mousePos = pygame.mouse.get_pos()
+        mousePos = self.input.getMousePos()
         
         for button in menu.buttons:
             if (button.rect.collidepoint(mousePos)):
@@ -151,92 +269,53 @@ class Keyboard(object):
         """
         self.updateTilesHovered()
 
-    # MAP GEN
-    def loadMap(self, csvFileName):
+    def mousewheelplay(self, event):
         """
-        Converts a CSV file into a set of Tile objects which are stored into a TileMap
+        Handles play mouse wheel events: zoom around the mouse.
         """
-        tileSize = 32
-        # generate tiles from CSV file into a set of tiles and a set of ids
-        tiles = []
-        tileIds = []
-        with open(csvFileName) as csvFile:
-            csvReader = csv.reader(csvFile, delimiter = ',')
-            for row, line in enumerate(csvReader):
-                # for each row, add a new row to tileIds list
-                tileIds.append([])
-                for col, tileId in enumerate(line):
-                    # for each column, add id to tileIds and add Tile to tiles with a generated resource
-                    tileIds[row].append(int(tileId))
-                    generatedTile = model.Tile(int(tileId), tileSize*col, tileSize*row, tileSize)
-                    generatedResource = self.generateResource(generatedTile)
-                    generatedTile.resource = generatedResource
-                    tiles.append(generatedTile)
-        self.model.tileMap = model.TileMap(tileIds, tiles)
-    
-    def generateResource(self, tile):
+        if event.y > 0:
+            self.zoom(-1, self.input.getMousePos())
+        elif event.y < 0:
+            self.zoom(1, self.input.getMousePos())
+
+    def zoom(self, change, anchor = None):
         """
-        returns a random resource (or none) depending on tile's tileId
+        Zooms the camera in (change < 0) or out (change > 0) by change levels,
+        keeping the map under the screen position anchor in place.
         """
+        camera = self.model.camera
+        camera.setZoom(camera.zoomLevel + change, anchor)
+        self.updateTilesHovered()
 
-        if tile.tileId == model.GRASSLAND:
-            # grassland probability distribution:
-            # None: 97%
-            # Wheat: 2.75%
-            # Mountain: 0.25%
-            randomNum =  random()
-            if randomNum > 1 - 0.0275:
-                return model.Resource(tile, model.WHEAT)
-            elif randomNum > 1 - 0.03 :
-                return model.Resource(tile, model.MOUNTAIN)
-            else:
-                return None
-        elif tile.tileId == model.PLAINS:
-            # plains probability distribution:
-            # None: 80%
-            # Wheat: 20%
-            randomNum =  random()
-            if randomNum > 0.8:
-                return model.Resource(tile, model.WHEAT)
-            else:
-                return None
-        elif tile.tileId == model.TUNDRA:
-            # plains probability distribution:
-            # None: 85%
-            # Mountain: 15%
-            randomNum =  random()
-            if randomNum > 0.85:
-                return model.Resource(tile, model.MOUNTAIN)
-            else:
-                return None
-        else:
-            return None
-
-        
+    # MAP GEN
+    def loadMap(self, mapFileName, seed = None, stream = False):
+        """
+        Loads a binary map file or a CSV file into a TileMap.
+        The format is detected from the file contents.
+        Resources are generated from seed if the file has none.
+        A random seed is picked if it is None, either way it is kept in model.seed.
+        With stream, a binary map file with resources is streamed in chunks
+        around the camera instead, and changes are saved back to it.
+        """
+        tileSize = 32
+        if stream:
+            self.model.setTileMap(streaming.StreamingTileMap(mapFileName, tileSize))
+            return
+        self.model.setTileMap(*mapgen.loadTileMap(mapFileName, seed, tileSize))
 
-    # TILE UPDATES
-    def updateTilesOnScreen(self):
+    def generateMap(self, width, height, seed = None, workers = None):
         """
-        Updates tileMap's tilesOnScreen property to contain only tiles which are on screen
+        Replaces the map with a procedurally generated world, see mapgen.generateTileMap.
         """
-        self.model.tileMap.tilesOnScreen = []
-        for tile in self.model.tileMap.tiles:
-            #                                                  \/ offset tile x to fix visual glitch
-            if self.model.camera.rect.collidepoint(tile.rect.centerx + 16, tile.rect.centery + 16):
-                self.model.tileMap.tilesOnScreen.append(tile)
-    
+        self.model.setTileMap(*mapgen.generateTileMap(width, height, seed, workers = workers))
+
+    # TILE UPDATES
     def updateTilesHovered(self):
         """
-        Updates hovered property of tile
+        Updates hovered property of the tile under the mouse
         """
-        x, y = pygame.mouse.get_pos()
-        x += self.model.camera.rect.x
-        y += self.model.camera.rect.y
-        for tile in self.model.tileMap.tilesOnScreen:
-            if tile.rect.collidepoint((x, y)):
-                tile.hovered = True
-            else:
-                tile.hovered = False
+        x, y = self.model.camera.screenToMap(self.input.getMousePos())
+        self.model.tileHover.update(self.model.tileMap, x, y)
 
 
 
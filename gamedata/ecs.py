@@ -0,0 +1,352 @@
+"""
+Entity-component store for structures and units.
+
+An entity is only an id. Its components live in packed arrays indexed by that id,
+one array per component field, and a bit per component in masks says which ones it
+has. Systems iterate over every entity having a set of components with query(), which
+finds them with one bytes.translate() of the masks instead of visiting each entity.
+
+Entities with a position are also kept in a spatial index of CELL_TILES square cells,
+so the entities on a tile or inside the camera are found without scanning them all.
+Production rates are summed per owner as they change, so paying out production costs
+nothing per entity, like the tile yields in yields.py.
+"""
+from array import array
+from itertools import compress
+
+# component bits of masks
+POSITION = 1
+OWNER = 2
+STRUCTURE = 4
+PRODUCTION = 8
+HEALTH = 16
+# set for every live entity, so free ids match no query
+ALIVE = 128
+
+# structure types
+FARM = 1
+MINE = 2
+TOWN = 3
+
+# owner of entities no player owns
+UNOWNED = 0
+# owners are kept in a byte per entity, in save files and in server updates too
+MAX_OWNER = 255
+# the spatial index cells are CELL_TILES by CELL_TILES tiles
+CELL_TILES = 16
+# beyond this many changed tiles between two frames, the view redraws everything
+CHANGED_LIMIT = 1024
+
+
+def buildQueryTable(mask):
+    """
+    Returns a bytes.translate() table mapping entity masks to 1 if they have every bit of mask.
+    """
+    mask |= ALIVE
+    return bytes(1 if value & mask == mask else 0 for value in range(256))
+
+
+def checkOwner(owner):
+    """
+    Raises ValueError if owner is not an owner the owner arrays can hold.
+    """
+    if not UNOWNED <= owner <= MAX_OWNER:
+        raise ValueError("owner %d is not between %d and %d" % (owner, UNOWNED, MAX_OWNER))
+
+
+class EntityStore(object):
+    """
+    Creates and destroys entities, and holds their components.
+    """
+
+    def __init__(self, cellTiles = CELL_TILES):
+        """
+        cellTiles (int): width and height in tiles of the spatial index cells.
+
+        Attributes:
+        masks (array): component bits of each entity id, 0 for free ids.
+        cols, rows (array): POSITION, the tile the entity is on.
+        owners (array): OWNER, the player owning the entity.
+        structures (array): STRUCTURE, the structure type.
+        rates (array): PRODUCTION, production per second.
+        health, maxHealth (array): HEALTH, hit points left and at most.
+        cells (dict): (cellCol, cellRow): set of the ids of the entities in the cell.
+        ownerProduction (dict): owner: summed rates of its entities with PRODUCTION.
+        """
+        self.cellTiles = cellTiles
+        self.queryTables = {}
+        self.clear()
+        # the view starts with a full redraw anyway
+        self.allChanged = False
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        """
+        Destroys every entity. Use when a new TileMap is loaded.
+        """
+        self.masks = array('B')
+        self.cols = array('i')
+        self.rows = array('i')
+        self.owners = array('B')
+        self.structures = array('B')
+        self.rates = array('H')
+        self.health = array('H')
+        self.maxHealth = array('H')
+        self.free = []
+        self.count = 0
+        self.cells = {}
+        self.ownerProduction = {}
+        # tiles whose entities changed since the view last looked, see popChangedTiles()
+        self.changedTiles = set()
+        self.allChanged = True
+
+    # ENTITIES
+    def create(self, col = None, row = None, owner = None, structure = None, rate = None, health = None):
+        """
+        Returns the id of a new entity, with the components whose values are given:
+        POSITION (col, row), OWNER, STRUCTURE, PRODUCTION (rate) and HEALTH.
+        """
+        if owner is not None:
+            checkOwner(owner)
+        if self.free:
+            entity = self.free.pop()
+        else:
+            entity = len(self.masks)
+            for components in (self.masks, self.cols, self.rows, self.owners, self.structures,
+                               self.rates, self.health, self.maxHealth):
+                components.append(0)
+        self.masks[entity] = ALIVE
+        self.count += 1
+        if owner is not None:
+            self.setOwner(entity, owner)
+        if structure is not None:
+            self.setStructure(entity, structure)
+        if rate is not None:
+            self.setProduction(entity, rate)
+        if health is not None:
+            self.setHealth(entity, health)
+        if col is not None:
+            self.setPosition(entity, col, row)
+        return entity
+
+    def destroy(self, entity):
+        """
+        Removes an entity and all its components. Its id is reused by a later create().
+        """
+        if not self.masks[entity]:
+            return
+        for component in (POSITION, OWNER, PRODUCTION):
+            self.remove(entity, component)
+        self.masks[entity] = 0
+        self.free.append(entity)
+        self.count -= 1
+
+    def has(self, entity, components):
+        """
+        Returns True if the entity is alive and has every component bit in components.
+        """
+        components |= ALIVE
+        return self.masks[entity] & components == components
+
+    def remove(self, entity, component):
+        """
+        Removes one component from an entity.
+        """
+        mask = self.masks[entity]
+        if not mask & component:
+            return
+        if component == POSITION:
+            self.unlink(entity)
+        elif component == OWNER and mask & PRODUCTION:
+            # its production goes to nobody now
+            self.moveProduction(entity, self.owners[entity], UNOWNED)
+        elif component == PRODUCTION:
+            self.addProduction(entity, -self.rates[entity])
+        self.masks[entity] = mask & ~component
+        if mask & POSITION:
+            self.changedTile(self.cols[entity], self.rows[entity])
+
+    def query(self, components):
+        """
+        Returns an iterator over the ids of the live entities having every component bit in components.
+        """
+        table = self.queryTables.get(components)
+        if table is None:
+            table = self.queryTables[components] = buildQueryTable(components)
+        return compress(range(len(self.masks)), self.masks.tobytes().translate(table))
+
+    # COMPONENTS
+    def setPosition(self, entity, col, row):
+        """
+        Moves an entity to the tile (col, row), giving it a POSITION if it had none.
+        """
+        if self.masks[entity] & POSITION:
+            self.unlink(entity)
+        self.masks[entity] |= POSITION
+        self.cols[entity] = col
+        self.rows[entity] = row
+        self.cells.setdefault((col // self.cellTiles, row // self.cellTiles), set()).add(entity)
+        self.changedTile(col, row)
+
+    def setOwner(self, entity, owner):
+        """
+        Gives an entity to owner, moving its production to the new owner's sum.
+        """
+        checkOwner(owner)
+        mask = self.masks[entity]
+        if mask & PRODUCTION:
+            self.moveProduction(entity, self.owners[entity] if mask & OWNER else UNOWNED, owner)
+        self.masks[entity] = mask | OWNER
+        self.owners[entity] = owner
+        if mask & POSITION:
+            self.changedTile(self.cols[entity], self.rows[entity])
+
+    def setStructure(self, entity, structure):
+        self.masks[entity] |= STRUCTURE
+        self.structures[entity] = structure
+        if self.masks[entity] & POSITION:
+            self.changedTile(self.cols[entity], self.rows[entity])
+
+    def setProduction(self, entity, rate):
+        """
+        Sets the production per second of an entity, patching its owner's sum.
+        """
+        if self.masks[entity] & PRODUCTION:
+            self.addProduction(entity, -self.rates[entity])
+        self.masks[entity] |= PRODUCTION
+        self.rates[entity] = rate
+        self.addProduction(entity, rate)
+
+    def setHealth(self, entity, health, maxHealth = None):
+        """
+        Sets the hit points of an entity, and the most it can have (health if None the first time).
+        """
+        if maxHealth is not None or not self.masks[entity] & HEALTH:
+            self.maxHealth[entity] = maxHealth if maxHealth is not None else health
+        self.masks[entity] |= HEALTH
+        self.health[entity] = min(health, self.maxHealth[entity])
+        # the view draws health bars
+        if self.masks[entity] & POSITION:
+            self.changedTile(self.cols[entity], self.rows[entity])
+
+    def getOwner(self, entity):
+        """
+        Returns the owner of an entity, UNOWNED if it has no OWNER.
+        """
+        return self.owners[entity] if self.masks[entity] & OWNER else UNOWNED
+
+    # PRODUCTION
+    def addProduction(self, entity, change):
+        owner = self.getOwner(entity)
+        self.ownerProduction[owner] = self.ownerProduction.get(owner, 0) + change
+
+    def moveProduction(self, entity, oldOwner, newOwner):
+        rate = self.rates[entity]
+        self.ownerProduction[oldOwner] = self.ownerProduction.get(oldOwner, 0) - rate
+        self.ownerProduction[newOwner] = self.ownerProduction.get(newOwner, 0) + rate
+
+    def getOwnerProduction(self, owner):
+        """
+        Returns the summed production per second of the entities owner has.
+        """
+        return self.ownerProduction.get(owner, 0)
+
+    # SPATIAL INDEX
+    def unlink(self, entity):
+        """
+        Takes an entity out of its spatial index cell.
+        """
+        col = self.cols[entity]
+        row = self.rows[entity]
+        key = (col // self.cellTiles, row // self.cellTiles)
+        cell = self.cells[key]
+        cell.discard(entity)
+        if not cell:
+            del self.cells[key]
+        self.changedTile(col, row)
+
+    def getEntitiesAt(self, col, row):
+        """
+        Returns the ids of the entities on the tile (col, row).
+        """
+        cell = self.cells.get((col // self.cellTiles, row // self.cellTiles), ())
+        return [entity for entity in cell if self.cols[entity] == col and self.rows[entity] == row]
+
+    def getEntitiesInRange(self, tileRange):
+        """
+        Returns the ids of the entities in a (firstCol, firstRow, endCol, endRow) range of tiles.
+        Only the cells overlapping the range are visited, and only entities of cells
+        on its edges are checked one by one.
+        """
+        firstCol, firstRow, endCol, endRow = tileRange
+        if firstCol >= endCol or firstRow >= endRow:
+            return []
+        cellTiles = self.cellTiles
+        cols = self.cols
+        rows = self.rows
+        found = []
+        for cellRow in range(firstRow // cellTiles, (endRow - 1) // cellTiles + 1):
+            top = cellRow * cellTiles
+            rowsInside = firstRow <= top and top + cellTiles <= endRow
+            for cellCol in range(firstCol // cellTiles, (endCol - 1) // cellTiles + 1):
+                cell = self.cells.get((cellCol, cellRow))
+                if not cell:
+                    continue
+                left = cellCol * cellTiles
+                if rowsInside and firstCol <= left and left + cellTiles <= endCol:
+                    found.extend(cell)
+                else:
+                    found.extend(entity for entity in cell if firstCol <= cols[entity] < endCol
+                        and firstRow <= rows[entity] < endRow)
+        return found
+
+    # SAVING
+    def getArrays(self):
+        """
+        Returns the component arrays, all as long as the number of ids, in the order setArrays() takes them.
+        """
+        return [self.masks, self.cols, self.rows, self.owners, self.structures,
+            self.rates, self.health, self.maxHealth]
+
+    def setArrays(self, arrays):
+        """
+        Replaces every entity with the ones held by component arrays like getArrays() returns,
+        rebuilding the free ids, the spatial index and the production sums from them.
+        """
+        self.clear()
+        (self.masks, self.cols, self.rows, self.owners, self.structures,
+            self.rates, self.health, self.maxHealth) = arrays
+        cellTiles = self.cellTiles
+        for entity, mask in enumerate(self.masks):
+            if not mask:
+                self.free.append(entity)
+                continue
+            self.count += 1
+            if mask & POSITION:
+                key = (self.cols[entity] // cellTiles, self.rows[entity] // cellTiles)
+                self.cells.setdefault(key, set()).add(entity)
+            if mask & PRODUCTION:
+                self.addProduction(entity, self.rates[entity])
+
+    # CHANGES
+    def changedTile(self, col, row):
+        if self.allChanged:
+            return
+        self.changedTiles.add((col, row))
+        if len(self.changedTiles) > CHANGED_LIMIT:
+            self.changedTiles = set()
+            self.allChanged = True
+
+    def popChangedTiles(self):
+        """
+        Returns the (col, row) tiles whose entities changed since the last call,
+        or None if too many did to list them.
+        """
+        if self.allChanged:
+            self.allChanged = False
+            return None
+        changedTiles = self.changedTiles
+        self.changedTiles = set()
+        return changedTiles
@@ -1,22 +1,46 @@
+import logging
+from time import perf_counter
+from types import MethodType
+from weakref import WeakMethod
+
+log = logging.getLogger(__name__)
+
+# most events one Pump() of a game loop dispatches, so a handler that keeps posting
+# events makes the rest wait for the next Pump() instead of never returning
+PUMP_LIMIT = 10000
+
+
 class Event(object):
     """
     A superclass for any events that might be generated by an
     object and sent to the EventManager.
     """
     
+    # queued events of a class with coalesce = True are offered to merge()
+    coalesce = False
+    
     def __init__(self):
         self.name = "Generic event"
     def __str__(self):
         return self.name
+    def merge(self, other):
+        """
+        Folds a later event of the same class into this queued one.
+        Returns True if it was merged and other can be dropped.
+        """
+        return False
     
     
 class QuitEvent(Event):
     """
     Quit event.
     """
+    coalesce = True
     
     def __init__ (self):
         self.name = "Quit event"
+    def merge(self, other):
+        return True
     
     
 class TickEvent(Event):
@@ -28,6 +52,18 @@ class TickEvent(Event):
         self.name = "Tick event"
     
     
+class RenderEvent(Event):
+    """
+    Render event, posted by the engine at the render rate.
+    interpolation (float): how far the render time is from the last
+    simulation tick to the next one, from 0 to 1.
+    """
+    
+    def __init__ (self, interpolation = 0.0):
+        self.name = "Render event"
+        self.interpolation = interpolation
+    
+    
 class InputEvent(Event):
     """
     Keyboard or mouse input event.
@@ -70,14 +106,120 @@ class StateChangeEvent(Event):
             return '%s popped' % (self.name, )
 
 
+class TileChangeEvent(Event):
+    """
+    The terrain or resource of some tiles changed.
+    positions is a list of (col, row) map positions.
+    """
+    coalesce = True
+    
+    def __init__(self, positions):
+        self.name = "Tile change event"
+        self.positions = positions
+    def merge(self, other):
+        self.positions = self.positions + other.positions
+        return True
+    def __str__(self):
+        return '%s, %d tiles' % (self.name, len(self.positions))
+
+
+class ClaimTileEvent(Event):
+    """
+    A player claims the tile at (col, row), its yields now go to owner.
+    """
+    
+    def __init__(self, col, row, owner):
+        self.name = "Claim tile event"
+        self.col = col
+        self.row = row
+        self.owner = owner
+    def __str__(self):
+        return '%s, (%d, %d) to %d' % (self.name, self.col, self.row, self.owner)
+
+
+class SaveEvent(Event):
+    """
+    Asks for the game to be saved. full forces a snapshot of the whole game
+    instead of a delta save of the tiles changed since the last one.
+    """
+    
+    def __init__(self, full = False):
+        self.name = "Save event"
+        self.full = full
+    def __str__(self):
+        return '%s, %s' % (self.name, 'full' if self.full else 'delta')
+
+
+class LoadEvent(Event):
+    """
+    Asks for the saved game to be loaded.
+    """
+    
+    def __init__(self):
+        self.name = "Load event"
+
+
+class QueueStats(object):
+    """
+    Counters of a queued EventManager, see EventManager.Pump().
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """
+        Sets every counter back to zero.
+        """
+        self.posted = 0
+        self.coalesced = 0
+        self.dispatched = 0
+        self.batches = 0
+        # largest queue length seen at the start of a batch
+        self.maxDepth = 0
+        # queue length left after the last Pump()
+        self.depth = 0
+        # Pump() calls that stopped at maxEvents with events left
+        self.limited = 0
+    
+    def __str__(self):
+        return 'posted=%d coalesced=%d dispatched=%d batches=%d maxDepth=%d depth=%d limited=%d' % (
+            self.posted, self.coalesced, self.dispatched, self.batches, self.maxDepth, self.depth,
+            self.limited)
+
+
 class EventManager(object):
     """
     We coordinate communication between the Model, View, and Controller.
+
+    Listeners either Subscribe() a handler to the event classes they care about,
+    or RegisterListener() themselves to receive every event through notify().
+    Posted events other than ticks and renders are logged at DEBUG level.
+
+    By default Post() dispatches right away, so an event posted by a handler
+    is handled before the event that handler is running for.
+    In queued mode Post() only queues events, and Pump() dispatches them
+    in FIFO order at the points of the frame where the game loop calls it.
     """
     
-    def __init__(self):
+    def __init__(self, queued = False, profiler = None):
+        """
+        queued (bool): queue posted events until Pump() instead of dispatching them.
+        profiler (Profiler): if given, times every handler and listener per event type.
+        """
         from weakref import WeakKeyDictionary
+        from collections import deque
         self.listeners = WeakKeyDictionary()
+        # (eventClass, handler ref) pairs in the order they were subscribed
+        self.subscriptions = []
+        # event type: tuple of handler refs, built on first Post of that type
+        self.dispatchTable = {}
+        self.queued = queued
+        self.queue = deque()
+        # event type: the last queued event of a coalescing type
+        self.coalescing = {}
+        self.stats = QueueStats()
+        self.profiler = profiler
 
     def RegisterListener(self, listener):
         """ 
@@ -96,15 +238,165 @@ class EventManager(object):
         
         if listener in self.listeners.keys():
             del self.listeners[listener]
+
+    def Subscribe(self, eventClass, handler):
+        """
+        Calls handler(event) for every Post()ed event that is an instance of eventClass.
+        Bound methods are held weakly, like listeners, so subscribing
+        does not keep the object alive.
+        """
+        
+        self.subscriptions.append((eventClass, makeHandlerRef(handler)))
+        self.dispatchTable.clear()
+
+    def Unsubscribe(self, eventClass, handler):
+        """
+        Removes a handler added with Subscribe().
+        """
+        
+        self.subscriptions = [
+            (subscribedClass, ref) for subscribedClass, ref in self.subscriptions
+            if not (subscribedClass is eventClass and ref() == handler)
+            ]
+        self.dispatchTable.clear()
+
+    def getHandlers(self, eventType):
+        """
+        Returns the handler refs subscribed to eventType or one of its superclasses.
+        """
+        
+        handlers = self.dispatchTable.get(eventType)
+        if handlers is None:
+            handlers = tuple(ref for eventClass, ref in self.subscriptions
+                if issubclass(eventType, eventClass))
+            self.dispatchTable[eventType] = handlers
+        return handlers
+
+    def removeDeadHandlers(self):
+        """
+        Drops subscriptions whose object no longer exists.
+        """
+        
+        self.subscriptions = [
+            (eventClass, ref) for eventClass, ref in self.subscriptions
+            if ref() is not None
+            ]
+        self.dispatchTable.clear()
         
     def Post(self, event):
         """
         Post a new event to the message queue.
-        It will be broadcast to all listeners.
+        It is sent to the handlers subscribed to its class
+        and broadcast to all registered listeners,
+        right away or at the next Pump() in queued mode.
+        """
+        
+        if not isinstance(event, (TickEvent, RenderEvent)) and log.isEnabledFor(logging.DEBUG):
+            # log the event (unless it is TickEvent or RenderEvent)
+            log.debug(str(event))
+        if not self.queued:
+            self.dispatch(event)
+            return
+        self.stats.posted += 1
+        if event.coalesce:
+            queuedEvent = self.coalescing.get(type(event))
+            if queuedEvent is not None and queuedEvent.merge(event):
+                self.stats.coalesced += 1
+                return
+            self.coalescing[type(event)] = event
+        self.queue.append(event)
+
+    def Pump(self, maxEvents = None):
+        """
+        Dispatches queued events in FIFO batches until the queue is empty.
+        A batch is the events queued when it starts, events posted while it is
+        dispatched wait for the next batch. With maxEvents, stops after that many
+        events and leaves the rest for the next Pump().
+        Returns the number of events dispatched.
+        """
+        
+        dispatched = 0
+        queue = self.queue
+        while queue and (maxEvents is None or dispatched < maxEvents):
+            batchSize = len(queue)
+            if maxEvents is not None:
+                batchSize = min(batchSize, maxEvents - dispatched)
+            self.stats.batches += 1
+            self.stats.maxDepth = max(self.stats.maxDepth, len(queue))
+            for i in range(batchSize):
+                event = queue.popleft()
+                if self.coalescing.get(type(event)) is event:
+                    # later events of this type start a new one
+                    del self.coalescing[type(event)]
+                self.dispatch(event)
+            dispatched += batchSize
+        if queue and maxEvents is not None:
+            self.stats.limited += 1
+        self.stats.dispatched += dispatched
+        self.stats.depth = len(queue)
+        return dispatched
+
+    def dispatch(self, event):
+        """
+        Sends an event to its subscribed handlers and to all listeners.
         """
         
-        if not isinstance(event, TickEvent):
-            # print the event (unless it is TickEvent)
-            print(str(event))
+        if self.profiler and self.profiler.enabled:
+            self.dispatchProfiled(event)
+            return
+        dead = False
+        for ref in self.getHandlers(type(event)):
+            handler = ref()
+            if handler is None:
+                dead = True
+            else:
+                handler(event)
+        if dead:
+            self.removeDeadHandlers()
         for listener in self.listeners.keys():
-            listener.notify(event)
\ No newline at end of file
+            listener.notify(event)
+
+
+    def dispatchProfiled(self, event):
+        """
+        dispatch() that records the time of each handler and listener
+        as 'notify <Class.method> <EventClass>' in the profiler.
+        """
+        
+        eventName = type(event).__name__
+        record = self.profiler.record
+        dead = False
+        for ref in self.getHandlers(type(event)):
+            handler = ref()
+            if handler is None:
+                dead = True
+                continue
+            start = perf_counter()
+            handler(event)
+            record('notify %s %s' % (handlerName(handler), eventName), perf_counter() - start)
+        if dead:
+            self.removeDeadHandlers()
+        for listener in self.listeners.keys():
+            start = perf_counter()
+            listener.notify(event)
+            record('notify %s.notify %s' % (type(listener).__name__, eventName), perf_counter() - start)
+
+
+def handlerName(handler):
+    """
+    Returns 'Class.method' for a bound method, or the function's name.
+    """
+    
+    if isinstance(handler, MethodType):
+        return '%s.%s' % (type(handler.__self__).__name__, handler.__func__.__name__)
+    return getattr(handler, '__qualname__', repr(handler))
+
+
+def makeHandlerRef(handler):
+    """
+    Returns a callable that returns handler, or None once a bound method's object is gone.
+    """
+    
+    if isinstance(handler, MethodType):
+        return WeakMethod(handler)
+    return lambda: handler
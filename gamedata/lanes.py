@@ -0,0 +1,59 @@
+"""
+Packed lanes: a row of small numbers held in one big int, so the whole row is
+added, scaled or or-ed by a single int operation instead of number by number.
+
+pack() turns bytes into an int with a 16 bit lane per byte, first byte highest.
+Lanes only carry into each other past 65535, so up to 257 packed rows of bytes
+can be added, or a row scaled by up to 257, before the lanes are read back with
+unpack() (their low bytes) or unpackWords() (the whole lanes).
+orBytes() uses 8 bit lanes, for joining bytes whose set bits never overlap.
+"""
+import sys
+from array import array
+
+
+def pack(data):
+    """
+    Returns an int with one 16 bit lane per byte of data, first byte highest.
+    """
+    lanes = bytearray(2 * len(data))
+    lanes[1::2] = data
+    return int.from_bytes(lanes, 'big')
+
+
+def unpack(packed, count):
+    """
+    Returns the low byte of each of the count lanes of a pack() int.
+    """
+    return packed.to_bytes(2 * count, 'big')[1::2]
+
+
+def unpackWords(packed, count):
+    """
+    Returns an array('H') of the count lanes of a pack() int.
+    """
+    words = array('H', packed.to_bytes(2 * count, 'big'))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
+
+
+def interpolate(first, second, count, spacing):
+    """
+    Linearly interpolates two packed rows of count lanes in spacing steps, a power of two.
+    Returns a list of spacing byte strings, step i being i / spacing of the way to second.
+    """
+    shift = spacing.bit_length() - 1
+    lowBytes = pack(b'\xff' * count)
+    steps = []
+    for step in range(spacing):
+        mixed = (first * (spacing - step) + second * step) >> shift
+        steps.append(unpack(mixed & lowBytes, count))
+    return steps
+
+
+def orBytes(first, second):
+    """
+    Returns the bytes of first or-ed with the bytes of second, which has the same length.
+    """
+    return (int.from_bytes(first, 'big') | int.from_bytes(second, 'big')).to_bytes(len(first), 'big')
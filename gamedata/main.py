@@ -1,15 +1,44 @@
+import logging
+import sys
 import eventmanager
 import model
+import profiler
+import replay
+import savegame
 import view
+import yields
 import controller
 import pygame
 
-def run():
-    evManager = eventmanager.EventManager()
+def run(logLevel = logging.WARNING, profile = False, mapFileName = None, stream = False, resume = False, record = None):
+    """
+    logLevel: use logging.DEBUG to print every posted event except ticks.
+    profile (bool): time event handlers and frame parts all the time,
+    not only while the debug overlay (F3) is shown.
+    mapFileName (str): map to play on instead of classic-medium.csv.
+    stream (bool): stream mapFileName in chunks around the camera, see streaming.py.
+    resume (bool): continue the game in savegame.SAVE_FILE_NAME if there is one.
+    record (str): log the input of every tick to this file, see replay.py.
+    Resumed and streamed sessions depend on files the log does not hold.
+    """
+    logging.basicConfig(level = logLevel, format = '%(message)s')
+    gameProfiler = profiler.Profiler(pinned = profile)
+    evManager = eventmanager.EventManager(queued = True, profiler = gameProfiler)
     gamemodel = model.GameEngine(evManager)
-    keyboard = controller.Keyboard(evManager, gamemodel)
+    recorder = replay.InputRecorder(controller.PygameInput()) if record else None
+    keyboard = controller.Keyboard(evManager, gamemodel, recorder)
+    if mapFileName:
+        keyboard.loadMap(mapFileName, stream = stream)
+    if recorder:
+        recorder.start(gamemodel.seed, mapFileName)
+    economy = yields.YieldEngine(evManager, gamemodel)
+    saves = savegame.SaveManager(evManager, gamemodel, economy = economy)
+    if resume:
+        evManager.Post(eventmanager.LoadEvent())
     graphics = view.GraphicalView(evManager, gamemodel)
     gamemodel.run()
+    if recorder:
+        replay.writeLog(record, recorder.log)
 
 if __name__ == '__main__':
-    run()
+    run(profile = '--profile' in sys.argv[1:])
@@ -0,0 +1,208 @@
+"""
+Compact binary map format.
+
+A map file is a fixed header followed by one layer per map array,
+each layer being width * height unsigned bytes stored row by row:
+
+    magic     4s  b'ACMP'
+    version   H   MAP_VERSION
+    layers    H   LAYER_ flag bits of the layers that follow
+    width     I   number of tile columns
+    height    I   number of tile rows
+    terrain   width * height bytes   (LAYER_TERRAIN)
+    resources width * height bytes   (LAYER_RESOURCES)
+
+Loading maps the file with mmap, so the layers are used in place without parsing.
+Close the MappedFile once the map is no longer used: while it is mapped, another
+program shrinking the file would crash the game with SIGBUS when it reads the lost pages.
+
+Convert a CSV map from the gamedata folder with:
+
+    python mapfile.py assets/maps/classic-medium.csv assets/maps/classic-medium.map
+"""
+import csv
+import mmap
+import struct
+from array import array
+import model
+
+MAGIC = b'ACMP'
+MAP_VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+
+# layer flag bits
+LAYER_TERRAIN = 1
+LAYER_RESOURCES = 2
+
+
+class MapFileError(Exception):
+    """
+    Raised when a file is not a map file this version can read.
+    """
+    pass
+
+
+def isMapFile(fileName):
+    """
+    Returns True if fileName starts with the binary map magic.
+    """
+    with open(fileName, 'rb') as mapFile:
+        return mapFile.read(len(MAGIC)) == MAGIC
+
+
+def readCsv(csvFileName):
+    """
+    Reads a CSV map and returns (width, height, terrain) with terrain as a flat array.
+    """
+    terrain = array('B')
+    width = 0
+    height = 0
+    with open(csvFileName) as csvFile:
+        csvReader = csv.reader(csvFile, delimiter = ',')
+        for line in csvReader:
+            terrain.extend([int(tileId) for tileId in line])
+            width = len(line)
+            height += 1
+    return width, height, terrain
+
+
+def save(fileName, width, height, terrain, resources = None):
+    """
+    Writes terrain (and resources if given) to a binary map file.
+    """
+    layers = LAYER_TERRAIN
+    if resources is not None:
+        layers |= LAYER_RESOURCES
+    with open(fileName, 'wb') as mapFile:
+        mapFile.write(HEADER.pack(MAGIC, MAP_VERSION, layers, width, height))
+        mapFile.write(terrain)
+        if resources is not None:
+            mapFile.write(resources)
+
+
+def saveTileMap(fileName, tileMap):
+    """
+    Writes the terrain and resources of a TileMap to a binary map file.
+    """
+    save(fileName, tileMap.width, tileMap.height, tileMap.terrain, tileMap.resources)
+
+
+def parseHeader(data, fileName):
+    """
+    Checks the header at the start of data, read from fileName.
+    Returns (layers, width, height), raises MapFileError if this version can't read it.
+    """
+    if len(data) < HEADER.size:
+        raise MapFileError("%s is too short to be a map file" % fileName)
+    magic, version, layers, width, height = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise MapFileError("%s is not a map file" % fileName)
+    if version != MAP_VERSION:
+        raise MapFileError("%s has map version %d, expected %d" % (fileName, version, MAP_VERSION))
+    return layers, width, height
+
+
+class MappedFile(object):
+    """
+    A binary map file mapped into memory by load(), until close() unmaps it.
+    Can be used as a context manager that closes it.
+    """
+
+    def __init__ (self, mapped, width, height, terrain, resources):
+        """
+        Attributes:
+        width (int): number of tile columns.
+        height (int): number of tile rows.
+        terrain (memoryview): tileId of each tile.
+        resources (memoryview): recId of each tile, None if the file has no resource layer.
+        The layers are writable views of a private copy-on-write mapping,
+        changing them never changes the file.
+        """
+        self.mapped = mapped
+        self.width = width
+        self.height = height
+        self.terrain = terrain
+        self.resources = resources
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        """
+        Releases the layers and unmaps the file. Slices of the layers that are
+        still used keep the mapping until they are gone.
+        """
+        if self.mapped is None:
+            return
+        self.terrain.release()
+        if self.resources is not None:
+            self.resources.release()
+        try:
+            self.mapped.close()
+        except BufferError:
+            pass
+        self.mapped = None
+
+
+def load(fileName):
+    """
+    Maps a binary map file into memory. Returns a MappedFile.
+    """
+    with open(fileName, 'rb') as mapFile:
+        mapped = mmap.mmap(mapFile.fileno(), 0, access = mmap.ACCESS_COPY)
+    try:
+        layers, width, height = parseHeader(mapped, fileName)
+        count = width * height
+        layerCount = bin(layers).count('1')
+        if len(mapped) < HEADER.size + count * layerCount:
+            raise MapFileError("%s is truncated" % fileName)
+    except MapFileError:
+        mapped.close()
+        raise
+    view = memoryview(mapped)
+    offset = HEADER.size
+    terrain = view[offset:offset + count]
+    offset += count
+    resources = None
+    if layers & LAYER_RESOURCES:
+        resources = view[offset:offset + count]
+    view.release()
+    return MappedFile(mapped, width, height, terrain, resources)
+
+
+def create(fileName, width, height):
+    """
+    Creates a zero filled map file with terrain and resource layers and maps it for writing.
+    Returns (mapped, terrain, resources) where the layers are memoryviews of the mmap,
+    release them before closing mapped.
+    """
+    count = width * height
+    with open(fileName, 'w+b') as mapFile:
+        mapFile.write(HEADER.pack(MAGIC, MAP_VERSION, LAYER_TERRAIN | LAYER_RESOURCES, width, height))
+        mapFile.truncate(HEADER.size + 2 * count)
+        mapped = mmap.mmap(mapFile.fileno(), 0, access = mmap.ACCESS_WRITE)
+    view = memoryview(mapped)
+    terrain = view[HEADER.size:HEADER.size + count]
+    resources = view[HEADER.size + count:HEADER.size + 2 * count]
+    view.release()
+    return mapped, terrain, resources
+
+
+def convertCsv(csvFileName, mapFileName):
+    """
+    Converts a CSV map to a binary map file with only a terrain layer,
+    so resources are still generated when it is loaded.
+    """
+    width, height, terrain = readCsv(csvFileName)
+    save(mapFileName, width, height, terrain)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        print("usage: python mapfile.py <map.csv> <map.map>")
+        sys.exit(1)
+    convertCsv(sys.argv[1], sys.argv[2])
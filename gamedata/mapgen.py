@@ -0,0 +1,425 @@
+"""
+Map generation: procedural terrain and resources for a terrain grid.
+
+Terrain comes from two noise fields, elevation and moisture, mapped to terrain types
+by BIOME_TABLE. The world is generated in square chunks that can be made in any order
+by any process: every random number is hashed from the seed and the global position
+it belongs to, so neighbouring chunks always meet seamlessly.
+
+Generate a map file from the gamedata folder with:
+
+    python mapgen.py assets/maps/generated.map 4096 4096 [seed]
+"""
+import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import blake2b
+from random import Random, randrange
+import lanes
+import mapfile
+import model
+
+# Chance of each resource per terrain type. Terrain types not listed get no resources.
+# Each entry is a tuple of (recId, probability) pairs, their sum must be at most 1.
+RESOURCE_DISTRIBUTIONS = {
+    model.GRASSLAND: ((model.WHEAT, 0.0275), (model.MOUNTAIN, 0.0025)),
+    model.PLAINS: ((model.WHEAT, 0.20), ),
+    model.TUNDRA: ((model.MOUNTAIN, 0.15), ),
+}
+
+# random draws are 16 bit numbers, probabilities are scaled to this range
+DRAW_RANGE = 1 << 16
+
+
+def buildThresholdTable(distributions):
+    """
+    Turns distributions into a list indexed by tileId.
+    Each item is None or a tuple of (cumulative draw limit, recId) pairs.
+    """
+    table = [None] * 256
+    for tileId, chances in distributions.items():
+        limit = 0.0
+        thresholds = []
+        for recId, probability in chances:
+            limit += probability
+            thresholds.append((int(round(limit * DRAW_RANGE)), recId))
+        table[tileId] = tuple(thresholds)
+    return table
+
+
+def randomDraws(seed, count):
+    """
+    Returns an array of count random 16 bit numbers made from seed.
+    """
+    draws = array('H')
+    draws.frombytes(Random(seed).randbytes(count * draws.itemsize))
+    if sys.byteorder != 'little':
+        # keep the same draws for a seed on every platform
+        draws.byteswap()
+    return draws
+
+
+def generateResources(terrain, seed = None, distributions = RESOURCE_DISTRIBUTIONS):
+    """
+    Returns an array with a generated resource recId (or 0 for none) for each tileId in terrain.
+    All random numbers are drawn in one batch from seed, one per tile,
+    so the same seed and terrain always give the same resources
+    and a tile's resource only depends on its own terrain.
+    """
+    return placeResources(terrain, randomDraws(seed, len(terrain)), buildThresholdTable(distributions))
+
+
+def pickResource(thresholds, draw):
+    """
+    Returns the recId of the first of thresholds that draw is under, 0 if none.
+    """
+    for limit, recId in thresholds:
+        if draw < limit:
+            return recId
+    return 0
+
+
+def buildPlacementTables(table):
+    """
+    Returns the bytes.translate() tables placeResources() uses for a
+    buildThresholdTable() table, or None if it has too many terrain classes or limits.
+
+    Each tile is keyed by one byte, class << 4 | code:
+
+        class  bits 7-4  0 for tileIds without thresholds, else 1 + the tileId's
+                         place among the tileIds with thresholds (at most 15)
+        code   bits 3-0  where the high byte of the tile's draw falls among the
+                         sorted high bytes of every limit below DRAW_RANGE (at most 7):
+                         2 * the number of them below it, plus 1 if it equals one
+
+    With limits 0x0710 and 0x3300 the codes of draw high bytes 0x00-0x06, 0x07,
+    0x08-0x32, 0x33 and 0x34-0xff are 0, 1, 2, 3 and 4. An even code puts the draw
+    strictly between two limit high bytes, so the key alone decides the resource.
+    An odd code is ambiguous when the equal high byte is one of the tile's own limits,
+    the low byte of the draw then decides and the tile is picked one by one.
+    Returns (classTable, codeTable, recIdTable, ambiguousTable): tileId to class << 4,
+    draw high byte to code, key to recId, and key to 1 if it is ambiguous.
+    """
+    tileIds = [tileId for tileId, thresholds in enumerate(table) if thresholds]
+    highs = sorted(set(limit >> 8 for tileId in tileIds for limit, recId in table[tileId] if limit < DRAW_RANGE))
+    if len(tileIds) > 15 or len(highs) > 7:
+        return None
+    classTable = bytearray(256)
+    for tileClass, tileId in enumerate(tileIds, 1):
+        classTable[tileId] = tileClass << 4
+    codeTable = bytearray(256)
+    for high in range(256):
+        below = sum(1 for value in highs if value < high)
+        codeTable[high] = 2 * below + 1 if high in highs else 2 * below
+    recIdTable = bytearray(256)
+    ambiguousTable = bytearray(256)
+    for tileClass, tileId in enumerate(tileIds, 1):
+        for code in range(2 * len(highs) + 1):
+            position = code // 2
+            for limit, recId in table[tileId]:
+                if limit >= DRAW_RANGE:
+                    under = True
+                else:
+                    index = highs.index(limit >> 8)
+                    if code % 2 and index == position:
+                        ambiguousTable[tileClass << 4 | code] = 1
+                        break
+                    under = index >= position + code % 2
+                if under:
+                    recIdTable[tileClass << 4 | code] = recId
+                    break
+    return bytes(classTable), bytes(codeTable), bytes(recIdTable), bytes(ambiguousTable)
+
+
+# tiles placeResources() works on at once
+PLACE_BAND = 1 << 20
+
+
+def placeResources(terrain, draws, table):
+    """
+    Returns an array with the resource recId (or 0 for none) picked for each tile in terrain
+    by its draw in draws and the thresholds for its tileId in table.
+    Tiles are not visited one by one: a band of tiles at a time, each tile's key (see
+    buildPlacementTables) is made from its terrain and the high byte of its draw with
+    two bytes.translate() and lanes.orBytes(), and turned into its recId by another.
+    Only tiles whose draw is too close to a limit to tell from its high byte are picked
+    one by one, about one in a hundred.
+    """
+    tables = buildPlacementTables(table)
+    resources = array('B')
+    for start in range(0, len(terrain), PLACE_BAND):
+        band = bytes(terrain[start:start + PLACE_BAND])
+        count = len(band)
+        if tables is None:
+            resources.extend(pickResource(table[tileId], draws[start + index]) if table[tileId] else 0
+                for index, tileId in enumerate(band))
+            continue
+        classTable, codeTable, recIdTable, ambiguousTable = tables
+        high = draws[start:start + count].tobytes()[1 if sys.byteorder == 'little' else 0::2]
+        keys = lanes.orBytes(band.translate(classTable), high.translate(codeTable))
+        placed = bytearray(keys.translate(recIdTable))
+        ambiguous = keys.translate(ambiguousTable)
+        index = ambiguous.find(1)
+        while index >= 0:
+            placed[index] = pickResource(table[band[index]], draws[start + index])
+            index = ambiguous.find(1, index + 1)
+        resources.frombytes(placed)
+    return resources
+
+
+# NOISE
+# Each octave is (lattice spacing in tiles, amplitude), the amplitudes add up to 255.
+# Spacings are powers of two up to 256, and chunk sizes are a multiple of the largest.
+NOISE_OCTAVES = ((128, 140), (32, 75), (8, 40))
+CHUNK_SIZE = 256
+
+# hash layers, so every kind of random number gets its own stream
+LAYER_ELEVATION = 0
+LAYER_MOISTURE = 1
+LAYER_RESOURCES = 2
+
+# one hash gives this many random bytes
+HASH_BLOCK = 64
+
+
+def hashedBytes(seed, layer, row, firstCol, count):
+    """
+    Returns count random bytes for the columns from firstCol on one row of a layer.
+    Bytes are hashed from seed, layer, row and column block only,
+    so the same column always gets the same byte whatever range it was asked with.
+    """
+    firstBlock = firstCol // HASH_BLOCK
+    lastBlock = (firstCol + count - 1) // HASH_BLOCK
+    data = b''.join(blake2b(b'%d:%d:%d:%d' % (seed, layer, row, block), digest_size = HASH_BLOCK).digest()
+                    for block in range(firstBlock, lastBlock + 1))
+    start = firstCol - firstBlock * HASH_BLOCK
+    return data[start:start + count]
+
+
+def noiseOctave(seed, layer, firstCol, firstRow, size, spacing, amplitude):
+    """
+    Returns size * size bytes of value noise from 0 to amplitude for the square
+    of tiles at (firstCol, firstRow), row by row. Values are random on a lattice
+    every spacing tiles and linearly interpolated between, firstCol and firstRow
+    must be on the lattice.
+    """
+    points = size // spacing
+    scale = bytes(value * amplitude // 255 for value in range(256))
+    latticeCol = firstCol // spacing
+    latticeRow = firstRow // spacing
+    lattice = [hashedBytes(seed, layer * 256 + spacing, latticeRow + row, latticeCol, points + 1).translate(scale)
+               for row in range(points + 1)]
+    # across: every lattice row at once, step i fills every spacing-th column from i
+    left = lanes.pack(b''.join(row[:-1] for row in lattice))
+    right = lanes.pack(b''.join(row[1:] for row in lattice))
+    rows = bytearray(size * (points + 1))
+    for step, values in enumerate(lanes.interpolate(left, right, points * (points + 1), spacing)):
+        rows[step::spacing] = values
+    # down: step i of every pair of lattice rows is tile row lattice row * spacing + i
+    top = lanes.pack(rows[:size * points])
+    bottom = lanes.pack(rows[size:])
+    noise = bytearray(size * size)
+    for step, values in enumerate(lanes.interpolate(top, bottom, size * points, spacing)):
+        for point in range(points):
+            row = point * spacing + step
+            noise[row * size:(row + 1) * size] = values[point * size:(point + 1) * size]
+    return noise
+
+
+def noiseField(seed, layer, firstCol, firstRow, size, octaves = NOISE_OCTAVES):
+    """
+    Returns size * size bytes of the sum of the noise octaves for a square of tiles.
+    """
+    total = 0
+    for spacing, amplitude in octaves:
+        total += lanes.pack(noiseOctave(seed, layer, firstCol, firstRow, size, spacing, amplitude))
+    return lanes.unpack(total, size * size)
+
+
+# TERRAIN
+# Elevation and moisture are cut to 16 levels each, BIOME_TABLE is indexed by
+# elevation level * 16 + moisture level.
+SEA_LEVEL = 8
+
+
+def biomeFor(elevation, moisture):
+    """
+    Returns the terrain tileId for an elevation and a moisture level, both 0 to 15.
+    """
+    if elevation < SEA_LEVEL:
+        return model.OCEAN
+    if elevation >= SEA_LEVEL + 3:
+        return model.SNOW if elevation >= SEA_LEVEL + 4 or moisture >= 8 else model.GRAVEL
+    if elevation == SEA_LEVEL + 2:
+        return model.TUNDRA if moisture >= 6 else model.GRAVEL
+    if moisture < 5:
+        return model.DESERT
+    if moisture < 7:
+        return model.PLAINS
+    if moisture < 11:
+        return model.GRASSLAND
+    return model.LAKE
+
+BIOME_TABLE = bytes(biomeFor(level >> 4, level & 15) for level in range(256))
+HIGH_LEVEL = bytes(value & 0xf0 for value in range(256))
+LOW_LEVEL = bytes(value >> 4 for value in range(256))
+
+
+def generateChunk(seed, chunkCol, chunkRow, chunkSize = CHUNK_SIZE, distributions = RESOURCE_DISTRIBUTIONS):
+    """
+    Generates one chunkSize square of the world.
+    Returns (terrain, resources) as chunkSize * chunkSize bytes each, row by row.
+    """
+    firstCol = chunkCol * chunkSize
+    firstRow = chunkRow * chunkSize
+    elevation = noiseField(seed, LAYER_ELEVATION, firstCol, firstRow, chunkSize).translate(HIGH_LEVEL)
+    moisture = noiseField(seed, LAYER_MOISTURE, firstCol, firstRow, chunkSize).translate(LOW_LEVEL)
+    # the levels use separate nibbles, so or-ing them as packed lanes joins every byte at once
+    levels = lanes.orBytes(elevation, moisture)
+    terrain = levels.translate(BIOME_TABLE)
+    draws = array('H')
+    for row in range(firstRow, firstRow + chunkSize):
+        draws.frombytes(hashedBytes(seed, LAYER_RESOURCES, row, 2 * firstCol, 2 * chunkSize))
+    if sys.byteorder != 'little':
+        draws.byteswap()
+    resources = placeResources(terrain, draws, buildThresholdTable(distributions))
+    return terrain, resources.tobytes()
+
+
+def generateChunkJob(job):
+    """
+    generateChunk() for a (seed, chunkCol, chunkRow, chunkSize) tuple, as sent to worker processes.
+    Returns (chunkCol, chunkRow, terrain, resources).
+    """
+    seed, chunkCol, chunkRow, chunkSize = job
+    return (chunkCol, chunkRow) + generateChunk(seed, chunkCol, chunkRow, chunkSize)
+
+
+# the pool of worker processes generateInto() uses and its size, kept between calls
+# so the processes only start and import once
+workerPool = None
+poolWorkers = 0
+
+
+def getWorkerPool(workers):
+    """
+    Returns a pool of workers processes, the one of the last call if it was the same size.
+    """
+    global workerPool, poolWorkers
+    if workerPool is None or poolWorkers != workers:
+        shutdownWorkerPool()
+        workerPool = ProcessPoolExecutor(max_workers = workers)
+        poolWorkers = workers
+    return workerPool
+
+
+def shutdownWorkerPool():
+    """
+    Stops the worker processes, if there are any. The next getWorkerPool() starts new ones.
+    """
+    global workerPool, poolWorkers
+    if workerPool is not None:
+        workerPool.shutdown()
+        workerPool = None
+        poolWorkers = 0
+
+
+def generateInto(terrain, resources, width, height, seed, chunkSize = CHUNK_SIZE, workers = None):
+    """
+    Generates a width by height world into the writable byte buffers terrain and resources.
+    Chunks are made by a pool of workers processes (all CPUs if None), kept for
+    the next call, or in this process if workers is 1.
+    """
+    largestSpacing = max(spacing for spacing, amplitude in NOISE_OCTAVES)
+    if chunkSize % largestSpacing:
+        raise ValueError("chunkSize must be a multiple of %d" % largestSpacing)
+    terrain = memoryview(terrain)
+    resources = memoryview(resources)
+    jobs = [(seed, chunkCol, chunkRow, chunkSize)
+            for chunkRow in range(-(-height // chunkSize))
+            for chunkCol in range(-(-width // chunkSize))]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(jobs) > 1:
+        results = getWorkerPool(workers).map(generateChunkJob, jobs, chunksize = max(1, len(jobs) // (workers * 4)))
+    else:
+        results = map(generateChunkJob, jobs)
+    try:
+        for chunkCol, chunkRow, chunkTerrain, chunkResources in results:
+            # clip chunks at the right and bottom edges of the map
+            firstCol = chunkCol * chunkSize
+            firstRow = chunkRow * chunkSize
+            cols = min(chunkSize, width - firstCol)
+            for row in range(min(chunkSize, height - firstRow)):
+                start = (firstRow + row) * width + firstCol
+                terrain[start:start + cols] = chunkTerrain[row * chunkSize:row * chunkSize + cols]
+                resources[start:start + cols] = chunkResources[row * chunkSize:row * chunkSize + cols]
+    except BrokenProcessPool:
+        # a worker died, the next call starts a new pool
+        shutdownWorkerPool()
+        raise
+    finally:
+        terrain.release()
+        resources.release()
+
+
+def generateTileMap(width, height, seed = None, chunkSize = CHUNK_SIZE, workers = None, tileSize = 32):
+    """
+    Returns (tileMap, seed) for a newly generated world.
+    A random seed is picked if it is None.
+    """
+    if seed is None:
+        seed = randrange(1 << 32)
+    terrain = array('B', bytes(width * height))
+    resources = array('B', bytes(width * height))
+    generateInto(terrain, resources, width, height, seed, chunkSize, workers)
+    return model.TileMap(width, height, terrain, resources, tileSize), seed
+
+
+def loadTileMap(mapFileName, seed = None, tileSize = 32):
+    """
+    Returns (tileMap, seed) for a binary map file or a CSV file.
+    The format is detected from the file contents.
+    Resources are generated from seed if the file has none, a random seed
+    is picked if it is None. The seed is returned as given if the file had resources.
+    """
+    mapped = None
+    if mapfile.isMapFile(mapFileName):
+        mapped = mapfile.load(mapFileName)
+        width, height, terrain, resources = mapped.width, mapped.height, mapped.terrain, mapped.resources
+    else:
+        width, height, terrain = mapfile.readCsv(mapFileName)
+        resources = None
+    if resources is None:
+        if seed is None:
+            seed = randrange(1 << 32)
+        resources = generateResources(terrain, seed)
+    return model.TileMap(width, height, terrain, resources, tileSize, mapped), seed
+
+
+def generateMapFile(fileName, width, height, seed = None, chunkSize = CHUNK_SIZE, workers = None):
+    """
+    Generates a world straight into a binary map file, without holding it in memory.
+    Returns the seed, a random one is picked if it is None.
+    """
+    if seed is None:
+        seed = randrange(1 << 32)
+    mapped, terrain, resources = mapfile.create(fileName, width, height)
+    try:
+        generateInto(terrain, resources, width, height, seed, chunkSize, workers)
+    finally:
+        terrain.release()
+        resources.release()
+        mapped.close()
+    return seed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5):
+        print("usage: python mapgen.py <map.map> <width> <height> [seed]")
+        sys.exit(1)
+    seed = int(sys.argv[4]) if len(sys.argv) == 5 else None
+    seed = generateMapFile(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), seed)
+    print("generated %s with seed %d" % (sys.argv[1], seed))
@@ -1,60 +1,202 @@
 import pygame
+import time
+import ecs
+from array import array
 from eventmanager import *
-pygame.font.init()
 
 class GameEngine(object):
     """
     Tracks the game state.
     """
 
-    def __init__(self, evManager):
+    def __init__(self, evManager, tickRate = 30, renderRate = 60):
         """
         evManager (EventManager): Allows posting messages to the event queue.
+        tickRate (int): simulation ticks per second.
+        renderRate (int): most frames rendered per second, 0 for no limit.
         
         Attributes:
         running (bool): True while the engine is online. Changed via QuitEvent().
+        scheduler (Scheduler): decides when to tick and when to render.
         """
 
         self.evManager = evManager
-        evManager.RegisterListener(self)
+        # subscribed first so the camera is saved before anything moves it
+        evManager.Subscribe(TickEvent, self.onTick)
+        evManager.Subscribe(QuitEvent, self.onQuit)
+        evManager.Subscribe(StateChangeEvent, self.onStateChange)
         self.running = False
+        self.scheduler = Scheduler(tickRate, renderRate)
         self.state = StateMachine()
         self.mainMenu = MainMenu()
         # tileMap will be loaded once game starts
         self.tileMap = None
+        # seed the map's resources were generated from, None if they were loaded
+        self.seed = None
         # camera offsets will offset all game objects
         self.camera = Camera(posx = 4500, posy = 600)
-    def notify(self, event):
+        # the tile under the mouse
+        self.tileHover = TileHover()
+        # show profiler stats over the menu and play screens
+        self.showDebugOverlay = False
+        # overview of the map on the play screen
+        self.minimap = Minimap()
+        # structures and units on the map
+        self.entities = ecs.EntityStore()
+
+    def onTick(self, event):
+        """
+        Called for each simulation tick, before the controller handles input.
+        """
+
+        # remember where the camera was so renders can interpolate from there
+        self.camera.savePosition()
+        if self.tileMap is not None:
+            self.tileMap.streamAround(self.camera.rect)
+
+    def onQuit(self, event):
+        """
+        Called by a QuitEvent in the message queue. Stops the engine loop.
+        """
+
+        self.running = False
+
+    def onStateChange(self, event):
+        """
+        Called by a StateChangeEvent in the message queue.
+        """
+
+        # pop request
+        if not event.state:
+            # false if no more states are left
+            if not self.state.pop():
+                self.evManager.Post(QuitEvent())
+        else:
+            # push a new state on the stack
+            self.state.push(event.state)
+
+    def changeTile(self, col, row, tileId = None, recId = None):
         """
-        Called by an event in the message queue. 
+        Changes the terrain and/or resource of the tile at (col, row).
+        recId 0 removes the resource, None leaves it as is.
+        Posts a TileChangeEvent so cached drawings of the tile are refreshed.
         """
+        tile = self.tileMap.getTile(col, row)
+        if not tile:
+            return
+        if tileId is not None:
+            tile.tileId = tileId
+        if recId is not None:
+            tile.resource = Resource(tile, recId) if recId else None
+        self.evManager.Post(TileChangeEvent([(col, row)]))
 
-        if isinstance(event, QuitEvent):
-            self.running = False
-        if isinstance(event, StateChangeEvent):
-            # pop request
-            if not event.state:
-                # false if no more states are left
-                if not self.state.pop():
-                    self.evManager.Post(QuitEvent())
-            else:
-                # push a new state on the stack
-                self.state.push(event.state)
+    def setTileMap(self, tileMap, seed = None):
+        """
+        Replaces the map, closing the old one.
+        Its entities and hovered tile go with it.
+        """
+        if self.tileMap is not None:
+            self.tileMap.close()
+        self.entities.clear()
+        self.tileHover = TileHover()
+        self.tileMap = tileMap
+        self.seed = seed
 
     def run(self):
         """
         Starts the game engine loop.
-        This pumps a Tick event into the message queue for each loop.
-        The loop ends when this object hears a QuitEvent in notify(). 
+        The scheduler decides how many Tick events to pump into the message queue
+        and whether to post a Render event on each loop. The loop sleeps
+        until the next of them is due. Each Pump() handles at most PUMP_LIMIT events.
+        The loop ends when this object hears a QuitEvent in onQuit(). 
         """
         self.running = True
         self.evManager.Post(InitializeEvent())
-        self.state.push(STATE_MENU)
+        self.evManager.Pump(PUMP_LIMIT)
+        # a resumed game already has the states it was saved with
+        if not self.state.peek():
+            self.state.push(STATE_MENU)
+        self.scheduler.start(time.perf_counter())
         while self.running:
-            newTick = TickEvent()
-            self.evManager.Post(newTick)
+            ticks, render = self.scheduler.advance(time.perf_counter())
+            for i in range(ticks):
+                if not self.running:
+                    break
+                self.evManager.Post(TickEvent())
+                # in queued mode, handle the tick and everything it caused
+                self.evManager.Pump(PUMP_LIMIT)
+            if render and self.running:
+                self.evManager.Post(RenderEvent(self.scheduler.interpolation()))
+                self.evManager.Pump(PUMP_LIMIT)
+            idle = self.scheduler.timeUntilDue(time.perf_counter())
+            if idle > 0:
+                time.sleep(idle)
+        # closed once every QuitEvent handler has run, so they can still use it
+        if self.tileMap is not None:
+            self.tileMap.close()
+
+
+class Scheduler(object):
+    """
+    Fixed timestep scheduler.
+    The simulation advances in ticks of exactly 1 / tickRate seconds, however long
+    frames take, while frames are rendered at most renderRate times per second.
+    After a stall the missed ticks are caught up, up to maxCatchUp at once.
+    """
+
+    def __init__(self, tickRate = 30, renderRate = 60, maxCatchUp = 10):
+        self.tickTime = 1.0 / tickRate
+        self.renderTime = 1.0 / renderRate if renderRate else 0.0
+        self.maxCatchUp = maxCatchUp
+        # simulation time not yet covered by ticks
+        self.accumulator = 0.0
+        self.lastTime = None
+        self.nextRender = 0.0
+
+    def start(self, now):
+        """
+        Starts counting time from now.
+        """
+        self.lastTime = now
+        self.accumulator = 0.0
+        self.nextRender = now
+
+    def advance(self, now):
+        """
+        Moves the clock to now.
+        Returns (ticks, render): the number of ticks due and whether a frame is due.
+        """
+        self.accumulator += now - self.lastTime
+        self.lastTime = now
+        ticks = int(self.accumulator / self.tickTime)
+        if ticks > self.maxCatchUp:
+            # too far behind, drop the time we can not catch up
+            ticks = self.maxCatchUp
+            self.accumulator = ticks * self.tickTime
+        self.accumulator -= ticks * self.tickTime
+        render = now >= self.nextRender
+        if render:
+            # schedule from the previous deadline to keep a steady rate
+            self.nextRender = max(self.nextRender + self.renderTime, now - self.renderTime)
+        return ticks, render
+
+    def interpolation(self):
+        """
+        Returns how far the clock is between the last tick and the next, from 0 to 1.
+        """
+        return min(1.0, self.accumulator / self.tickTime)
+
+    def timeUntilDue(self, now):
+        """
+        Returns the seconds until the next tick or frame is due.
+        """
+        nextTick = self.lastTime + self.tickTime - self.accumulator
+        return min(nextTick, self.nextRender) - now
 
 
+# owner of what the player at this keyboard claims, see yields.py
+LOCAL_PLAYER = 1
+
 # State machine constants for the StateMachine class below
 STATE_INTRO = 1
 STATE_MENU = 2
@@ -134,10 +276,11 @@ class MainMenu(object):
 class PrimButton(object):
     """
     Primitive solid rectangular button with text.
+    font is a (name, size) pair of a system font, loaded by the view's asset manager.
     """
     def __init__(self, posx, posy, width, height, 
     color = pygame.Color(255, 0, 0), hoverColor = pygame.Color(0, 255, 0),
-    text = 'Button', font = pygame.font.SysFont('arial', 20)
+    text = 'Button', font = ('arial', 20)
     ):
         self.rect = pygame.Rect(posx, posy, width, height)
         self.color = color
@@ -147,6 +290,47 @@ class PrimButton(object):
         self.stroke = True
         self.hovered = False
 
+class Minimap(object):
+    """
+    Overview of the whole map in the bottom right corner of the play screen.
+    It is fitted into maxWidth by maxHeight screen pixels keeping the map's aspect ratio.
+    """
+    def __init__(self, maxWidth = 240, maxHeight = 180, margin = 8):
+        self.maxWidth = maxWidth
+        self.maxHeight = maxHeight
+        self.margin = margin
+        self.visible = True
+
+    def getRect(self, tileMap):
+        """
+        Returns the screen rect the minimap of tileMap is drawn in.
+        """
+        scale = min(self.maxWidth / float(max(1, tileMap.width)), self.maxHeight / float(max(1, tileMap.height)))
+        width = max(1, int(tileMap.width * scale))
+        height = max(1, int(tileMap.height * scale))
+        return pygame.Rect(SCREEN_WIDTH - self.margin - width, SCREEN_HEIGHT - self.margin - height, width, height)
+
+    def screenToMap(self, pos, tileMap):
+        """
+        Returns the map pixel shown at a screen position on the minimap.
+        """
+        rect = self.getRect(tileMap)
+        return ((pos[0] - rect.x) * tileMap.width * tileMap.tileSize // rect.width,
+            (pos[1] - rect.y) * tileMap.height * tileMap.tileSize // rect.height)
+
+    def getViewRect(self, cameraRect, tileMap):
+        """
+        Returns the screen rect on the minimap that shows the map pixel rect cameraRect.
+        """
+        rect = self.getRect(tileMap)
+        mapWidth = tileMap.width * tileMap.tileSize
+        mapHeight = tileMap.height * tileMap.tileSize
+        left = rect.x + cameraRect.left * rect.width // mapWidth
+        top = rect.y + cameraRect.top * rect.height // mapHeight
+        right = rect.x + cameraRect.right * rect.width // mapWidth
+        bottom = rect.y + cameraRect.bottom * rect.height // mapHeight
+        return pygame.Rect(left, top, max(1, right - left), max(1, bottom - top))
+
 # TILES
 # constanst for terrain tileIds
 GRASSLAND = 0
@@ -162,59 +346,322 @@ TUNDRA = 7
 WHEAT = 100
 MOUNTAIN = 101
 
-terrainTextures = {
-    GRASSLAND:  pygame.image.load("assets/terrain-tiles/t_grassland_0_32.png"),
-    PLAINS: pygame.image.load("assets/terrain-tiles/t_plains_1_32.png"),
-    DESERT:  pygame.image.load("assets/terrain-tiles/t_desert_2_32.png"),
-    GRAVEL:  pygame.image.load("assets/terrain-tiles/t_gravel_3_32.png"),
-    SNOW:  pygame.image.load("assets/terrain-tiles/t_snow_4_32.png"),
-    LAKE:  pygame.image.load("assets/terrain-tiles/t_lake_5_32.png"),
-    OCEAN:  pygame.image.load("assets/terrain-tiles/t_ocean_6_32.png"),
-    TUNDRA:  pygame.image.load("assets/terrain-tiles/t_tundra_7_32.png")
+# texture files, loaded by assets.AssetManager once the display is up
+terrainTextureFiles = {
+    GRASSLAND:  "assets/terrain-tiles/t_grassland_0_32.png",
+    PLAINS: "assets/terrain-tiles/t_plains_1_32.png",
+    DESERT:  "assets/terrain-tiles/t_desert_2_32.png",
+    GRAVEL:  "assets/terrain-tiles/t_gravel_3_32.png",
+    SNOW:  "assets/terrain-tiles/t_snow_4_32.png",
+    LAKE:  "assets/terrain-tiles/t_lake_5_32.png",
+    OCEAN:  "assets/terrain-tiles/t_ocean_6_32.png",
+    TUNDRA:  "assets/terrain-tiles/t_tundra_7_32.png"
 }
+# drawn for tileIds without a texture
+errorTextureFile = "assets/terrain-tiles/t_error.png"
 
-resourceTextures = {
-    WHEAT: pygame.image.load("assets/resources/r_wheat_100_32.png"),
-    MOUNTAIN: pygame.image.load("assets/resources/r_mountain_101_32.png")
+resourceTextureFiles = {
+    WHEAT: "assets/resources/r_wheat_100_32.png",
+    MOUNTAIN: "assets/resources/r_mountain_101_32.png"
 }
 
-guiImages = {
-    'TITLE_TEXT': pygame.image.load("assets/gui/title-text.png")
+guiImageFiles = {
+    'TITLE_TEXT': "assets/gui/title-text.png"
 }
 
+# flag bits stored in TileMap.flags
+FLAG_HOVERED = 1
+
 class TileMap(object):
-    def __init__ (self, tileIds = [], tiles = []):
-        self.tileIds = tileIds
-        self.tiles = tiles
-        self.tilesOnScreen = []
+    def __init__ (self, width = 0, height = 0, terrain = None, resources = None, tileSize = 32, mapping = None):
+        """
+        Holds every tile of the map as typed arrays, stored row by row.
+        A tile is the index row * width + col into each array,
+        Tile objects are only light views made on demand by getTile().
+        mapping (MappedFile): the mapfile.load() result the layers are views of,
+        closed with the map.
 
-class Tile(object):
-    def __init__ (self, tileId = 0, posx = 0, posy = 0, size = 32, resource = None):
+        Attributes:
+        width (int): number of tile columns.
+        height (int): number of tile rows.
+        terrain (array): tileId of each tile.
+        resources (array): recId of each tile's resource, 0 if it has none.
+        flags (array): FLAG_ bits of each tile.
+        """
+        count = width * height
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+        self.terrain = terrain if terrain is not None else array('B', bytes(count))
+        self.resources = resources if resources is not None else array('B', bytes(count))
+        self.flags = array('B', bytes(count))
+        self.mapping = mapping
+
+    def __len__(self):
+        return self.width * self.height
+
+    def __iter__(self):
         """
-        Represents a single tile of terrain.
-        TODO structure: Structure object
+        Iterates over every tile, row by row.
         """
-        self.hovered = False
-        self.tileId = tileId
-        self.rect = pygame.Rect(posx, posy, size, size)
-        self.size = size
-        self.resource = resource
-        if id == GRASSLAND:
-            self.name = "grassland"
-        elif id == PLAINS:
-            self.name = "plains"
-        elif id == DESERT:
-            self.name = "desert" 
+        for index in range(len(self)):
+            yield Tile(self, index)
+
+    def getTile(self, col, row):
+        """
+        Returns the Tile at a column and row, or None if it is off the map.
+        """
+        if 0 <= col < self.width and 0 <= row < self.height:
+            return Tile(self, row * self.width + col)
+        return None
+    def getTileAt(self, x, y):
+        """
+        Returns the Tile under the map pixel (x, y), or None if it is off the map.
+        """
+        return self.getTile(x // self.tileSize, y // self.tileSize)
+
+    def getTileRange(self, rect):
+        """
+        Returns the (firstCol, firstRow, endCol, endRow) range of tiles inside rect.
+        The end values are exclusive and everything is clamped to the map.
+        A tile counts as inside when its bottom right corner is, which matches
+        the offset used to fix the visual glitch at the screen edges.
+        """
+        size = self.tileSize
+        # ceil division on negative numbers: -(-a // b)
+        firstCol = max(0, -(-rect.left // size) - 1)
+        firstRow = max(0, -(-rect.top // size) - 1)
+        endCol = max(firstCol, min(self.width, -(-rect.right // size) - 1))
+        endRow = max(firstRow, min(self.height, -(-rect.bottom // size) - 1))
+        return firstCol, firstRow, endCol, endRow
+
+    def streamAround(self, cameraRect):
+        """
+        Called every tick with the camera rect, so maps that load tiles as
+        the camera moves can do so. A plain TileMap holds every tile already.
+        """
+        pass
+
+    def popLoadedRanges(self):
+        """
+        Returns the (firstCol, firstRow, endCol, endRow) tile ranges that came into
+        memory since the last call, or None if every tile always is, as in a plain TileMap.
+        """
+        return None
+
+    def copyLayers(self):
+        """
+        Returns the terrain and then the resource layer as an iterable of bytes pieces.
+        The tiles are copied now, so the pieces can be read later on another thread.
+        """
+        count = len(self)
+        return [bytes(self.terrain[0:count]), bytes(self.resources[0:count])]
+
+    def readLayers(self):
+        """
+        Yields the terrain and then the resource layer in bands of 64 rows, each
+        copied when it is reached, so another thread can read them without the whole
+        map being copied up front. Tiles changed meanwhile may show their newer values.
+        """
+        count = len(self)
+        bandSize = 64 * self.width
+        for layer in (self.terrain, self.resources):
+            for start in range(0, count, bandSize):
+                yield bytes(layer[start:min(count, start + bandSize)])
+
+    def close(self):
+        """
+        Called when the map is no longer used. Unmaps the map file it was loaded from.
+        """
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+class TileHover(object):
+    def __init__ (self):
+        """
+        Tracks which Tile the mouse is over.
+        Only the tile that lost the hover and the tile that gained it are touched,
+        and both are remembered in changedTiles until the view redraws them.
+
+        Attributes:
+        tile (Tile): the hovered tile, None when the mouse is off the map.
+        changedTiles (list): tiles whose hovered flag changed since popChangedTiles().
+        """
+        self.tile = None
+        self.changedTiles = []
+
+    def update(self, tileMap, x, y):
+        """
+        Hovers the tile under the map pixel (x, y).
+        Returns True if the hovered tile changed.
+        """
+        tile = tileMap.getTileAt(x, y)
+        if tile == self.tile:
+            return False
+        if self.tile:
+            self.tile.hovered = False
+            self.changedTiles.append(self.tile)
+        if tile:
+            tile.hovered = True
+            self.changedTiles.append(tile)
+        self.tile = tile
+        return True
+
+    def popChangedTiles(self):
+        """
+        Returns the tiles whose hovered flag changed and forgets them.
+        """
+        changedTiles = self.changedTiles
+        self.changedTiles = []
+        return changedTiles
+
+class Tile(object):
+    """
+    Represents a single tile of terrain.
+    This is a view of one index of a TileMap, reading and writing its arrays,
+    so two Tile objects of the same map and index are equal.
+    Structures and units on a tile are entities, see ecs.EntityStore.getEntitiesAt().
+    """
+    __slots__ = ('tileMap', 'index')
+
+    def __init__ (self, tileMap, index):
+        self.tileMap = tileMap
+        self.index = index
+
+    def __eq__(self, other):
+        return (isinstance(other, Tile) and other.tileMap is self.tileMap
+            and other.index == self.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tileMap), self.index))
+
+    @property
+    def col(self):
+        return self.index % self.tileMap.width
+
+    @property
+    def row(self):
+        return self.index // self.tileMap.width
+
+    @property
+    def size(self):
+        return self.tileMap.tileSize
+
+    @property
+    def rect(self):
+        size = self.tileMap.tileSize
+        return pygame.Rect(self.col * size, self.row * size, size, size)
+
+    @property
+    def tileId(self):
+        return self.tileMap.terrain[self.index]
+
+    @tileId.setter
+    def tileId(self, tileId):
+        self.tileMap.terrain[self.index] = tileId
+
+    @property
+    def resource(self):
+        recId = self.tileMap.resources[self.index]
+        return Resource(self, recId) if recId else None
+
+    @resource.setter
+    def resource(self, resource):
+        self.tileMap.resources[self.index] = resource.recId if resource else 0
+
+    @property
+    def hovered(self):
+        return bool(self.tileMap.flags[self.index] & FLAG_HOVERED)
+
+    @hovered.setter
+    def hovered(self, hovered):
+        if hovered:
+            self.tileMap.flags[self.index] |= FLAG_HOVERED
+        else:
+            self.tileMap.flags[self.index] &= ~FLAG_HOVERED
         
+# screen pixels per tile at each Camera zoom level, from nearest to farthest
+ZOOM_TILE_SIZES = (32, 16, 8, 4, 1)
+
 class Camera(object):
-    def __init__ (self, posx = 0, posy = 0, width = SCREEN_WIDTH, height = SCREEN_HEIGHT):
+    def __init__ (self, posx = 0, posy = 0, width = SCREEN_WIDTH, height = SCREEN_HEIGHT, tileSize = 32):
         """
         Represents a camera. Only objects withing the camera rect are drawn.
+        rect is in map pixels, where tiles are tileSize wide. At zoom levels
+        other than 0 tiles are drawn smaller, so rect covers more of the map.
         """
         #                                           \/ offset wh to fix screen glitch
         self.rect = pygame.Rect(posx, posy, width + 32, height + 32)
-        self.width = SCREEN_WIDTH
-        self.height = SCREEN_HEIGHT
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+        self.zoomLevel = 0
+        # position at the start of the current tick
+        self.previous = self.rect.topleft
+
+    def getTilePixels(self):
+        """
+        Returns the width of a tile on screen at the current zoom level.
+        """
+        return ZOOM_TILE_SIZES[self.zoomLevel]
+
+    def screenToMap(self, pos):
+        """
+        Returns the map pixel under a screen position.
+        """
+        tilePixels = self.getTilePixels()
+        return (self.rect.x + pos[0] * self.tileSize // tilePixels,
+            self.rect.y + pos[1] * self.tileSize // tilePixels)
+
+    def setZoom(self, zoomLevel, anchor = None):
+        """
+        Changes the zoom level, keeping the map pixel under the screen position
+        anchor (the screen center by default) in place.
+        """
+        zoomLevel = max(0, min(len(ZOOM_TILE_SIZES) - 1, zoomLevel))
+        if zoomLevel == self.zoomLevel:
+            return
+        if anchor is None:
+            anchor = (self.width // 2, self.height // 2)
+        mapx, mapy = self.screenToMap(anchor)
+        self.zoomLevel = zoomLevel
+        tilePixels = self.getTilePixels()
+        self.rect.size = (self.width * self.tileSize // tilePixels + 32,
+            self.height * self.tileSize // tilePixels + 32)
+        self.rect.x = mapx - anchor[0] * self.tileSize // tilePixels
+        self.rect.y = mapy - anchor[1] * self.tileSize // tilePixels
+        # do not interpolate across a zoom
+        self.savePosition()
+
+    def jumpTo(self, pos):
+        """
+        Centers the screen on the map pixel pos, without interpolating from the old position.
+        """
+        tilePixels = self.getTilePixels()
+        self.rect.x = pos[0] - self.width // 2 * self.tileSize // tilePixels
+        self.rect.y = pos[1] - self.height // 2 * self.tileSize // tilePixels
+        self.savePosition()
+
+    def savePosition(self):
+        """
+        Remembers the current position as the start of the tick.
+        """
+        self.previous = self.rect.topleft
+
+    def getRenderRect(self, interpolation):
+        """
+        Returns a copy of rect moved back between the position at the start of the tick
+        and the current one. interpolation 1 is the current position.
+        """
+        rect = self.rect.copy()
+        prevx, prevy = self.previous
+        rect.x = int(round(prevx + (self.rect.x - prevx) * interpolation))
+        rect.y = int(round(prevy + (self.rect.y - prevy) * interpolation))
+        return rect
 
 class Resource(object):
     def __init__(self, parent, recId = WHEAT):
@@ -227,7 +674,5 @@ class Resource(object):
         else:
             self.name = "ERROR"
 
-# TODO structure object that represents building
 # TODO HUD object that holds UI content
-# TODO ? yield object that initiates based on a Tile and calculates the resource yield per second.
 # TODO tooltip object that represents a box with info in it. Created when mouse is hovered on tile for a moment
\ No newline at end of file
@@ -0,0 +1,502 @@
+"""
+Pathfinding across the tile grid.
+
+Moving onto a tile costs its terrain's cost from a cost table, times 10 for a straight
+step or 14 for a diagonal one. Terrain with cost 0 can not be entered: land units use
+LAND_COSTS where OCEAN and LAKE are impassable, ships use WATER_COSTS.
+
+Pathfinder answers three kinds of query:
+
+    findPath         A* over tiles, for short trips.
+    findLongPath     A* over clusters of tiles first, then A* inside each cluster on
+                     the route. Cluster entrances and the costs between them are
+                     worked out the first time a search reaches a cluster and cached.
+    getDistanceField the cost to a goal from every tile around it, so any number of
+                     units can head there by stepping downhill.
+
+Changing a tile drops the cached cluster data and distance fields it is part of.
+"""
+import heapq
+from collections import OrderedDict
+import model
+from eventmanager import *
+
+# cost of entering a tile of each terrain type, 0 if it can not be entered
+LAND_COSTS = {
+    model.GRASSLAND: 1,
+    model.PLAINS: 1,
+    model.GRAVEL: 2,
+    model.DESERT: 3,
+    model.TUNDRA: 3,
+    model.SNOW: 4,
+}
+WATER_COSTS = {
+    model.OCEAN: 1,
+    model.LAKE: 1,
+}
+
+# (column step, row step, step cost) of the eight moves
+STRAIGHT = 10
+DIAGONAL = 14
+MOVES = ((1, 0, STRAIGHT), (-1, 0, STRAIGHT), (0, 1, STRAIGHT), (0, -1, STRAIGHT),
+    (1, 1, DIAGONAL), (1, -1, DIAGONAL), (-1, 1, DIAGONAL), (-1, -1, DIAGONAL))
+
+# clusters of findLongPath are CLUSTER_TILES by CLUSTER_TILES tiles
+CLUSTER_TILES = 16
+# the least recently used distance field is dropped once there are more
+MAX_DISTANCE_FIELDS = 16
+
+# borders between a cluster and the one east (right) or south (below) of it
+EAST = 0
+SOUTH = 1
+
+
+def buildCostTable(costs):
+    """
+    Returns a bytes.translate() table with the cost of each tileId in costs, 0 for the rest.
+    """
+    return bytes(costs.get(tileId, 0) for tileId in range(256))
+
+
+def octile(fromCol, fromRow, toCol, toRow):
+    """
+    Returns the cost of the cheapest possible trip between two tiles, every tile costing 1.
+    """
+    dx = abs(fromCol - toCol)
+    dy = abs(fromRow - toRow)
+    return STRAIGHT * max(dx, dy) + (DIAGONAL - STRAIGHT) * min(dx, dy)
+
+
+class DistanceField(object):
+    """
+    Cost to reach goal from every tile within maxCost of it.
+    A unit heads for goal by moving to nextStep() of its tile until it gets there.
+    """
+
+    def __init__(self, pathfinder, goal, distances, bounds):
+        """
+        Attributes:
+        goal (int): index of the goal tile.
+        distances (dict): tile index: cost from that tile to goal.
+        bounds (tuple): (firstCol, firstRow, endCol, endRow) of the tiles in distances.
+        """
+        self.pathfinder = pathfinder
+        self.goal = goal
+        self.distances = distances
+        self.bounds = bounds
+
+    def getDistance(self, pos):
+        """
+        Returns the cost from (col, row) to the goal, or None if it is out of reach.
+        """
+        return self.distances.get(self.pathfinder.toIndex(pos))
+
+    def nextStep(self, pos):
+        """
+        Returns the (col, row) to move to from pos on the cheapest way to the goal,
+        pos itself at the goal and None if the goal is out of reach.
+        """
+        index = self.pathfinder.toIndex(pos)
+        if index == self.goal:
+            return pos
+        if index not in self.distances:
+            return None
+        best = None
+        bestCost = None
+        for neighbour, stepCost in self.pathfinder.getMoves(index):
+            distance = self.distances.get(neighbour)
+            if distance is not None and (bestCost is None or stepCost + distance < bestCost):
+                best = neighbour
+                bestCost = stepCost + distance
+        return self.pathfinder.toPos(best) if best is not None else None
+
+    def getPath(self, pos):
+        """
+        Returns the list of (col, row) from pos to the goal, or None if it is out of reach.
+        """
+        if self.getDistance(pos) is None:
+            return None
+        path = [pos]
+        while self.pathfinder.toIndex(path[-1]) != self.goal:
+            path.append(self.nextStep(path[-1]))
+        return path
+
+
+class Pathfinder(object):
+    """
+    Finds paths on the model's map for units that move with one cost table.
+    """
+
+    def __init__(self, evManager, model, costs = LAND_COSTS, clusterTiles = CLUSTER_TILES):
+        """
+        evManager (EventManager): Allows posting messages to the event queue.
+        model (GameEngine): a strong reference to the game Model.
+        costs (dict): tileId: cost of entering a tile of that terrain.
+
+        Attributes:
+        costs (bytearray): cost of entering each tile of tileMap, 0 if it can't be entered.
+        borders (dict): (clusterCol, clusterRow, EAST or SOUTH): list of (inside, outside, cost in, cost out)
+        tile index pairs where the route between two clusters crosses their border.
+        clusters (dict): (clusterCol, clusterRow): (links, edges), links being entrance:
+        list of (entrance, cost) across borders and edges entrance: dict of entrance: cost inside.
+        fields (OrderedDict): (goal, maxCost): DistanceField, least recently used first.
+        """
+        self.evManager = evManager
+        evManager.Subscribe(TileChangeEvent, self.onTileChange)
+        self.model = model
+        self.costTable = buildCostTable(costs)
+        self.clusterTiles = clusterTiles
+        self.tileMap = None
+        self.width = 0
+        self.height = 0
+        self.costs = None
+        self.borders = {}
+        self.clusters = {}
+        self.fields = OrderedDict()
+
+    def onTileChange(self, event):
+        """
+        Called by a TileChangeEvent in the message queue.
+        Updates the changed tiles' costs and drops what was cached around them.
+        """
+        if self.tileMap is None or self.model.tileMap is not self.tileMap:
+            return
+        for col, row in event.positions:
+            tile = self.tileMap.getTile(col, row)
+            if tile:
+                self.costs[tile.index] = self.costTable[tile.tileId]
+                self.dropCluster(col // self.clusterTiles, row // self.clusterTiles)
+                self.dropFields(col, row)
+
+    def update(self):
+        """
+        Works out the cost of every tile again if the model has a new map.
+        """
+        tileMap = self.model.tileMap
+        if tileMap is self.tileMap:
+            return
+        self.tileMap = tileMap
+        self.width = tileMap.width
+        self.height = tileMap.height
+        self.costs = bytearray(bytes(tileMap.terrain[0:len(tileMap)]).translate(self.costTable))
+        self.borders.clear()
+        self.clusters.clear()
+        self.fields.clear()
+
+    def toIndex(self, pos):
+        return pos[1] * self.width + pos[0]
+
+    def toPos(self, index):
+        row, col = divmod(index, self.width)
+        return (col, row)
+
+    def getMoves(self, index):
+        """
+        Returns (neighbour, step cost) of every move from a tile onto one that can be entered.
+        Diagonal moves are only allowed when both tiles beside them can be entered.
+        """
+        width = self.width
+        costs = self.costs
+        row, col = divmod(index, width)
+        moves = []
+        for dcol, drow, step in MOVES:
+            newCol = col + dcol
+            newRow = row + drow
+            if 0 <= newCol < width and 0 <= newRow < self.height:
+                neighbour = index + drow * width + dcol
+                cost = costs[neighbour]
+                if cost and (step == STRAIGHT or (costs[index + dcol] and costs[index + drow * width])):
+                    moves.append((neighbour, cost * step))
+        return moves
+
+    # TILE SEARCHES
+    def search(self, start, goal, bounds):
+        """
+        A* from tile index start to goal over the tiles in bounds.
+        Returns (cost, list of tile indices from start to goal), or None if there is no way.
+        """
+        width = self.width
+        costs = self.costs
+        firstCol, firstRow, endCol, endRow = bounds
+        goalRow, goalCol = divmod(goal, width)
+        best = {start: 0}
+        parents = {start: None}
+        startRow, startCol = divmod(start, width)
+        frontier = [(octile(startCol, startRow, goalCol, goalRow), 0, start)]
+        while frontier:
+            estimate, cost, index = heapq.heappop(frontier)
+            if index == goal:
+                path = []
+                while index is not None:
+                    path.append(index)
+                    index = parents[index]
+                path.reverse()
+                return cost, path
+            if cost > best[index]:
+                continue
+            row, col = divmod(index, width)
+            for dcol, drow, step in MOVES:
+                newCol = col + dcol
+                newRow = row + drow
+                if not (firstCol <= newCol < endCol and firstRow <= newRow < endRow):
+                    continue
+                neighbour = index + drow * width + dcol
+                tileCost = costs[neighbour]
+                if not tileCost:
+                    continue
+                if step != STRAIGHT and not (costs[index + dcol] and costs[index + drow * width]):
+                    continue
+                newCost = cost + tileCost * step
+                if newCost < best.get(neighbour, newCost + 1):
+                    best[neighbour] = newCost
+                    parents[neighbour] = index
+                    heapq.heappush(frontier, (newCost + octile(newCol, newRow, goalCol, goalRow), newCost, neighbour))
+        return None
+
+    def spread(self, source, bounds, toSource = False, maxCost = None):
+        """
+        Dijkstra from tile index source over the tiles in bounds.
+        Returns a dict of tile index: cost from source, or cost to source if toSource.
+        Tiles costing more than maxCost are left out.
+        """
+        width = self.width
+        costs = self.costs
+        firstCol, firstRow, endCol, endRow = bounds
+        distances = {source: 0}
+        frontier = [(0, source)]
+        while frontier:
+            cost, index = heapq.heappop(frontier)
+            if cost > distances[index]:
+                continue
+            row, col = divmod(index, width)
+            # towards the source a step costs what the tile stepped from costs
+            fromCost = costs[index]
+            for dcol, drow, step in MOVES:
+                newCol = col + dcol
+                newRow = row + drow
+                if not (firstCol <= newCol < endCol and firstRow <= newRow < endRow):
+                    continue
+                neighbour = index + drow * width + dcol
+                tileCost = costs[neighbour]
+                if not tileCost:
+                    continue
+                if step != STRAIGHT and not (costs[index + dcol] and costs[index + drow * width]):
+                    continue
+                newCost = cost + (fromCost if toSource else tileCost) * step
+                if maxCost is not None and newCost > maxCost:
+                    continue
+                if newCost < distances.get(neighbour, newCost + 1):
+                    distances[neighbour] = newCost
+                    heapq.heappush(frontier, (newCost, neighbour))
+        return distances
+
+    def findPath(self, start, goal, bounds = None):
+        """
+        Returns the cheapest list of (col, row) from start to goal, or None if there is no way.
+        Only tiles in bounds (firstCol, firstRow, endCol, endRow) are searched, the whole map if None.
+        """
+        self.update()
+        startIndex = self.toIndex(start)
+        goalIndex = self.toIndex(goal)
+        if not (self.inMap(start) and self.inMap(goal)) or not self.costs[goalIndex]:
+            return None
+        found = self.search(startIndex, goalIndex, bounds or (0, 0, self.width, self.height))
+        return [self.toPos(index) for index in found[1]] if found else None
+
+    def inMap(self, pos):
+        return 0 <= pos[0] < self.width and 0 <= pos[1] < self.height
+
+    # CLUSTERS
+    def getClusterBounds(self, clusterCol, clusterRow):
+        tiles = self.clusterTiles
+        return (clusterCol * tiles, clusterRow * tiles,
+            min(self.width, (clusterCol + 1) * tiles), min(self.height, (clusterRow + 1) * tiles))
+
+    def getCluster(self, index):
+        row, col = divmod(index, self.width)
+        return (col // self.clusterTiles, row // self.clusterTiles)
+
+    def getBorder(self, clusterCol, clusterRow, side):
+        """
+        Returns the crossings of the east or south border of a cluster, finding them
+        if they are not cached: one in the middle of every run of tiles that can
+        be entered on both sides.
+        """
+        key = (clusterCol, clusterRow, side)
+        crossings = self.borders.get(key)
+        if crossings is not None:
+            return crossings
+        crossings = []
+        firstCol, firstRow, endCol, endRow = self.getClusterBounds(clusterCol, clusterRow)
+        width = self.width
+        costs = self.costs
+        if side == EAST and endCol < width:
+            pairs = [(row * width + endCol - 1, row * width + endCol) for row in range(firstRow, endRow)]
+        elif side == SOUTH and endRow < self.height:
+            pairs = [((endRow - 1) * width + col, endRow * width + col) for col in range(firstCol, endCol)]
+        else:
+            pairs = []
+        run = []
+        for inside, outside in pairs + [(None, None)]:
+            if inside is not None and costs[inside] and costs[outside]:
+                run.append((inside, outside))
+            elif run:
+                inside, outside = run[len(run) // 2]
+                crossings.append((inside, outside, costs[inside] * STRAIGHT, costs[outside] * STRAIGHT))
+                run = []
+        self.borders[key] = crossings
+        return crossings
+
+    def getClusterGraph(self, clusterCol, clusterRow):
+        """
+        Returns (links, edges) of a cluster, working them out if they are not cached.
+        links maps each entrance to the (entrance, cost) pairs across its borders,
+        edges maps each entrance to the costs of reaching the cluster's other entrances inside it.
+        """
+        key = (clusterCol, clusterRow)
+        graph = self.clusters.get(key)
+        if graph is not None:
+            return graph
+        links = {}
+        for inside, outside, costIn, costOut in self.getBorder(clusterCol, clusterRow, EAST) + self.getBorder(clusterCol, clusterRow, SOUTH):
+            links.setdefault(inside, []).append((outside, costOut))
+        if clusterCol > 0:
+            for outside, inside, costOut, costIn in self.getBorder(clusterCol - 1, clusterRow, EAST):
+                links.setdefault(inside, []).append((outside, costOut))
+        if clusterRow > 0:
+            for outside, inside, costOut, costIn in self.getBorder(clusterCol, clusterRow - 1, SOUTH):
+                links.setdefault(inside, []).append((outside, costOut))
+        bounds = self.getClusterBounds(clusterCol, clusterRow)
+        edges = {}
+        for entrance in links:
+            distances = self.spread(entrance, bounds)
+            edges[entrance] = dict((other, distances[other]) for other in links
+                if other != entrance and other in distances)
+        graph = (links, edges)
+        self.clusters[key] = graph
+        return graph
+
+    def dropCluster(self, clusterCol, clusterRow):
+        """
+        Forgets the borders of a cluster and the graphs of it and its neighbours.
+        """
+        for side in (EAST, SOUTH):
+            self.borders.pop((clusterCol, clusterRow, side), None)
+        self.borders.pop((clusterCol - 1, clusterRow, EAST), None)
+        self.borders.pop((clusterCol, clusterRow - 1, SOUTH), None)
+        for dcol, drow in ((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)):
+            self.clusters.pop((clusterCol + dcol, clusterRow + drow), None)
+
+    def findLongPath(self, start, goal):
+        """
+        Returns a list of (col, row) from start to goal, or None if there is no way.
+        The route is planned between cluster entrances first and then filled in
+        with A* inside each cluster, so it is close to but not always the cheapest.
+        """
+        self.update()
+        if not (self.inMap(start) and self.inMap(goal)):
+            return None
+        startIndex = self.toIndex(start)
+        goalIndex = self.toIndex(goal)
+        if not self.costs[goalIndex]:
+            return None
+        startCluster = self.getCluster(startIndex)
+        goalCluster = self.getCluster(goalIndex)
+        if startCluster == goalCluster:
+            found = self.search(startIndex, goalIndex, self.getClusterBounds(*startCluster))
+            if found:
+                return [self.toPos(index) for index in found[1]]
+        # start and goal join the cluster graph through their own cluster's entrances
+        startLinks, startEdges = self.getClusterGraph(*startCluster)
+        goalLinks, goalEdges = self.getClusterGraph(*goalCluster)
+        fromStart = self.spread(startIndex, self.getClusterBounds(*startCluster))
+        toGoal = self.spread(goalIndex, self.getClusterBounds(*goalCluster), toSource = True)
+        startExits = dict((entrance, fromStart[entrance]) for entrance in startLinks if entrance in fromStart)
+        goalEntrances = dict((entrance, toGoal[entrance]) for entrance in goalLinks if entrance in toGoal)
+        route = self.searchClusters(startIndex, goalIndex, startExits, goalEntrances)
+        if route is None:
+            return None
+        # fill in the tiles between each pair of route points, they share a cluster or a border
+        path = [startIndex]
+        for fromIndex, toIndex in zip(route, route[1:]):
+            if toIndex in [neighbour for neighbour, stepCost in self.getMoves(fromIndex)]:
+                path.append(toIndex)
+                continue
+            found = self.search(fromIndex, toIndex, self.getClusterBounds(*self.getCluster(fromIndex)))
+            if found is None:
+                return None
+            path.extend(found[1][1:])
+        return [self.toPos(index) for index in path]
+
+    def searchClusters(self, start, goal, startExits, goalEntrances):
+        """
+        A* over the cluster graph from start to goal, leaving start through startExits
+        and reaching goal from goalEntrances, both dicts of entrance: cost.
+        Returns the list of tile indices of the route, or None.
+        """
+        width = self.width
+        goalRow, goalCol = divmod(goal, width)
+        best = {start: 0}
+        parents = {start: None}
+        frontier = [(0, 0, start)]
+        while frontier:
+            estimate, cost, index = heapq.heappop(frontier)
+            if index == goal:
+                route = []
+                while index is not None:
+                    route.append(index)
+                    index = parents[index]
+                route.reverse()
+                return route
+            if cost > best[index]:
+                continue
+            links, edges = self.getClusterGraph(*self.getCluster(index))
+            if index == start:
+                # a start that is an entrance itself also crosses its own links
+                moves = list(startExits.items()) + links.get(index, [])
+            else:
+                moves = links.get(index, []) + list(edges.get(index, {}).items())
+            if index in goalEntrances:
+                moves.append((goal, goalEntrances[index]))
+            for neighbour, moveCost in moves:
+                newCost = cost + moveCost
+                if newCost < best.get(neighbour, newCost + 1):
+                    best[neighbour] = newCost
+                    parents[neighbour] = index
+                    row, col = divmod(neighbour, width)
+                    heapq.heappush(frontier, (newCost + octile(col, row, goalCol, goalRow), newCost, neighbour))
+        return None
+
+    # DISTANCE FIELDS
+    def getDistanceField(self, goal, maxCost = None):
+        """
+        Returns the DistanceField to the (col, row) goal, reusing a cached one if it is still valid.
+        With a maxCost only tiles that cost at most that much to reach goal from are in it,
+        without one it covers every tile that can reach goal.
+        """
+        self.update()
+        key = (goal, maxCost)
+        field = self.fields.get(key)
+        if field is not None:
+            self.fields.move_to_end(key)
+            return field
+        goalIndex = self.toIndex(goal)
+        distances = self.spread(goalIndex, (0, 0, self.width, self.height), toSource = True, maxCost = maxCost)
+        cols = [index % self.width for index in distances]
+        rows = [index // self.width for index in distances]
+        bounds = (min(cols), min(rows), max(cols) + 1, max(rows) + 1)
+        field = DistanceField(self, goalIndex, distances, bounds)
+        self.fields[key] = field
+        while len(self.fields) > MAX_DISTANCE_FIELDS:
+            self.fields.popitem(last = False)
+        return field
+
+    def dropFields(self, col, row):
+        """
+        Forgets the distance fields a change of the tile at (col, row) could alter:
+        those covering it or a tile next to it.
+        """
+        for key, field in list(self.fields.items()):
+            firstCol, firstRow, endCol, endRow = field.bounds
+            if firstCol - 1 <= col <= endCol and firstRow - 1 <= row <= endRow:
+                del self.fields[key]
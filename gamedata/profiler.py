@@ -0,0 +1,122 @@
+"""
+Timing instrumentation.
+
+A Profiler keeps a RollingHistogram of recent timings per name.
+EventManager records how long each handler takes per event type
+and GraphicalView records the parts of each frame.
+"""
+import csv
+import json
+from collections import deque
+
+# RollingHistogram.buckets() are BUCKET_COUNT buckets of BUCKET_SIZE seconds
+BUCKET_SIZE = 0.001
+BUCKET_COUNT = 20
+
+
+class RollingHistogram(object):
+    """
+    The last windowSize samples of a timing, in seconds.
+    """
+
+    def __init__(self, windowSize = 300):
+        self.samples = deque(maxlen = windowSize)
+        # samples ever added, including the ones that rolled out of the window
+        self.total = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.total += 1
+
+    def mean(self):
+        if not self.samples:
+            return 0.0
+        return sum(self.samples) / len(self.samples)
+
+    def maximum(self):
+        return max(self.samples) if self.samples else 0.0
+
+    def percentile(self, fraction):
+        """
+        Returns the nearest rank percentile of the window, fraction from 0 to 1.
+        """
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        rank = int(fraction * len(ordered) + 0.999999) - 1
+        return ordered[max(0, min(rank, len(ordered) - 1))]
+
+    def buckets(self, bucketSize = BUCKET_SIZE, count = BUCKET_COUNT):
+        """
+        Returns how many samples fall in each bucketSize wide bucket from 0.
+        The last bucket also counts every larger sample.
+        """
+        counts = [0] * count
+        for value in self.samples:
+            counts[min(count - 1, int(value / bucketSize))] += 1
+        return counts
+
+
+class Profiler(object):
+    """
+    Named rolling histograms of timings.
+    """
+
+    def __init__(self, windowSize = 300, pinned = True):
+        """
+        windowSize (int): number of recent samples kept per name.
+        pinned (bool): record all the time, not only while the debug overlay is shown.
+        """
+        self.windowSize = windowSize
+        self.histograms = {}
+        self.pinned = pinned
+        self.enabled = pinned
+
+    def record(self, name, seconds):
+        """
+        Adds a timing sample to the histogram of name.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = RollingHistogram(self.windowSize)
+        histogram.add(seconds)
+
+    def summary(self):
+        """
+        Returns a list of (name, count, mean, p50, p95, p99, max) rows in seconds,
+        slowest mean first.
+        """
+        rows = []
+        for name, histogram in self.histograms.items():
+            rows.append((name, len(histogram.samples), histogram.mean(),
+                histogram.percentile(0.50), histogram.percentile(0.95),
+                histogram.percentile(0.99), histogram.maximum()))
+        rows.sort(key = lambda row: row[2], reverse = True)
+        return rows
+
+    def export(self, fileName):
+        """
+        Writes the summary to fileName, as CSV if it ends with .csv and JSON otherwise.
+        CSV rows end with the counts of the buckets, one column per bucket.
+        The JSON file holds the buckets and every sample in the windows too.
+        """
+        columns = ('name', 'count', 'mean', 'p50', 'p95', 'p99', 'max')
+        rows = self.summary()
+        if fileName.endswith('.csv'):
+            bucketColumns = ['%gms' % (bucket * BUCKET_SIZE * 1000) for bucket in range(BUCKET_COUNT)]
+            bucketColumns[-1] += '+'
+            with open(fileName, 'w', newline = '') as csvFile:
+                writer = csv.writer(csvFile)
+                writer.writerow(columns + tuple(bucketColumns))
+                writer.writerows(row + tuple(self.histograms[row[0]].buckets()) for row in rows)
+        else:
+            trace = {
+                'summary': [dict(zip(columns, row)) for row in rows],
+                'bucketSize': BUCKET_SIZE,
+                'buckets': dict((name, histogram.buckets())
+                    for name, histogram in self.histograms.items()),
+                'samples': dict((name, list(histogram.samples))
+                    for name, histogram in self.histograms.items()),
+            }
+            with open(fileName, 'w') as jsonFile:
+                json.dump(trace, jsonFile, indent = 1)
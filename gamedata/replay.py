@@ -0,0 +1,287 @@
+"""
+Input recording and replay, to turn played sessions into repeatable test cases.
+
+An InputRecorder sits between Keyboard and the real input source and logs, for every
+tick, the mouse position, the held keys Keyboard polls and the input events it handled.
+Together with the map and resource seed that is everything a session depends on,
+so feeding the log back through Keyboard replays the session exactly.
+
+A log file is a header followed by the zlib compressed ticks:
+
+    magic     4s  b'ACRP'
+    version   H   REPLAY_VERSION
+    seed      q   resource seed, -1 for none
+    name      H   length of the map file name, then its UTF-8 bytes (empty for the default map)
+    ticks         zlib compressed, per tick:
+                  mouse x h, mouse y h, held keys B (bit i for RECORDED_KEYS[i]),
+                  event count H, then the events as an EVENT_ type byte and its fields
+
+Record a session with main.run(record = "session.rec"), and replay it headless,
+as fast as possible, from the gamedata folder with:
+
+    python replay.py session.rec
+"""
+import os
+import struct
+import sys
+import tempfile
+import zlib
+import pygame
+import savegame
+from controller import ScriptedKeys
+
+MAGIC = b'ACRP'
+REPLAY_VERSION = 1
+HEADER = struct.Struct('<4sHqH')
+TICK = struct.Struct('<hhBH')
+
+# keys Keyboard polls while they are held, their pressed state is logged every tick
+RECORDED_KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d)
+
+# logged event types and the fields stored for each, other events do not reach the game
+EVENT_QUIT = 0
+EVENT_KEYDOWN = 1
+EVENT_KEYUP = 2
+EVENT_MOUSEMOTION = 3
+EVENT_MOUSEBUTTONDOWN = 4
+EVENT_MOUSEBUTTONUP = 5
+EVENT_MOUSEWHEEL = 6
+EVENT_TYPES = {
+    pygame.QUIT: EVENT_QUIT,
+    pygame.KEYDOWN: EVENT_KEYDOWN,
+    pygame.KEYUP: EVENT_KEYUP,
+    pygame.MOUSEMOTION: EVENT_MOUSEMOTION,
+    pygame.MOUSEBUTTONDOWN: EVENT_MOUSEBUTTONDOWN,
+    pygame.MOUSEBUTTONUP: EVENT_MOUSEBUTTONUP,
+    pygame.MOUSEWHEEL: EVENT_MOUSEWHEEL,
+}
+PYGAME_TYPES = dict((code, eventType) for eventType, code in EVENT_TYPES.items())
+KEY_FIELDS = struct.Struct('<iHB')
+MOTION_FIELDS = struct.Struct('<hhhhB')
+BUTTON_FIELDS = struct.Struct('<hhB')
+WHEEL_FIELDS = struct.Struct('<hh')
+
+
+class ReplayFileError(Exception):
+    """
+    Raised when a file is not a replay log this version can read.
+    """
+    pass
+
+
+class InputLog(object):
+    """
+    A recorded session: where it started and the input of every tick.
+    """
+
+    def __init__(self, seed = None, mapFileName = None):
+        """
+        Attributes:
+        seed (int): resource seed of the map, None if it had its own resources.
+        mapFileName (str): map played on, None for the default map.
+        ticks (list): (mousePos, pressed, events) of every tick, with pressed
+        the set of RECORDED_KEYS held and events the pygame events handled.
+        """
+        self.seed = seed
+        self.mapFileName = mapFileName
+        self.ticks = []
+
+    def __len__(self):
+        return len(self.ticks)
+
+
+def packEvent(event):
+    """
+    Returns the logged bytes of a pygame event, or None if it is not logged.
+    """
+    code = EVENT_TYPES.get(event.type)
+    if code is None:
+        return None
+    data = bytes((code,))
+    if code in (EVENT_KEYDOWN, EVENT_KEYUP):
+        text = getattr(event, 'unicode', '').encode('utf-8')
+        data += KEY_FIELDS.pack(event.key, event.mod, len(text)) + text
+    elif code == EVENT_MOUSEMOTION:
+        buttons = sum(1 << bit for bit, pressed in enumerate(event.buttons) if pressed)
+        data += MOTION_FIELDS.pack(event.pos[0], event.pos[1], event.rel[0], event.rel[1], buttons)
+    elif code in (EVENT_MOUSEBUTTONDOWN, EVENT_MOUSEBUTTONUP):
+        data += BUTTON_FIELDS.pack(event.pos[0], event.pos[1], event.button)
+    elif code == EVENT_MOUSEWHEEL:
+        data += WHEEL_FIELDS.pack(event.x, event.y)
+    return data
+
+
+def unpackEvent(data, offset):
+    """
+    Reads a logged event at offset. Returns (pygame event, offset after it).
+    """
+    code = data[offset]
+    offset += 1
+    eventType = PYGAME_TYPES[code]
+    if code in (EVENT_KEYDOWN, EVENT_KEYUP):
+        key, mod, length = KEY_FIELDS.unpack_from(data, offset)
+        offset += KEY_FIELDS.size
+        text = data[offset:offset + length].decode('utf-8')
+        offset += length
+        event = pygame.event.Event(eventType, key = key, mod = mod, unicode = text)
+    elif code == EVENT_MOUSEMOTION:
+        x, y, relx, rely, buttons = MOTION_FIELDS.unpack_from(data, offset)
+        offset += MOTION_FIELDS.size
+        event = pygame.event.Event(eventType, pos = (x, y), rel = (relx, rely),
+            buttons = tuple(bool(buttons & (1 << bit)) for bit in range(3)))
+    elif code in (EVENT_MOUSEBUTTONDOWN, EVENT_MOUSEBUTTONUP):
+        x, y, button = BUTTON_FIELDS.unpack_from(data, offset)
+        offset += BUTTON_FIELDS.size
+        event = pygame.event.Event(eventType, pos = (x, y), button = button)
+    elif code == EVENT_MOUSEWHEEL:
+        x, y = WHEEL_FIELDS.unpack_from(data, offset)
+        offset += WHEEL_FIELDS.size
+        event = pygame.event.Event(eventType, x = x, y = y)
+    else:
+        event = pygame.event.Event(eventType)
+    return event, offset
+
+
+def writeLog(fileName, log):
+    """
+    Writes an InputLog to a replay log file.
+    """
+    ticks = bytearray()
+    for mousePos, pressed, events in log.ticks:
+        packed = [data for data in (packEvent(event) for event in events) if data is not None]
+        heldBits = sum(1 << bit for bit, key in enumerate(RECORDED_KEYS) if key in pressed)
+        ticks += TICK.pack(mousePos[0], mousePos[1], heldBits, len(packed))
+        for data in packed:
+            ticks += data
+    name = (log.mapFileName or '').encode('utf-8')
+    seed = log.seed if log.seed is not None else -1
+    with open(fileName, 'wb') as logFile:
+        logFile.write(HEADER.pack(MAGIC, REPLAY_VERSION, seed, len(name)) + name)
+        logFile.write(zlib.compress(bytes(ticks)))
+
+
+def readLog(fileName):
+    """
+    Reads a replay log file. Returns an InputLog.
+    """
+    with open(fileName, 'rb') as logFile:
+        data = logFile.read()
+    if len(data) < HEADER.size:
+        raise ReplayFileError("%s is too short to be a replay log" % fileName)
+    magic, version, seed, nameLength = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ReplayFileError("%s is not a replay log" % fileName)
+    if version != REPLAY_VERSION:
+        raise ReplayFileError("%s has replay version %d, expected %d" % (fileName, version, REPLAY_VERSION))
+    name = data[HEADER.size:HEADER.size + nameLength].decode('utf-8')
+    log = InputLog(seed if seed >= 0 else None, name or None)
+    ticks = zlib.decompress(data[HEADER.size + nameLength:])
+    offset = 0
+    while offset < len(ticks):
+        mousex, mousey, heldBits, count = TICK.unpack_from(ticks, offset)
+        offset += TICK.size
+        events = []
+        for i in range(count):
+            event, offset = unpackEvent(ticks, offset)
+            events.append(event)
+        pressed = set(key for bit, key in enumerate(RECORDED_KEYS) if heldBits & (1 << bit))
+        log.ticks.append(((mousex, mousey), pressed, events))
+    return log
+
+
+class InputRecorder(object):
+    """
+    Input source that reads another one and logs what it read, tick by tick.
+    The held keys and the mouse position are read once at the start of each tick,
+    so the tick sees the same input whether it is played or replayed.
+    """
+
+    def __init__(self, source, seed = None, mapFileName = None):
+        """
+        source: input source to record, like controller.PygameInput().
+        seed, mapFileName: see InputLog, set them again with start() if the map changes.
+        """
+        self.source = source
+        self.log = InputLog(seed, mapFileName)
+        self.pressed = set()
+        self.mousePos = (0, 0)
+
+    def start(self, seed = None, mapFileName = None):
+        """
+        Starts a new log, for a session on mapFileName with resources from seed.
+        """
+        self.log = InputLog(seed, mapFileName)
+
+    def getEvents(self):
+        keys = self.source.getPressed()
+        self.pressed = set(key for key in RECORDED_KEYS if keys[key])
+        self.mousePos = tuple(self.source.getMousePos())
+        events = [event for event in self.source.getEvents() if event.type in EVENT_TYPES]
+        self.log.ticks.append((self.mousePos, self.pressed, events))
+        return events
+
+    def getPressed(self):
+        return ScriptedKeys(self.pressed)
+
+    def getMousePos(self):
+        return self.mousePos
+
+
+class ReplayInput(object):
+    """
+    Input source that plays back an InputLog, one tick per call of getEvents().
+    Once the log is over nothing is pressed and no events come.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.tick = 0
+        self.pressed = set()
+        self.mousePos = (0, 0)
+
+    @property
+    def done(self):
+        return self.tick >= len(self.log.ticks)
+
+    def getEvents(self):
+        if self.done:
+            self.pressed = set()
+            return []
+        self.mousePos, self.pressed, events = self.log.ticks[self.tick]
+        self.tick += 1
+        return list(events)
+
+    def getPressed(self):
+        return ScriptedKeys(self.pressed)
+
+    def getMousePos(self):
+        return self.mousePos
+
+
+def replay(log, render = True):
+    """
+    Replays an InputLog in a headless game as fast as possible, rendering after
+    every tick unless render is False. Returns the benchmark.FrameBench that ran it,
+    with the time of every frame and phase.
+    F5 and F9 save and load in a temporary folder, never the player's save game.
+    """
+    import benchmark
+    with tempfile.TemporaryDirectory() as saveFolder:
+        bench = benchmark.FrameBench(seed = log.seed, inputSource = ReplayInput(log),
+            mapFileName = log.mapFileName or benchmark.CLASSIC_MEDIUM, render = render,
+            saveFileName = os.path.join(saveFolder, savegame.SAVE_FILE_NAME))
+        bench.run(len(log))
+        bench.stopSaving()
+    return bench
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("usage: python replay.py <session.rec>")
+        sys.exit(1)
+    log = readLog(sys.argv[1])
+    bench = replay(log)
+    bench.report('replay')
+    worst = sorted(range(len(bench.frameTimes)), key = lambda tick: bench.frameTimes[tick], reverse = True)
+    print("slowest ticks: %s" % "  ".join("%d (%.2f ms)" % (tick, bench.frameTimes[tick] * 1000)
+        for tick in worst[:5]))
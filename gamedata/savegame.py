@@ -0,0 +1,563 @@
+"""
+Save games: binary snapshots of the whole game, and delta saves of the tiles changed since.
+
+Both kinds of file are a header followed by sections, each a tag, a length and its data:
+
+    magic    4s  b'ACSV'
+    version  H   SAVE_VERSION
+    kind     H   SNAPSHOT or DELTA
+    saveId   Q   random id of the snapshot, repeated in the deltas made after it
+    sections     (4s tag, I length, data) ...
+
+    GAME  seed, camera position and zoom level, state stack
+    TILE  width, height, then the terrain and resource layers, zlib compressed (snapshots)
+    DIFF  count, then the indices, terrain and resources of every tile changed
+          since the snapshot, zlib compressed (deltas)
+    ENTS  number of entity ids, then every component array of ecs.EntityStore,
+          zlib compressed (both, a delta's replace the snapshot's)
+    YLDS  number of owned tiles, of stocks and of yield types, then the owned tiles'
+          indices and owners and every owner's stock, see yields.YieldEngine,
+          zlib compressed (both, a delta's replace the snapshot's)
+    STRM  the map file a streamed map was streamed from (snapshots)
+
+Unknown sections are skipped when loading, so later versions can add more.
+A delta save holds every change since its snapshot, so loading reads the snapshot and
+at most one delta file. Files are written by a background thread, the game thread
+only copies what is saved. Streamed maps only copy their chunks in memory, the writer
+reads the other tiles from the map file, and loading writes the saved tiles back
+into the map file and streams it again.
+"""
+import logging
+import os
+import random
+import struct
+import sys
+import threading
+import queue
+import zlib
+from array import array
+import ecs
+import mapfile
+import model
+import streaming
+import yields
+from eventmanager import *
+
+MAGIC = b'ACSV'
+SAVE_VERSION = 1
+HEADER = struct.Struct('<4sHHQ')
+SECTION = struct.Struct('<4sI')
+# seed (-1 for none), camera x and y, zoom level, number of states
+GAME = struct.Struct('<qiiBH')
+# width, height
+TILES = struct.Struct('<II')
+# number of changed tiles
+DIFF = struct.Struct('<I')
+# number of entity ids
+ENTITIES = struct.Struct('<I')
+# number of owned tiles, number of stocks, yield types per stock
+YIELDS = struct.Struct('<IHB')
+
+# file kinds
+SNAPSHOT = 1
+DELTA = 2
+
+SAVE_FILE_NAME = "savegame.sav"
+# zlib level, fast since big maps are mostly runs of the same terrain anyway
+COMPRESS_LEVEL = 1
+# ticks between autosaves, and the part of the map that may change before
+# an autosave writes a snapshot instead of a delta
+AUTOSAVE_TICKS = 30 * 60
+SNAPSHOT_FRACTION = 0.125
+
+
+class SaveFileError(Exception):
+    """
+    Raised when a file is not a save file this version can read.
+    """
+    pass
+
+
+def deltaFileName(fileName):
+    return fileName + ".delta"
+
+
+class SaveData(object):
+    """
+    Everything a save file holds, as read by load().
+    """
+
+    def __init__(self, saveId, seed, cameraPos, zoomLevel, states, width, height, terrain, resources, changed,
+                 entities, owners = None, stocks = None, mapFileName = None):
+        """
+        Attributes:
+        terrain, resources (array): the map layers, with the delta applied.
+        changed (array): indices of the tiles changed since the snapshot.
+        entities (list): component arrays for EntityStore.setArrays().
+        owners (dict): tile index: owner of the owned tiles, None if the save has no yields.
+        stocks (dict): owner: amount per yield type, None if the save has no yields.
+        mapFileName (str): the map file of a streamed map, None for other maps.
+        """
+        self.saveId = saveId
+        self.seed = seed
+        self.cameraPos = cameraPos
+        self.zoomLevel = zoomLevel
+        self.states = states
+        self.width = width
+        self.height = height
+        self.terrain = terrain
+        self.resources = resources
+        self.changed = changed
+        self.entities = entities
+        self.owners = owners
+        self.stocks = stocks
+        self.mapFileName = mapFileName
+
+
+def packGame(gameModel):
+    """
+    Returns the GAME section data of the model.
+    """
+    camera = gameModel.camera
+    states = gameModel.state.statestack
+    seed = gameModel.seed if gameModel.seed is not None else -1
+    return (GAME.pack(seed, camera.rect.x, camera.rect.y, camera.zoomLevel, len(states))
+        + bytes(states))
+
+
+def packEntities(entities):
+    """
+    Returns the component arrays of an EntityStore as bytes, compressed later by writeEntities.
+    """
+    arrays = entities.getArrays()
+    if sys.byteorder != 'little':
+        arrays = [array(components.typecode, components) for components in arrays]
+        for components in arrays:
+            components.byteswap()
+    return ENTITIES.pack(len(entities.masks)) + b''.join(components.tobytes() for components in arrays)
+
+
+def writeEntities(entities):
+    """
+    Returns the ENTS section data of packEntities() bytes.
+    """
+    return entities[:ENTITIES.size] + zlib.compress(entities[ENTITIES.size:], COMPRESS_LEVEL)
+
+
+def unpackEntities(data, fileName):
+    """
+    Returns the component arrays of an ENTS section.
+    """
+    count, = ENTITIES.unpack_from(data)
+    data = zlib.decompress(data[ENTITIES.size:])
+    arrays = []
+    offset = 0
+    for components in ecs.EntityStore().getArrays():
+        size = count * components.itemsize
+        if offset + size > len(data):
+            raise SaveFileError("%s has entity data of the wrong size" % fileName)
+        components.frombytes(data[offset:offset + size])
+        if sys.byteorder != 'little':
+            components.byteswap()
+        arrays.append(components)
+        offset += size
+    return arrays
+
+
+def packYields(economy):
+    """
+    Returns the tile owners and stocks of a YieldEngine as bytes, compressed later by writeYields.
+    """
+    tileOwners = economy.getOwners()
+    indices = array('I', sorted(tileOwners))
+    owners = bytes(tileOwners[index] for index in indices)
+    stockOwners = sorted(economy.stocks)
+    stocks = array('d')
+    for owner in stockOwners:
+        stocks.extend(economy.stocks[owner])
+    if sys.byteorder != 'little':
+        indices.byteswap()
+        stocks.byteswap()
+    return (YIELDS.pack(len(indices), len(stockOwners), len(yields.YIELD_NAMES))
+        + indices.tobytes() + owners + bytes(stockOwners) + stocks.tobytes())
+
+
+def writeYields(data):
+    """
+    Returns the YLDS section data of packYields() bytes.
+    """
+    return data[:YIELDS.size] + zlib.compress(data[YIELDS.size:], COMPRESS_LEVEL)
+
+
+def unpackYields(data, count, fileName):
+    """
+    Returns the (owners, stocks) dicts of a YLDS section, for a map of count tiles.
+    """
+    ownedCount, stockCount, yieldCount = YIELDS.unpack_from(data)
+    data = zlib.decompress(data[YIELDS.size:])
+    indices = array('I')
+    stocks = array('d')
+    ownersStart = ownedCount * indices.itemsize
+    stocksStart = ownersStart + ownedCount + stockCount
+    if len(data) != stocksStart + stockCount * yieldCount * stocks.itemsize:
+        raise SaveFileError("%s has yield data of the wrong size" % fileName)
+    indices.frombytes(data[:ownersStart])
+    stocks.frombytes(data[stocksStart:])
+    if sys.byteorder != 'little':
+        indices.byteswap()
+        stocks.byteswap()
+    if ownedCount and max(indices) >= count:
+        raise SaveFileError("%s has owned tiles outside the map" % fileName)
+    owners = dict(zip(indices, data[ownersStart:ownersStart + ownedCount]))
+    stockOwners = data[ownersStart + ownedCount:stocksStart]
+    return owners, dict((owner, list(stocks[i * yieldCount:(i + 1) * yieldCount]))
+        for i, owner in enumerate(stockOwners))
+
+
+def readDelta(diff, count, fileName):
+    """
+    Returns the indices, terrain and resources of the tiles in a DIFF section,
+    checked to be tiles of a map of count tiles.
+    """
+    changedCount, = DIFF.unpack_from(diff)
+    data = zlib.decompress(diff[DIFF.size:])
+    changed = array('I')
+    offset = changedCount * changed.itemsize
+    if len(data) != offset + 2 * changedCount:
+        raise SaveFileError("%s has tile changes of the wrong size" % fileName)
+    changed.frombytes(data[:offset])
+    if sys.byteorder != 'little':
+        changed.byteswap()
+    if changedCount and max(changed) >= count:
+        raise SaveFileError("%s changes tiles outside the map" % fileName)
+    return changed, data[offset:offset + changedCount], data[offset + changedCount:]
+
+
+def openMapFile(mapFileName, width, height):
+    """
+    Opens the map file of a streamed map to write loaded layers back into it,
+    positioned at its terrain layer, after checking it is the map the game was saved on.
+    """
+    mapFile = open(mapFileName, 'r+b')
+    try:
+        layers, fileWidth, fileHeight = mapfile.parseHeader(mapFile.read(mapfile.HEADER.size), mapFileName)
+    except mapfile.MapFileError:
+        mapFile.close()
+        raise
+    if (fileWidth, fileHeight) != (width, height) or not layers & mapfile.LAYER_RESOURCES:
+        mapFile.close()
+        raise SaveFileError("%s is not the map the game was saved on" % mapFileName)
+    return mapFile
+
+
+def packSection(tag, data):
+    return SECTION.pack(tag, len(data)) + data
+
+
+def readSections(data, fileName, kind):
+    """
+    Checks the header of a save file's data.
+    Returns (saveId, dict of tag: section data).
+    """
+    if len(data) < HEADER.size:
+        raise SaveFileError("%s is too short to be a save file" % fileName)
+    magic, version, fileKind, saveId = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SaveFileError("%s is not a save file" % fileName)
+    if version != SAVE_VERSION:
+        raise SaveFileError("%s has save version %d, expected %d" % (fileName, version, SAVE_VERSION))
+    if fileKind != kind:
+        raise SaveFileError("%s is not a %s" % (fileName, "snapshot" if kind == SNAPSHOT else "delta save"))
+    sections = {}
+    offset = HEADER.size
+    while offset < len(data):
+        tag, length = SECTION.unpack_from(data, offset)
+        offset += SECTION.size
+        if offset + length > len(data):
+            raise SaveFileError("%s is truncated" % fileName)
+        sections[tag] = data[offset:offset + length]
+        offset += length
+    return saveId, sections
+
+
+def writeFile(fileName, kind, saveId, sections):
+    """
+    Writes a save file next to fileName and then moves it in place,
+    so a crash mid-save never leaves a broken file behind.
+    """
+    temporary = fileName + ".tmp"
+    with open(temporary, 'wb') as saveFile:
+        saveFile.write(HEADER.pack(MAGIC, SAVE_VERSION, kind, saveId))
+        for tag, data in sections:
+            saveFile.write(packSection(tag, data))
+    os.replace(temporary, fileName)
+
+
+def writeSnapshot(fileName, saveId, game, entities, owners, width, height, layers, mapFileName = None):
+    """
+    Compresses and writes a snapshot, and removes the delta of the one it replaces.
+    owners is packYields() bytes, None without yields.
+    layers is TileMap.copyLayers(), compressed piece by piece.
+    mapFileName is the map file of a streamed map.
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL)
+    pieces = [compressor.compress(piece) for piece in layers]
+    pieces.append(compressor.flush())
+    tiles = TILES.pack(width, height) + b''.join(pieces)
+    sections = [(b'GAME', game), (b'TILE', tiles), (b'ENTS', writeEntities(entities))]
+    if owners is not None:
+        sections.append((b'YLDS', writeYields(owners)))
+    if mapFileName is not None:
+        sections.append((b'STRM', os.fsencode(mapFileName)))
+    writeFile(fileName, SNAPSHOT, saveId, sections)
+    if os.path.exists(deltaFileName(fileName)):
+        os.remove(deltaFileName(fileName))
+
+
+def writeDelta(fileName, saveId, game, entities, owners, indices, terrain, resources):
+    """
+    Compresses and writes a delta save of the snapshot saveId.
+    """
+    if sys.byteorder != 'little':
+        indices.byteswap()
+    diff = DIFF.pack(len(terrain)) + zlib.compress(indices.tobytes() + terrain + resources, COMPRESS_LEVEL)
+    sections = [(b'GAME', game), (b'DIFF', diff), (b'ENTS', writeEntities(entities))]
+    if owners is not None:
+        sections.append((b'YLDS', writeYields(owners)))
+    writeFile(deltaFileName(fileName), DELTA, saveId, sections)
+
+
+def load(fileName):
+    """
+    Reads a snapshot and its delta save, if there is one for it.
+    Returns a SaveData.
+    """
+    with open(fileName, 'rb') as saveFile:
+        saveId, sections = readSections(saveFile.read(), fileName, SNAPSHOT)
+    if b'GAME' not in sections or b'TILE' not in sections:
+        raise SaveFileError("%s is missing game or tile data" % fileName)
+    game = sections[b'GAME']
+    entities = sections.get(b'ENTS')
+    owners = sections.get(b'YLDS')
+    width, height = TILES.unpack_from(sections[b'TILE'])
+    count = width * height
+    layers = zlib.decompress(sections[b'TILE'][TILES.size:])
+    if len(layers) != 2 * count:
+        raise SaveFileError("%s has tile data of the wrong size" % fileName)
+    terrain = array('B', layers[:count])
+    resources = array('B', layers[count:])
+    changed = array('I')
+    if os.path.exists(deltaFileName(fileName)):
+        with open(deltaFileName(fileName), 'rb') as deltaFile:
+            deltaId, deltaSections = readSections(deltaFile.read(), deltaFileName(fileName), DELTA)
+        # a delta left over from an older snapshot does not apply
+        if deltaId == saveId and b'DIFF' in deltaSections:
+            game = deltaSections.get(b'GAME', game)
+            entities = deltaSections.get(b'ENTS', entities)
+            owners = deltaSections.get(b'YLDS', owners)
+            changed, changedTerrain, changedResources = readDelta(deltaSections[b'DIFF'], count,
+                deltaFileName(fileName))
+            for index, tileId, recId in zip(changed, changedTerrain, changedResources):
+                terrain[index] = tileId
+                resources[index] = recId
+    seed, camerax, cameray, zoomLevel, stateCount = GAME.unpack_from(game)
+    states = list(game[GAME.size:GAME.size + stateCount])
+    owners, stocks = unpackYields(owners, count, fileName) if owners is not None else (None, None)
+    mapFileName = os.fsdecode(sections[b'STRM']) if b'STRM' in sections else None
+    return SaveData(saveId, seed if seed >= 0 else None, (camerax, cameray), zoomLevel, states,
+        width, height, terrain, resources, changed,
+        unpackEntities(entities, fileName) if entities is not None else None, owners, stocks, mapFileName)
+
+
+class SaveWriter(threading.Thread):
+    """
+    Background thread that compresses and writes save files in the order they were asked for.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name = "SaveWriter")
+        self.daemon = True
+        # (function, arguments) to call, None to stop
+        self.jobs = queue.Queue()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            function, arguments = job
+            try:
+                function(*arguments)
+            except Exception:
+                # a failed save must not stop the ones after it
+                logging.exception("writing a save file failed")
+            self.jobs.task_done()
+
+    def write(self, function, *arguments):
+        self.jobs.put((function, arguments))
+
+    def flush(self):
+        """
+        Waits until every save asked for so far is written.
+        """
+        self.jobs.join()
+
+    def stop(self):
+        """
+        Writes every save asked for so far and stops the thread.
+        """
+        self.jobs.put(None)
+        self.join()
+
+
+class SaveManager(object):
+    """
+    Saves and loads the game, and autosaves it every AUTOSAVE_TICKS ticks.
+    """
+
+    def __init__(self, evManager, model, fileName = SAVE_FILE_NAME, autosaveTicks = AUTOSAVE_TICKS, economy = None):
+        """
+        evManager (EventManager): Allows posting messages to the event queue.
+        model (GameEngine): a strong reference to the game Model.
+        fileName (str): snapshot file, the delta save is next to it.
+        autosaveTicks (int): ticks between autosaves, 0 for none.
+        economy (YieldEngine): the yields whose tile owners and stocks are saved, if any.
+
+        Attributes:
+        saveId (int): id of the last snapshot, None if the map has none yet.
+        tileMap (TileMap): the map saveId is a snapshot of.
+        changed (set): indices of the tiles changed since the snapshot.
+        tilesChanged (bool): tiles changed since the last save or load.
+        savedEntities (bytes): packEntities() of the entities as last saved or loaded.
+        savedOwners (dict): the tile owners as last saved or loaded.
+        """
+        self.evManager = evManager
+        evManager.Subscribe(TickEvent, self.onTick)
+        evManager.Subscribe(TileChangeEvent, self.onTileChange)
+        evManager.Subscribe(SaveEvent, self.onSave)
+        evManager.Subscribe(LoadEvent, self.onLoad)
+        evManager.Subscribe(QuitEvent, self.onQuit)
+        self.model = model
+        self.fileName = fileName
+        self.autosaveTicks = autosaveTicks
+        self.ticks = 0
+        self.saveId = None
+        self.tileMap = None
+        self.changed = set()
+        self.economy = economy
+        self.tilesChanged = False
+        self.savedEntities = packEntities(model.entities)
+        self.savedOwners = {}
+        self.writer = SaveWriter()
+        self.writer.start()
+
+    def onTick(self, event):
+        """
+        Called for each simulation tick. Autosaves while playing, if anything changed.
+        """
+        self.ticks += 1
+        if (self.autosaveTicks and self.ticks % self.autosaveTicks == 0
+                and self.model.state.peek() == model.STATE_PLAY and self.hasUnsavedChanges()):
+            self.save()
+
+    def onTileChange(self, event):
+        """
+        Called by a TileChangeEvent in the message queue. Remembers the tiles for the next delta save.
+        """
+        tileMap = self.model.tileMap
+        self.tilesChanged = True
+        if tileMap is self.tileMap:
+            self.changed.update(row * tileMap.width + col for col, row in event.positions
+                if 0 <= col < tileMap.width and 0 <= row < tileMap.height)
+
+    def onSave(self, event):
+        if self.model.tileMap is not None:
+            self.save(event.full)
+
+    def onLoad(self, event):
+        # a save still being written would be read half old
+        self.writer.flush()
+        if os.path.exists(self.fileName):
+            self.restore(load(self.fileName))
+
+    def onQuit(self, event):
+        """
+        Called by a QuitEvent in the message queue. Saves the game if anything changed
+        and waits for the writes to finish.
+        """
+        if self.model.tileMap is not None and self.hasUnsavedChanges():
+            self.save()
+        self.writer.stop()
+
+    def hasUnsavedChanges(self):
+        """
+        Returns True if tiles, entities or tile owners changed since the last save or load.
+        The camera moving alone is not worth a save.
+        """
+        return (self.tilesChanged or packEntities(self.model.entities) != self.savedEntities
+            or (self.economy is not None and self.economy.getOwners() != self.savedOwners))
+
+    def save(self, full = False):
+        """
+        Saves the game in the background: a delta save of the tiles changed since
+        the last snapshot, or a new snapshot if full is True, the map is not the
+        snapshot's, or too many tiles changed for a delta to be worth it.
+        """
+        tileMap = self.model.tileMap
+        game = packGame(self.model)
+        entities = packEntities(self.model.entities)
+        owners = packYields(self.economy) if self.economy is not None else None
+        count = len(tileMap)
+        if full or tileMap is not self.tileMap or len(self.changed) > count * SNAPSHOT_FRACTION:
+            self.saveId = random.getrandbits(63)
+            self.tileMap = tileMap
+            self.changed = set()
+            mapFileName = tileMap.fileName if isinstance(tileMap, streaming.StreamingTileMap) else None
+            # copying the layers is all the game thread does, the writer compresses them
+            self.writer.write(writeSnapshot, self.fileName, self.saveId, game, entities, owners,
+                tileMap.width, tileMap.height, tileMap.copyLayers(), mapFileName)
+        else:
+            indices = array('I', sorted(self.changed))
+            terrain = bytes(tileMap.terrain[index] for index in indices)
+            resources = bytes(tileMap.resources[index] for index in indices)
+            self.writer.write(writeDelta, self.fileName, self.saveId, game, entities, owners, indices, terrain, resources)
+        self.tilesChanged = False
+        self.savedEntities = entities
+        if self.economy is not None:
+            self.savedOwners = self.economy.getOwners()
+
+    def restore(self, saveData):
+        """
+        Puts a loaded game into the model: its map, entities, tile owners, camera and states.
+        A streamed map gets the loaded tiles written back into its map file and is streamed again.
+        """
+        gameModel = self.model
+        if saveData.mapFileName is not None:
+            tileSize = gameModel.tileMap.tileSize if gameModel.tileMap is not None else 32
+            with openMapFile(saveData.mapFileName, saveData.width, saveData.height) as mapFile:
+                # the map may be streaming the file, its changed chunks are saved into it on close
+                gameModel.setTileMap(None)
+                mapFile.write(saveData.terrain)
+                mapFile.write(saveData.resources)
+            tileMap = streaming.StreamingTileMap(saveData.mapFileName, tileSize)
+        else:
+            tileMap = model.TileMap(saveData.width, saveData.height, saveData.terrain, saveData.resources)
+        gameModel.setTileMap(tileMap, saveData.seed)
+        if saveData.entities is not None:
+            gameModel.entities.setArrays(saveData.entities)
+        if self.economy is not None and saveData.owners is not None:
+            self.economy.restore(saveData.owners, saveData.stocks)
+        camera = gameModel.camera
+        camera.setZoom(saveData.zoomLevel)
+        camera.rect.topleft = saveData.cameraPos
+        camera.savePosition()
+        # a game saved on quit has left every state, start it from the menu
+        gameModel.state.statestack = list(saveData.states) or [model.STATE_MENU]
+        # later delta saves still build on the loaded snapshot
+        self.saveId = saveData.saveId
+        self.tileMap = tileMap
+        self.changed = set(saveData.changed)
+        self.tilesChanged = False
+        self.savedEntities = packEntities(gameModel.entities)
+        self.savedOwners = dict(saveData.owners or {})
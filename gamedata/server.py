@@ -0,0 +1,693 @@
+"""
+Authoritative simulation server: runs the model headless and replicates it to clients over TCP.
+
+Every message is a FRAME header, the length of its body and its type, followed by the body.
+
+Clients send:
+    MSG_CAMERA  x i, y i, width I, height I   camera rect in map pixels, tiles inside it are replicated
+    MSG_INPUT   click B, x i, y i, length H   an InputEvent, then its char in UTF-8 (click 0 for no clickpos)
+    MSG_STATE   state B                       a StateChangeEvent of the client's screens, 0 pops
+
+The server sends:
+    MSG_WELCOME clientId I, width I, height I, tileSize H, tickRate H
+    MSG_UPDATE  tick I, sentTime d, flags B, firstCol I, firstRow I, endCol I, endRow I (the tile
+                range of the client's camera), regions H, changes I, entityTiles I, entities I,
+                then the region headers (firstCol I, firstRow I, cols I, rows I) and a payload
+                (zlib compressed if flags has COMPRESSED): every region's terrain then resources
+                row by row, then the changed tiles' indices (I), terrain and resources, then the
+                indices (I) of the tiles whose entities changed and the ENTITY records of the
+                entities on the regions and those tiles.
+
+An update goes out to every client after every tick. It only holds the tiles of the
+client's camera it did not have yet, as regions, and the tiles in it that changed that
+tick, so a client that holds still only gets a small header. Entities with a position,
+see ecs.py, go along the same way: the client replaces the entities of every region and
+listed tile with the records sent, or all of its entities if flags has ENTITY_RESET,
+and drops the entities its camera left, which are no longer kept up to date.
+Their ids are the client's own. State changes are per client: they are the screens it
+shows, popping its last one disconnects it.
+
+Run a server, or the load test with many local clients, from the gamedata folder with:
+
+    python server.py serve [map] [port]
+    python server.py loadtest [clients] [seconds]
+"""
+import asyncio
+import logging
+import random
+import statistics
+import struct
+import sys
+import time
+import zlib
+from array import array
+import ecs
+import eventmanager
+import mapgen
+import model
+import pygame
+import yields
+from eventmanager import *
+
+DEFAULT_MAP = "assets/maps/classic-medium.csv"
+DEFAULT_PORT = 7777
+TICK_RATE = 30
+
+FRAME = struct.Struct('<IB')
+# client messages
+MSG_CAMERA = 1
+MSG_INPUT = 2
+MSG_STATE = 3
+CAMERA = struct.Struct('<iiII')
+INPUT = struct.Struct('<BiiH')
+STATE = struct.Struct('<B')
+# server messages
+MSG_WELCOME = 16
+MSG_UPDATE = 17
+WELCOME = struct.Struct('<IIIHH')
+UPDATE = struct.Struct('<IdBIIIIHIII')
+REGION = struct.Struct('<IIII')
+# col, row, component mask, owner, structure, rate, health, maxHealth
+ENTITY = struct.Struct('<iiBBBHHH')
+
+# update flags
+COMPRESSED = 1
+# too many entities changed to list their tiles, the client drops every entity it has
+ENTITY_RESET = 2
+# payloads shorter than this are sent as they are, zlib would only make them longer
+COMPRESS_MIN = 64
+# clients that fall this many bytes behind are disconnected
+MAX_BUFFERED = 1 << 20
+
+
+def subtractRange(newRange, oldRange):
+    """
+    Returns the tile ranges (firstCol, firstRow, endCol, endRow) covering
+    the tiles of newRange that are not in oldRange (which may be None).
+    """
+    firstCol, firstRow, endCol, endRow = newRange
+    if firstCol >= endCol or firstRow >= endRow:
+        return []
+    if oldRange is None:
+        return [newRange]
+    left = max(firstCol, oldRange[0])
+    top = max(firstRow, oldRange[1])
+    right = min(endCol, oldRange[2])
+    bottom = min(endRow, oldRange[3])
+    if left >= right or top >= bottom:
+        return [newRange]
+    ranges = []
+    if firstRow < top:
+        ranges.append((firstCol, firstRow, endCol, top))
+    if bottom < endRow:
+        ranges.append((firstCol, bottom, endCol, endRow))
+    if firstCol < left:
+        ranges.append((firstCol, top, left, bottom))
+    if right < endCol:
+        ranges.append((right, top, endCol, bottom))
+    return ranges
+
+
+def inRange(index, width, tileRange):
+    row, col = divmod(index, width)
+    return tileRange[0] <= col < tileRange[2] and tileRange[1] <= row < tileRange[3]
+
+
+def packIndices(indices):
+    """
+    Returns an array of tile indices as little endian bytes.
+    """
+    if sys.byteorder != 'little':
+        indices = array('I', indices)
+        indices.byteswap()
+    return indices.tobytes()
+
+
+def packFrame(msgType, body):
+    return FRAME.pack(len(body), msgType) + body
+
+
+def packEntities(entities, width, entityRanges, entityTiles):
+    """
+    Returns the ENTITY records of the entities in the tile ranges entityRanges
+    and on the tiles of the indices entityTiles, in a map width tiles wide.
+    """
+    found = []
+    for tileRange in entityRanges:
+        found.extend(entities.getEntitiesInRange(tileRange))
+    for index in entityTiles:
+        row, col = divmod(index, width)
+        found.extend(entities.getEntitiesAt(col, row))
+    return b''.join(ENTITY.pack(entities.cols[entity], entities.rows[entity], entities.masks[entity],
+        entities.owners[entity], entities.structures[entity], entities.rates[entity],
+        entities.health[entity], entities.maxHealth[entity]) for entity in found)
+
+
+def packUpdate(tick, sentTime, tileMap, tileRange, regions, changes, entities, entityRanges, entityTiles, flags = 0):
+    """
+    Returns the MSG_UPDATE frame of one tick for a client whose camera covers tileRange: the tiles of the regions and the
+    changed tiles, given as a sorted array of indices, and the entities in the tile
+    ranges entityRanges and on the tiles entityTiles, given the same way.
+    flags may hold ENTITY_RESET.
+    """
+    width = tileMap.width
+    headers = []
+    payload = []
+    for firstCol, firstRow, endCol, endRow in regions:
+        headers.append(REGION.pack(firstCol, firstRow, endCol - firstCol, endRow - firstRow))
+        for layer in (tileMap.terrain, tileMap.resources):
+            for row in range(firstRow, endRow):
+                payload.append(bytes(layer[row * width + firstCol:row * width + endCol]))
+    if changes:
+        payload.append(packIndices(changes))
+        payload.append(bytes(tileMap.terrain[index] for index in changes))
+        payload.append(bytes(tileMap.resources[index] for index in changes))
+    records = packEntities(entities, width, entityRanges, entityTiles)
+    if entityTiles:
+        payload.append(packIndices(entityTiles))
+    payload.append(records)
+    payload = b''.join(payload)
+    if len(payload) >= COMPRESS_MIN:
+        payload = zlib.compress(payload, 1)
+        flags |= COMPRESSED
+    body = (UPDATE.pack(tick, sentTime, flags, *tileRange, len(regions), len(changes), len(entityTiles),
+        len(records) // ENTITY.size) + b''.join(headers) + payload)
+    return packFrame(MSG_UPDATE, body)
+
+
+class ClientSession(object):
+    """
+    Server side of one connected client.
+    """
+
+    def __init__(self, clientId, reader, writer):
+        """
+        Attributes:
+        cameraRect (Rect): the client's camera, None until it sends one.
+        state (StateMachine): the screens the client shows.
+        sentRange (tuple): tile range of the camera the client has every tile of.
+        """
+        self.clientId = clientId
+        self.reader = reader
+        self.writer = writer
+        self.cameraRect = None
+        self.state = model.StateMachine()
+        self.sentRange = None
+        self.bytesSent = 0
+
+    def send(self, data):
+        self.writer.write(data)
+        self.bytesSent += len(data)
+
+
+class GameServer(object):
+    """
+    Runs the model's ticks and replicates its tiles to the connected clients.
+    """
+
+    def __init__(self, evManager, model, host = '127.0.0.1', port = DEFAULT_PORT):
+        """
+        evManager (EventManager): a queued EventManager, pumped every tick.
+        model (GameEngine): a strong reference to the game Model, with a tileMap.
+        port (int): port to listen on, 0 picks a free one.
+
+        Attributes:
+        changed (set): indices of the tiles changed during the current tick.
+        sessions (dict): clientId: ClientSession of every connected client.
+        tickTimes (list): seconds every tick took to run and broadcast.
+        economy (YieldEngine): the yields of the model's tiles.
+        """
+        self.evManager = evManager
+        evManager.Subscribe(TileChangeEvent, self.onTileChange)
+        self.model = model
+        self.economy = yields.YieldEngine(evManager, model)
+        self.host = host
+        self.port = port
+        self.server = None
+        self.running = False
+        self.tick = 0
+        self.changed = set()
+        self.sessions = {}
+        self.nextClientId = 1
+        self.tickTimes = []
+
+    def onTileChange(self, event):
+        """
+        Called by a TileChangeEvent in the message queue. Remembers the tiles for this tick's updates.
+        """
+        tileMap = self.model.tileMap
+        self.changed.update(row * tileMap.width + col for col, row in event.positions
+            if 0 <= col < tileMap.width and 0 <= row < tileMap.height)
+
+    async def start(self):
+        """
+        Starts listening for clients. The port picked is kept in port.
+        """
+        self.server = await asyncio.start_server(self.onConnect, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def run(self, ticks = None):
+        """
+        Runs the simulation at the model's tick rate until stop() is called,
+        or for ticks ticks if given.
+        """
+        scheduler = self.model.scheduler
+        scheduler.start(time.perf_counter())
+        self.running = True
+        endTick = self.tick + ticks if ticks is not None else None
+        while self.running:
+            due, render = scheduler.advance(time.perf_counter())
+            for i in range(due):
+                self.step()
+                if self.tick == endTick:
+                    self.running = False
+                    break
+            await asyncio.sleep(max(0.0, scheduler.timeUntilDue(time.perf_counter())))
+
+    def stop(self):
+        self.running = False
+
+    def step(self):
+        """
+        Runs one tick of the model and sends every client its update.
+        """
+        start = time.perf_counter()
+        self.tick += 1
+        self.evManager.Post(TickEvent())
+        self.evManager.Pump(PUMP_LIMIT)
+        self.broadcast(start)
+        self.tickTimes.append(time.perf_counter() - start)
+
+    def broadcast(self, sentTime):
+        """
+        Sends every client the tiles of its camera it does not have yet
+        and the ones in it that changed this tick, with their entities.
+        """
+        tileMap = self.model.tileMap
+        changes = sorted(self.changed)
+        self.changed = set()
+        entityChanges = self.model.entities.popChangedTiles()
+        if entityChanges is not None:
+            entityChanges = sorted(row * tileMap.width + col for col, row in entityChanges
+                if 0 <= col < tileMap.width and 0 <= row < tileMap.height)
+        for session in list(self.sessions.values()):
+            if session.writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+                logging.warning("client %d is too far behind, disconnecting it" % session.clientId)
+                self.drop(session)
+                continue
+            if session.cameraRect is None:
+                continue
+            oldRange = session.sentRange
+            newRange = tileMap.getTileRange(session.cameraRect)
+            session.sentRange = newRange
+            regions = subtractRange(newRange, oldRange)
+            # tiles that are new to the client are in the regions already
+            seen = [index for index in changes if inRange(index, tileMap.width, newRange)
+                and (oldRange is None or inRange(index, tileMap.width, oldRange))]
+            if entityChanges is None:
+                session.send(packUpdate(self.tick, sentTime, tileMap, newRange, regions, array('I', seen),
+                    self.model.entities, [newRange], array('I'), ENTITY_RESET))
+                continue
+            seenEntities = [index for index in entityChanges if inRange(index, tileMap.width, newRange)
+                and (oldRange is None or inRange(index, tileMap.width, oldRange))]
+            session.send(packUpdate(self.tick, sentTime, tileMap, newRange, regions, array('I', seen),
+                self.model.entities, regions, array('I', seenEntities)))
+
+    async def onConnect(self, reader, writer):
+        """
+        Serves one client: welcomes it, then handles its messages until it leaves.
+        """
+        session = ClientSession(self.nextClientId, reader, writer)
+        self.nextClientId += 1
+        self.sessions[session.clientId] = session
+        tileMap = self.model.tileMap
+        session.send(packFrame(MSG_WELCOME, WELCOME.pack(session.clientId, tileMap.width, tileMap.height,
+            tileMap.tileSize, int(round(1.0 / self.model.scheduler.tickTime)))))
+        try:
+            while session.clientId in self.sessions:
+                length, msgType = FRAME.unpack(await reader.readexactly(FRAME.size))
+                self.handleMessage(session, msgType, await reader.readexactly(length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (struct.error, zlib.error, ValueError) as error:
+            # a message that doesn't parse, the client is broken or hostile
+            logging.warning("client %d sent a bad message, disconnecting it: %s" % (session.clientId, error))
+        finally:
+            self.drop(session)
+
+    def handleMessage(self, session, msgType, body):
+        """
+        Applies a client message: a camera move, an InputEvent or a state change.
+        """
+        if msgType == MSG_CAMERA:
+            x, y, width, height = CAMERA.unpack(body)
+            session.cameraRect = pygame.Rect(x, y, width, height)
+        elif msgType == MSG_INPUT:
+            click, x, y, length = INPUT.unpack_from(body)
+            char = body[INPUT.size:INPUT.size + length].decode('utf-8')
+            self.evManager.Post(InputEvent(char, (x, y) if click else None))
+        elif msgType == MSG_STATE:
+            state, = STATE.unpack(body)
+            if state:
+                session.state.push(state)
+            elif not session.state.pop():
+                # the client left its last screen
+                self.drop(session)
+        else:
+            logging.warning("client %d sent unknown message type %d" % (session.clientId, msgType))
+
+    def drop(self, session):
+        """
+        Disconnects a client.
+        """
+        if self.sessions.pop(session.clientId, None) is not None:
+            session.writer.close()
+
+    async def close(self):
+        """
+        Stops listening and disconnects every client.
+        """
+        for session in list(self.sessions.values()):
+            self.drop(session)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class RemoteClient(object):
+    """
+    Client side of the protocol: sends the camera and actions, and keeps
+    a copy of the tiles of its camera from the updates.
+    """
+
+    def __init__(self):
+        """
+        Attributes:
+        tileMap (TileMap): the world as far as the server sent it.
+        entities (EntityStore): the entities on it as far as the server sent them.
+        tileRange (tuple): tile range of the camera as of the last update, None before one.
+        latencies (list): seconds from the start of each tick to its update arriving.
+        """
+        self.reader = None
+        self.writer = None
+        self.clientId = None
+        self.tileMap = None
+        self.entities = ecs.EntityStore()
+        self.tileRange = None
+        self.tick = 0
+        self.latencies = []
+        self.bytesReceived = 0
+
+    async def connect(self, host, port):
+        """
+        Connects to a server and reads its welcome.
+        """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        msgType, body = await self.read()
+        clientId, width, height, tileSize, tickRate = WELCOME.unpack(body)
+        self.clientId = clientId
+        self.tileMap = model.TileMap(width, height, tileSize = tileSize)
+
+    def send(self, msgType, body):
+        self.writer.write(packFrame(msgType, body))
+
+    def sendCamera(self, rect):
+        self.send(MSG_CAMERA, CAMERA.pack(rect.x, rect.y, rect.width, rect.height))
+
+    def sendInput(self, char, clickpos = None):
+        text = char.encode('utf-8')
+        x, y = clickpos if clickpos is not None else (0, 0)
+        self.send(MSG_INPUT, INPUT.pack(clickpos is not None, x, y, len(text)) + text)
+
+    def sendState(self, state):
+        """
+        Sends a StateChangeEvent, state None pops.
+        """
+        self.send(MSG_STATE, STATE.pack(state or 0))
+
+    async def read(self):
+        """
+        Returns (msgType, body) of the next message.
+        """
+        header = await self.reader.readexactly(FRAME.size)
+        length, msgType = FRAME.unpack(header)
+        body = await self.reader.readexactly(length)
+        self.bytesReceived += FRAME.size + length
+        return msgType, body
+
+    async def receive(self):
+        """
+        Reads and applies the next message. Returns its type, or None once the server closed the connection.
+        """
+        try:
+            msgType, body = await self.read()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        if msgType == MSG_UPDATE:
+            self.applyUpdate(body)
+        return msgType
+
+    def applyUpdate(self, body):
+        """
+        Writes the tiles of an update into tileMap, and its entities into entities.
+        """
+        received = time.perf_counter()
+        (tick, sentTime, flags, firstCol, firstRow, endCol, endRow,
+            regionCount, changeCount, entityTileCount, entityCount) = UPDATE.unpack_from(body)
+        tileRange = (firstCol, firstRow, endCol, endRow)
+        self.tick = tick
+        self.latencies.append(received - sentTime)
+        offset = UPDATE.size
+        regions = []
+        for i in range(regionCount):
+            regions.append(REGION.unpack_from(body, offset))
+            offset += REGION.size
+        payload = body[offset:]
+        if flags & COMPRESSED:
+            payload = zlib.decompress(payload)
+        tileMap = self.tileMap
+        width = tileMap.width
+        offset = 0
+        for firstCol, firstRow, cols, rows in regions:
+            for layer in (tileMap.terrain, tileMap.resources):
+                for row in range(firstRow, firstRow + rows):
+                    layer[row * width + firstCol:row * width + firstCol + cols] = array('B', payload[offset:offset + cols])
+                    offset += cols
+        if changeCount:
+            indices = array('I', payload[offset:offset + 4 * changeCount])
+            if sys.byteorder != 'little':
+                indices.byteswap()
+            offset += 4 * changeCount
+            for index, tileId, recId in zip(indices, payload[offset:offset + changeCount],
+                                            payload[offset + changeCount:offset + 2 * changeCount]):
+                tileMap.terrain[index] = tileId
+                tileMap.resources[index] = recId
+            offset += 2 * changeCount
+        entities = self.entities
+        if flags & ENTITY_RESET:
+            entities.clear()
+        else:
+            # the entities the camera left would go stale
+            if self.tileRange is not None:
+                for leftRange in subtractRange(self.tileRange, tileRange):
+                    for entity in entities.getEntitiesInRange(leftRange):
+                        entities.destroy(entity)
+            for firstCol, firstRow, cols, rows in regions:
+                for entity in entities.getEntitiesInRange((firstCol, firstRow, firstCol + cols, firstRow + rows)):
+                    entities.destroy(entity)
+        if entityTileCount:
+            indices = array('I', payload[offset:offset + 4 * entityTileCount])
+            if sys.byteorder != 'little':
+                indices.byteswap()
+            offset += 4 * entityTileCount
+            for index in indices:
+                row, col = divmod(index, width)
+                for entity in entities.getEntitiesAt(col, row):
+                    entities.destroy(entity)
+        for i in range(entityCount):
+            col, row, mask, owner, structure, rate, health, maxHealth = ENTITY.unpack_from(payload, offset)
+            offset += ENTITY.size
+            entity = entities.create(col, row, owner if mask & ecs.OWNER else None,
+                structure if mask & ecs.STRUCTURE else None, rate if mask & ecs.PRODUCTION else None)
+            if mask & ecs.HEALTH:
+                entities.setHealth(entity, health, maxHealth)
+        self.tileRange = tileRange
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+def createServer(mapFileName = DEFAULT_MAP, port = DEFAULT_PORT, seed = None, tickRate = TICK_RATE):
+    """
+    Returns a GameServer running a headless model on mapFileName.
+    """
+    evManager = eventmanager.EventManager(queued = True)
+    gameModel = model.GameEngine(evManager, tickRate, tickRate)
+    gameModel.tileMap, gameModel.seed = mapgen.loadTileMap(mapFileName, seed)
+    return GameServer(evManager, gameModel, port = port)
+
+
+async def serve(mapFileName = DEFAULT_MAP, port = DEFAULT_PORT):
+    """
+    Runs a server until it is interrupted.
+    """
+    server = createServer(mapFileName, port)
+    await server.start()
+    print("serving %s on port %d" % (mapFileName, server.port))
+    try:
+        await server.run()
+    finally:
+        await server.close()
+
+
+# LOAD TEST
+class RandomChanges(object):
+    """
+    Stands in for players changing the world: changes random tiles every tick,
+    and builds, moves, damages and destroys random entities.
+    """
+
+    def __init__(self, evManager, model, perTick, seed = 1):
+        self.evManager = evManager
+        evManager.Subscribe(TickEvent, self.onTick)
+        self.model = model
+        self.perTick = perTick
+        self.random = random.Random(seed)
+
+    def onTick(self, event):
+        tileMap = self.model.tileMap
+        for i in range(self.perTick):
+            self.model.changeTile(self.random.randrange(tileMap.width), self.random.randrange(tileMap.height),
+                self.random.choice((model.GRASSLAND, model.PLAINS, model.DESERT)),
+                self.random.choice((0, model.WHEAT)))
+        entities = self.model.entities
+        rng = self.random
+        entities.create(rng.randrange(tileMap.width), rng.randrange(tileMap.height), owner = rng.randrange(1, 9),
+            structure = rng.choice((ecs.FARM, ecs.MINE, ecs.TOWN)), rate = rng.randrange(1, 4), health = 100)
+        placed = list(entities.query(ecs.POSITION | ecs.HEALTH))
+        entity = rng.choice(placed)
+        entities.setPosition(entity, rng.randrange(tileMap.width), rng.randrange(tileMap.height))
+        entities.setHealth(rng.choice(placed), rng.randrange(1, 100))
+        if rng.random() < 0.5:
+            entities.destroy(rng.choice(placed))
+
+
+async def simulateClient(client, rng, mapRect):
+    """
+    Plays a client: starts somewhere on the map, then pans its camera now and then
+    and sends a few inputs and state changes, until the server disconnects it.
+    """
+    camera = pygame.Rect(0, 0, model.SCREEN_WIDTH + 32, model.SCREEN_HEIGHT + 32)
+    camera.center = (rng.randrange(mapRect.width), rng.randrange(mapRect.height))
+    client.sendState(model.STATE_MENU)
+    client.sendState(model.STATE_PLAY)
+    client.sendCamera(camera)
+    step = 16
+    direction = rng.choice(((step, 0), (-step, 0), (0, step), (0, -step)))
+    while True:
+        msgType = await client.receive()
+        if msgType is None:
+            break
+        if msgType != MSG_UPDATE:
+            continue
+        if client.tick % 60 == 0:
+            direction = rng.choice(((step, 0), (-step, 0), (0, step), (0, -step)))
+        if client.tick % 2 == 0:
+            camera.move_ip(direction)
+            camera.clamp_ip(mapRect.inflate(64, 64))
+            client.sendCamera(camera)
+        if rng.random() < 0.01:
+            client.sendInput('b', camera.center)
+
+
+async def loadTest(clients = 200, seconds = 10.0, mapFileName = DEFAULT_MAP, changesPerTick = 20):
+    """
+    Runs a server and clients local clients against it for seconds seconds.
+    Prints the tick times, the latency from the start of a tick to its update
+    arriving, the bandwidth sent and whether the clients' tiles and entities match the server's.
+    """
+    server = createServer(mapFileName, port = 0, seed = 1)
+    changes = RandomChanges(server.evManager, server.model, changesPerTick)
+    await server.start()
+    tileMap = server.model.tileMap
+    mapRect = pygame.Rect(0, 0, tileMap.width * tileMap.tileSize, tileMap.height * tileMap.tileSize)
+    remotes = [RemoteClient() for i in range(clients)]
+    for remote in remotes:
+        await remote.connect('127.0.0.1', server.port)
+    rng = random.Random(1)
+    tasks = [asyncio.ensure_future(simulateClient(remote, random.Random(rng.random()), mapRect)) for remote in remotes]
+    ticks = int(seconds * TICK_RATE)
+    start = time.perf_counter()
+    await server.run(ticks)
+    elapsed = time.perf_counter() - start
+    # let the clients read the last updates before they are disconnected
+    while any(remote.tick < server.tick for remote in remotes if not remote.reader.at_eof()):
+        await asyncio.sleep(0.01)
+    sessions = list(server.sessions.values())
+    remotesById = dict((remote.clientId, remote) for remote in remotes)
+    consistent = sum(1 for session in sessions
+        if replicaMatches(remotesById[session.clientId], server.model, session.sentRange))
+    bytesSent = sum(session.bytesSent for session in sessions)
+    await server.close()
+    await asyncio.gather(*tasks)
+    for remote in remotes:
+        await remote.close()
+    ms = 1000.0
+    tickTimes = statistics.quantiles(server.tickTimes, n = 100)
+    latencies = statistics.quantiles([latency for remote in remotes for latency in remote.latencies], n = 100)
+    print("server: %d clients  %d ticks in %.1f s (%.1f ticks/s)" % (clients, server.tick, elapsed, server.tick / elapsed))
+    print("%-12s tick p50 %7.3f  p95 %7.3f  max %7.3f ms" % (
+        "", tickTimes[49] * ms, tickTimes[94] * ms, max(server.tickTimes) * ms))
+    print("%-12s latency p50 %7.3f  p95 %7.3f  p99 %7.3f ms" % (
+        "", latencies[49] * ms, latencies[94] * ms, latencies[98] * ms))
+    print("%-12s sent %.1f KB/s  %.2f KB/s per client  replicas matching %d/%d" % (
+        "", bytesSent / elapsed / 1024, bytesSent / elapsed / 1024 / clients, consistent, len(sessions)))
+
+
+def describeEntities(entities, tileRange):
+    """
+    Returns the sorted components of the entities in tileRange, None for the ones they lack.
+    """
+    described = []
+    for entity in entities.getEntitiesInRange(tileRange):
+        mask = entities.masks[entity]
+        described.append((entities.cols[entity], entities.rows[entity], mask,
+            entities.owners[entity] if mask & ecs.OWNER else None,
+            entities.structures[entity] if mask & ecs.STRUCTURE else None,
+            entities.rates[entity] if mask & ecs.PRODUCTION else None,
+            (entities.health[entity], entities.maxHealth[entity]) if mask & ecs.HEALTH else None))
+    return sorted(described)
+
+
+def replicaMatches(remote, gameModel, tileRange):
+    """
+    Returns True if a client has the same tiles and entities as the server in tileRange.
+    """
+    if tileRange is None:
+        return True
+    tileMap = gameModel.tileMap
+    if describeEntities(gameModel.entities, tileRange) != describeEntities(remote.entities, tileRange):
+        return False
+    firstCol, firstRow, endCol, endRow = tileRange
+    for row in range(firstRow, endRow):
+        start = row * tileMap.width
+        for layer, remoteLayer in ((tileMap.terrain, remote.tileMap.terrain), (tileMap.resources, remote.tileMap.resources)):
+            if bytes(layer[start + firstCol:start + endCol]) != bytes(remoteLayer[start + firstCol:start + endCol]):
+                return False
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'serve':
+        asyncio.run(serve(sys.argv[2] if len(sys.argv) > 2 else DEFAULT_MAP,
+            int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PORT))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'loadtest':
+        asyncio.run(loadTest(int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+            float(sys.argv[3]) if len(sys.argv) > 3 else 10.0))
+    else:
+        print("usage: python server.py serve [map] [port] | loadtest [clients] [seconds]")
+        sys.exit(1)
@@ -0,0 +1,417 @@
+"""
+Streaming world: a TileMap that only keeps the chunks around the camera in memory.
+
+The map file is read and written a chunk at a time by a background loader thread.
+StreamingTileMap.streamAround() is called every tick with the camera rect. It asks the
+loader for the chunks near the camera and ahead of it in the direction it moves,
+adopts the chunks the loader has finished, and evicts chunks far from the camera,
+handing changed ones back to the loader to be saved to the map file.
+"""
+import threading
+import queue
+import mapfile
+import model
+
+# chunks are CHUNK_TILES by CHUNK_TILES tiles
+CHUNK_TILES = 64
+# chunks this far around the camera are loaded, chunks beyond EVICT_MARGIN are evicted
+RESIDENT_MARGIN = 1
+EVICT_MARGIN = 3
+# the camera's movement over this many ticks is prefetched ahead of it
+PREFETCH_TICKS = 30
+
+# index of each layer in Chunk.layers
+TERRAIN = 0
+RESOURCES = 1
+FLAGS = 2
+
+
+class Chunk(object):
+    """
+    The tiles of one chunk: a bytearray per layer, row by row.
+    dirty is True once terrain or resources changed since the chunk was loaded or saved.
+    """
+    __slots__ = ('layers', 'dirty')
+
+    def __init__ (self, terrain, resources, flags):
+        self.layers = [terrain, resources, flags]
+        self.dirty = False
+
+
+class MapFileSource(object):
+    """
+    Reads and writes square chunks of a binary map file in place.
+    The file must have terrain and resource layers, see mapgen.generateMapFile.
+    """
+
+    def __init__ (self, fileName):
+        self.mapFile = open(fileName, 'r+b')
+        layers, self.width, self.height = mapfile.parseHeader(self.mapFile.read(mapfile.HEADER.size), fileName)
+        if not layers & mapfile.LAYER_RESOURCES:
+            self.mapFile.close()
+            raise mapfile.MapFileError("%s has no resource layer to stream" % fileName)
+        # the loader thread and stalled loads on the main thread share the file
+        self.lock = threading.Lock()
+
+    def rowRanges(self, chunkCol, chunkRow, chunkTiles):
+        """
+        Yields (chunk offset, file offset, length) of each row of a chunk's terrain inside the map.
+        """
+        firstCol = chunkCol * chunkTiles
+        firstRow = chunkRow * chunkTiles
+        cols = min(chunkTiles, self.width - firstCol)
+        for row in range(min(chunkTiles, self.height - firstRow)):
+            yield row * chunkTiles, mapfile.HEADER.size + (firstRow + row) * self.width + firstCol, cols
+
+    def readChunk(self, chunkCol, chunkRow, chunkTiles):
+        """
+        Returns the Chunk at (chunkCol, chunkRow). Tiles past the map edge are 0.
+        """
+        count = chunkTiles * chunkTiles
+        chunk = Chunk(bytearray(count), bytearray(count), bytearray(count))
+        layerSize = self.width * self.height
+        with self.lock:
+            for start, offset, cols in self.rowRanges(chunkCol, chunkRow, chunkTiles):
+                for layer in (TERRAIN, RESOURCES):
+                    self.mapFile.seek(offset + layer * layerSize)
+                    chunk.layers[layer][start:start + cols] = self.mapFile.read(cols)
+        return chunk
+
+    def writeChunk(self, chunkCol, chunkRow, chunkTiles, chunk):
+        """
+        Writes the terrain and resources of a Chunk back to the map file.
+        """
+        layerSize = self.width * self.height
+        with self.lock:
+            for start, offset, cols in self.rowRanges(chunkCol, chunkRow, chunkTiles):
+                for layer in (TERRAIN, RESOURCES):
+                    self.mapFile.seek(offset + layer * layerSize)
+                    self.mapFile.write(chunk.layers[layer][start:start + cols])
+
+    def readBands(self, chunkTiles, chunks):
+        """
+        Yields the terrain and then the resource layer of the map file, a band of
+        chunkTiles rows at a time, with the tiles of chunks (key: Chunk) in place of the file's.
+        """
+        width = self.width
+        layerSize = width * self.height
+        for layer in (TERRAIN, RESOURCES):
+            for chunkRow in range(-(-self.height // chunkTiles)):
+                firstRow = chunkRow * chunkTiles
+                rows = min(chunkTiles, self.height - firstRow)
+                with self.lock:
+                    self.mapFile.seek(mapfile.HEADER.size + layer * layerSize + firstRow * width)
+                    band = bytearray(self.mapFile.read(rows * width))
+                for (chunkCol, keyRow), chunk in chunks.items():
+                    if keyRow != chunkRow:
+                        continue
+                    firstCol = chunkCol * chunkTiles
+                    cols = min(chunkTiles, width - firstCol)
+                    tiles = chunk.layers[layer]
+                    for row in range(rows):
+                        band[row * width + firstCol:row * width + firstCol + cols] = \
+                            tiles[row * chunkTiles:row * chunkTiles + cols]
+                yield bytes(band)
+
+    def close(self):
+        with self.lock:
+            self.mapFile.close()
+
+
+class ChunkLoader(threading.Thread):
+    """
+    Background thread that loads and saves chunks in the order they were asked for,
+    so a chunk loaded after it was saved always reads the saved tiles.
+    """
+
+    def __init__ (self, source, chunkTiles):
+        threading.Thread.__init__(self, name = "ChunkLoader")
+        self.daemon = True
+        self.source = source
+        self.chunkTiles = chunkTiles
+        # (key, chunk, None) to save, (key, None, request number) to load, None to stop
+        self.requests = queue.Queue()
+        # (key, request number, chunk) loaded, and (key, chunk) saved
+        self.loaded = queue.Queue()
+        self.saved = queue.Queue()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            key, chunk, number = request
+            if chunk is None:
+                self.loaded.put((key, number, self.source.readChunk(key[0], key[1], self.chunkTiles)))
+            else:
+                self.source.writeChunk(key[0], key[1], self.chunkTiles, chunk)
+                self.saved.put((key, chunk))
+
+    def load(self, key, number):
+        self.requests.put((key, None, number))
+
+    def save(self, key, chunk):
+        self.requests.put((key, chunk, None))
+
+    def stop(self):
+        """
+        Finishes every request made so far and stops the thread.
+        """
+        self.requests.put(None)
+        self.join()
+
+
+class ChunkLayer(object):
+    """
+    One layer of a StreamingTileMap, indexed like the arrays of a plain TileMap.
+    Reading a tile of a chunk that is not loaded yet loads it right away.
+    """
+
+    def __init__ (self, tileMap, layer):
+        self.tileMap = tileMap
+        self.layer = layer
+
+    def __len__(self):
+        return len(self.tileMap)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self.getRange(start, stop)
+            if step > 0:
+                return self.getRange(start, max(start, stop))[::step]
+            return bytes(self[i] for i in range(start, stop, step))
+        chunk, offset = self.tileMap.locate(index)
+        return chunk.layers[self.layer][offset]
+
+    def __setitem__(self, index, value):
+        chunk, offset = self.tileMap.locate(index)
+        chunk.layers[self.layer][offset] = value
+        if self.layer != FLAGS:
+            chunk.dirty = True
+
+    def getRange(self, start, stop):
+        """
+        Returns the bytes of the tiles from index start up to stop, across chunks and rows.
+        """
+        width = self.tileMap.width
+        chunkTiles = self.tileMap.chunkTiles
+        pieces = []
+        while start < stop:
+            col = start % width
+            count = min(stop - start, chunkTiles - col % chunkTiles, width - col)
+            chunk, offset = self.tileMap.locate(start)
+            pieces.append(chunk.layers[self.layer][offset:offset + count])
+            start += count
+        return b''.join(pieces)
+
+
+class StreamingTileMap(model.TileMap):
+    """
+    A TileMap backed by a map file, with only the chunks near the camera in memory.
+    """
+
+    def __init__ (self, fileName, tileSize = 32, chunkTiles = CHUNK_TILES):
+        """
+        fileName (str): binary map file with terrain and resource layers.
+        chunkTiles (int): width and height of a chunk in tiles.
+
+        Attributes:
+        fileName (str): the map file, see savegame.py.
+        chunks (dict): (chunkCol, chunkRow): resident Chunk.
+        requested (dict): key: number of the load the loader was asked for and hasn't returned.
+        saving (dict): key: evicted Chunk the loader hasn't saved yet, made resident again
+        instead of loading it if it is asked for before then.
+        evictedFlags (dict): key: flags layer of an evicted chunk with flags set,
+        put back when it is resident again.
+        stalls (int): chunks that had to be loaded on the spot because they were used before they arrived.
+        loadedChunks (list): keys of chunks made resident since popLoadedRanges().
+        """
+        self.fileName = fileName
+        self.source = MapFileSource(fileName)
+        self.width = self.source.width
+        self.height = self.source.height
+        self.tileSize = tileSize
+        self.chunkTiles = chunkTiles
+        self.terrain = ChunkLayer(self, TERRAIN)
+        self.resources = ChunkLayer(self, RESOURCES)
+        self.flags = ChunkLayer(self, FLAGS)
+        self.chunks = {}
+        self.requested = {}
+        self.requestCount = 0
+        self.saving = {}
+        self.evictedFlags = {}
+        self.stalls = 0
+        self.loadedChunks = []
+        self.lastCenter = None
+        self.loader = ChunkLoader(self.source, chunkTiles)
+        self.loader.start()
+
+    def locate(self, index):
+        """
+        Returns (chunk, offset) of the tile at index, loading its chunk if it isn't resident.
+        """
+        row, col = divmod(index, self.width)
+        chunkTiles = self.chunkTiles
+        key = (col // chunkTiles, row // chunkTiles)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.loadNow(key)
+        return chunk, (row % chunkTiles) * chunkTiles + col % chunkTiles
+
+    def loadNow(self, key):
+        """
+        Makes a chunk resident without waiting for the loader.
+        """
+        chunk = self.saving.pop(key, None)
+        if chunk is None:
+            chunk = self.source.readChunk(key[0], key[1], self.chunkTiles)
+            self.stalls += 1
+        # whatever the loader returns for it now is older than this
+        self.requested.pop(key, None)
+        self.adopt(key, chunk)
+        return chunk
+
+    def adopt(self, key, chunk):
+        """
+        Makes a chunk resident, with the flags it had when it was evicted.
+        """
+        flags = self.evictedFlags.pop(key, None)
+        if flags is not None:
+            chunk.layers[FLAGS][:] = flags
+        self.chunks[key] = chunk
+        self.loadedChunks.append(key)
+
+    def chunkBounds(self, rect, margin):
+        """
+        Returns (firstCol, firstRow, endCol, endRow) of the chunks overlapping
+        the map pixel rect grown by margin chunks, clipped to the map.
+        """
+        chunkPixels = self.chunkTiles * self.tileSize
+        return (max(0, rect.left // chunkPixels - margin),
+            max(0, rect.top // chunkPixels - margin),
+            min(-(-self.width // self.chunkTiles), (rect.right - 1) // chunkPixels + margin + 1),
+            min(-(-self.height // self.chunkTiles), (rect.bottom - 1) // chunkPixels + margin + 1))
+
+    def streamAround(self, cameraRect):
+        """
+        Adopts loaded chunks, requests the chunks around and ahead of cameraRect,
+        and evicts chunks far from it.
+        """
+        self.collect()
+        rects = [cameraRect]
+        center = cameraRect.center
+        if self.lastCenter is not None:
+            movex = (center[0] - self.lastCenter[0]) * PREFETCH_TICKS
+            movey = (center[1] - self.lastCenter[1]) * PREFETCH_TICKS
+            if movex or movey:
+                rects.append(cameraRect.move(movex, movey))
+        self.lastCenter = center
+        for rect in rects:
+            firstCol, firstRow, endCol, endRow = self.chunkBounds(rect, RESIDENT_MARGIN)
+            for chunkRow in range(firstRow, endRow):
+                for chunkCol in range(firstCol, endCol):
+                    self.request((chunkCol, chunkRow))
+        keep = [self.chunkBounds(rect, EVICT_MARGIN) for rect in rects]
+        for key in list(self.chunks):
+            if not any(firstCol <= key[0] < endCol and firstRow <= key[1] < endRow
+                       for firstCol, firstRow, endCol, endRow in keep):
+                self.evict(key)
+
+    def request(self, key):
+        """
+        Asks the loader for a chunk unless it is resident or already on its way.
+        """
+        if key in self.chunks or key in self.requested:
+            return
+        chunk = self.saving.pop(key, None)
+        if chunk is not None:
+            # evicted but not saved yet, so it is still the newest copy
+            self.adopt(key, chunk)
+            return
+        self.requestCount += 1
+        self.requested[key] = self.requestCount
+        self.loader.load(key, self.requestCount)
+
+    def collect(self):
+        """
+        Adopts the chunks the loader has finished and forgets the ones it has saved.
+        """
+        while True:
+            try:
+                key, number, chunk = self.loader.loaded.get_nowait()
+            except queue.Empty:
+                break
+            # only the answer to the latest request is adopted: chunks loaded on the spot
+            # in the meantime are no longer requested, and an earlier load of a chunk
+            # asked for again may have been read before its changes were saved
+            if self.requested.get(key) == number:
+                del self.requested[key]
+                self.adopt(key, chunk)
+        while True:
+            try:
+                key, chunk = self.loader.saved.get_nowait()
+            except queue.Empty:
+                break
+            if self.saving.get(key) is chunk:
+                del self.saving[key]
+
+    def popLoadedRanges(self):
+        """
+        Returns the tile ranges of the chunks made resident since the last call
+        that still are, so they can be read without loading anything.
+        """
+        keys = self.loadedChunks
+        self.loadedChunks = []
+        chunkTiles = self.chunkTiles
+        return [(chunkCol * chunkTiles, chunkRow * chunkTiles,
+            min(self.width, (chunkCol + 1) * chunkTiles), min(self.height, (chunkRow + 1) * chunkTiles))
+            for chunkCol, chunkRow in set(keys) if (chunkCol, chunkRow) in self.chunks]
+
+    def evict(self, key):
+        """
+        Drops a resident chunk, saving it first if it changed.
+        Flags are not saved to the map file, so they are kept aside if any are set.
+        """
+        chunk = self.chunks.pop(key)
+        flags = chunk.layers[FLAGS]
+        if flags.count(0) != len(flags):
+            self.evictedFlags[key] = flags
+        if chunk.dirty:
+            chunk.dirty = False
+            self.saving[key] = chunk
+            self.loader.save(key, chunk)
+
+    def copyLayers(self):
+        """
+        Returns the terrain and then the resource layer as bands of rows read from
+        the map file, see MapFileSource.readBands. Only the chunks in memory are
+        copied now, the file already holds the other tiles. Chunks loaded, changed
+        and saved while the bands are read may show their newer tiles, which are
+        in the changes made since anyway.
+        """
+        chunks = dict(self.saving)
+        chunks.update(self.chunks)
+        copies = dict((key, Chunk(bytes(chunk.layers[TERRAIN]), bytes(chunk.layers[RESOURCES]), None))
+            for key, chunk in chunks.items())
+        return self.source.readBands(self.chunkTiles, copies)
+
+    def readLayers(self):
+        """
+        Yields the terrain and then the resource layer in bands of chunkTiles rows,
+        see copyLayers(), read from the map file as they are reached.
+        """
+        return self.copyLayers()
+
+    def close(self):
+        """
+        Saves every changed chunk and stops the loader.
+        """
+        for key, chunk in self.chunks.items():
+            if chunk.dirty:
+                chunk.dirty = False
+                self.loader.save(key, chunk)
+        self.loader.stop()
+        self.saving.clear()
+        self.source.close()
@@ -0,0 +1,52 @@
+import pygame
+import controller
+import eventmanager
+import model
+
+
+def makeKeyboard():
+    evManager = eventmanager.EventManager()
+    gameModel = model.GameEngine(evManager)
+    keyboard = controller.Keyboard(evManager, gameModel, controller.ScriptedInput())
+    gameModel.state.push(model.STATE_PLAY)
+    return gameModel, keyboard
+
+
+def hoverScreenCenter(keyboard):
+    keyboard.input.mousePos = (model.SCREEN_WIDTH // 2, model.SCREEN_HEIGHT // 2)
+    keyboard.updateTilesHovered()
+    return keyboard.model.tileHover.tile
+
+
+def test_load_map_forgets_the_hovered_tile():
+    gameModel, keyboard = makeKeyboard()
+    oldMap = gameModel.tileMap
+    assert hoverScreenCenter(keyboard) is not None
+    gameModel.entities.create(1, 1)
+    keyboard.loadMap("assets/maps/classic-medium.csv", seed = 2)
+    assert gameModel.tileMap is not oldMap
+    assert gameModel.seed == 2
+    assert gameModel.tileHover.tile is None
+    assert gameModel.tileHover.popChangedTiles() == []
+    assert len(gameModel.entities) == 0
+    tile = hoverScreenCenter(keyboard)
+    assert tile.tileMap is gameModel.tileMap and tile.hovered
+
+
+def test_generate_map_forgets_the_hovered_tile():
+    gameModel, keyboard = makeKeyboard()
+    hoverScreenCenter(keyboard)
+    keyboard.generateMap(300, 300, seed = 1, workers = 1)
+    assert gameModel.tileHover.tile is None
+    assert hoverScreenCenter(keyboard).tileMap is gameModel.tileMap
+
+
+def test_left_click_claims_the_hovered_tile():
+    gameModel, keyboard = makeKeyboard()
+    claims = []
+    gameModel.evManager.Subscribe(eventmanager.ClaimTileEvent, claims.append)
+    tile = hoverScreenCenter(keyboard)
+    keyboard.input.post(pygame.event.Event(pygame.MOUSEBUTTONUP, pos = keyboard.input.mousePos, button = 1))
+    keyboard.input.post(pygame.event.Event(pygame.MOUSEBUTTONUP, pos = keyboard.input.mousePos, button = 3))
+    keyboard.onTick(eventmanager.TickEvent())
+    assert [(claim.col, claim.row, claim.owner) for claim in claims] == [(tile.col, tile.row, model.LOCAL_PLAYER)]
@@ -0,0 +1,40 @@
+import pytest
+import ecs
+
+
+def test_health_change_redraws_its_tile():
+    entities = ecs.EntityStore()
+    entity = entities.create(4, 7, owner = 1, structure = ecs.TOWN, health = 100)
+    entities.popChangedTiles()
+    entities.setHealth(entity, 60)
+    assert entities.popChangedTiles() == set([(4, 7)])
+    assert entities.health[entity] == 60
+    assert entities.maxHealth[entity] == 100
+
+
+def test_arrays_round_trip():
+    entities = ecs.EntityStore()
+    for i in range(50):
+        entities.create(i, i * 2, owner = i % 4 + 1, structure = ecs.FARM, rate = i % 3, health = 10 + i)
+    for entity in range(0, 50, 7):
+        entities.destroy(entity)
+    copy = ecs.EntityStore()
+    copy.setArrays([type(components)(components.typecode, components) for components in entities.getArrays()])
+    assert len(copy) == len(entities)
+    assert sorted(copy.getEntitiesInRange((0, 0, 50, 100))) == sorted(entities.getEntitiesInRange((0, 0, 50, 100)))
+    for owner in range(1, 5):
+        assert copy.getOwnerProduction(owner) == entities.getOwnerProduction(owner)
+    # destroyed ids are reused
+    assert copy.create(1, 1) in range(0, 50, 7)
+
+
+def test_owners_beyond_a_byte_are_refused():
+    entities = ecs.EntityStore()
+    entity = entities.create(1, 1, owner = ecs.MAX_OWNER, rate = 3)
+    with pytest.raises(ValueError):
+        entities.setOwner(entity, ecs.MAX_OWNER + 1)
+    with pytest.raises(ValueError):
+        entities.create(2, 2, owner = 300, rate = 1)
+    assert entities.getOwner(entity) == ecs.MAX_OWNER
+    assert entities.getOwnerProduction(ecs.MAX_OWNER) == 3
+    assert len(entities) == 1
@@ -0,0 +1,60 @@
+import eventmanager
+import model
+from eventmanager import *
+
+
+class EchoEvent(Event):
+    """
+    Posts itself again every time it is handled.
+    """
+
+    def __init__(self):
+        self.name = "Echo event"
+
+
+class Echo(object):
+
+    def __init__(self, evManager):
+        self.evManager = evManager
+        self.count = 0
+        evManager.Subscribe(EchoEvent, self.onEcho)
+
+    def onEcho(self, event):
+        self.count += 1
+        self.evManager.Post(EchoEvent())
+
+
+def test_pump_dispatches_batches_in_order():
+    evManager = EventManager(queued = True)
+    seen = []
+    evManager.Subscribe(Event, lambda event: seen.append(event.name))
+    evManager.Subscribe(InitializeEvent, lambda event: evManager.Post(LoadEvent()))
+    evManager.Post(InitializeEvent())
+    evManager.Post(SaveEvent(full = True))
+    assert seen == []
+    assert evManager.Pump() == 3
+    assert seen == ["Initialize event", "Save event", "Load event"]
+    assert (evManager.stats.batches, evManager.stats.depth, evManager.stats.limited) == (2, 0, 0)
+
+
+def test_pump_limit_stops_a_handler_that_keeps_posting():
+    evManager = EventManager(queued = True)
+    echo = Echo(evManager)
+    evManager.Post(EchoEvent())
+    assert evManager.Pump(100) == 100
+    assert echo.count == 100
+    assert evManager.stats.depth == 1
+    assert evManager.stats.limited == 1
+    assert 'limited=1' in str(evManager.stats)
+
+
+def test_game_loop_survives_a_handler_that_keeps_posting():
+    evManager = EventManager(queued = True)
+    gameModel = model.GameEngine(evManager)
+    echo = Echo(evManager)
+    evManager.Post(EchoEvent())
+    evManager.Post(QuitEvent())
+    gameModel.run()
+    # the Pump() after InitializeEvent stopped at the limit, then the loop saw the quit
+    assert 0 < echo.count <= eventmanager.PUMP_LIMIT
+    assert not gameModel.running
@@ -0,0 +1,26 @@
+import random
+import lanes
+
+
+def test_pack_unpack_round_trip():
+    data = bytes(random.Random(1).randrange(256) for i in range(1000))
+    assert lanes.unpack(lanes.pack(data), len(data)) == data
+    assert lanes.unpack(lanes.pack(b''), 0) == b''
+
+
+def test_sums_stay_in_their_lanes():
+    rows = [bytes([255] * 7), bytes(range(7)), bytes([1] * 7)]
+    total = sum(lanes.pack(row) for row in rows)
+    assert list(lanes.unpackWords(total, 7)) == [256 + value for value in range(7)]
+    assert lanes.unpack(total, 7) == bytes(range(7))
+
+
+def test_interpolate():
+    first = lanes.pack(bytes([0, 100, 255]))
+    second = lanes.pack(bytes([8, 100, 0]))
+    steps = lanes.interpolate(first, second, 3, 4)
+    assert steps == [bytes([0, 100, 255]), bytes([2, 100, 191]), bytes([4, 100, 127]), bytes([6, 100, 63])]
+
+
+def test_or_bytes():
+    assert lanes.orBytes(bytes([0x10, 0x20, 0]), bytes([1, 2, 3])) == bytes([0x11, 0x22, 3])
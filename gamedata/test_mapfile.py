@@ -0,0 +1,86 @@
+import pytest
+from array import array
+import mapfile
+import mapgen
+import model
+
+
+def test_save_load_round_trip(tmp_path):
+    fileName = str(tmp_path / "world.map")
+    terrain = array('B', (index % 9 for index in range(40 * 25)))
+    resources = array('B', (index % 3 for index in range(40 * 25)))
+    mapfile.save(fileName, 40, 25, terrain, resources)
+    assert mapfile.isMapFile(fileName)
+    with mapfile.load(fileName) as mapped:
+        assert (mapped.width, mapped.height) == (40, 25)
+        assert bytes(mapped.terrain) == terrain.tobytes()
+        assert bytes(mapped.resources) == resources.tobytes()
+
+
+def test_load_without_resources(tmp_path):
+    fileName = str(tmp_path / "classic.map")
+    mapfile.convertCsv("assets/maps/classic-medium.csv", fileName)
+    csvWidth, csvHeight, csvTerrain = mapfile.readCsv("assets/maps/classic-medium.csv")
+    with mapfile.load(fileName) as mapped:
+        assert (mapped.width, mapped.height) == (csvWidth, csvHeight)
+        assert bytes(mapped.terrain) == csvTerrain.tobytes()
+        assert mapped.resources is None
+
+
+def test_loaded_layers_are_private(tmp_path):
+    fileName = str(tmp_path / "world.map")
+    mapfile.save(fileName, 4, 4, bytes(16), bytes(16))
+    with mapfile.load(fileName) as mapped, mapfile.load(fileName) as other:
+        mapped.terrain[5] = model.DESERT
+        assert other.terrain[5] == 0
+
+
+def test_close_unmaps_the_file(tmp_path):
+    fileName = str(tmp_path / "world.map")
+    mapfile.save(fileName, 4, 4, bytes(range(16)), bytes(16))
+    mapped = mapfile.load(fileName)
+    mmapped = mapped.mapped
+    mapped.close()
+    assert mmapped.closed
+    with pytest.raises(ValueError):
+        mapped.terrain[0]
+    # slices still in use keep the mapping until they are gone
+    mapped = mapfile.load(fileName)
+    piece = mapped.terrain[2:4]
+    mapped.close()
+    assert bytes(piece) == bytes((2, 3))
+
+
+def test_tile_map_close_unmaps_its_file(tmp_path):
+    fileName = str(tmp_path / "world.map")
+    mapfile.save(fileName, 8, 8, bytes(64), bytes(64))
+    tileMap, seed = mapgen.loadTileMap(fileName)
+    mmapped = tileMap.mapping.mapped
+    tileMap.close()
+    assert mmapped.closed
+    assert tileMap.mapping is None
+
+
+def test_generated_map_file_loads(tmp_path):
+    fileName = str(tmp_path / "generated.map")
+    seed = mapgen.generateMapFile(fileName, 300, 200, seed = 3, workers = 1)
+    tileMap, loadedSeed = mapgen.loadTileMap(fileName)
+    generated, generatedSeed = mapgen.generateTileMap(300, 200, seed = 3, workers = 1)
+    assert (tileMap.width, tileMap.height) == (300, 200)
+    assert bytes(tileMap.terrain) == bytes(generated.terrain)
+    assert bytes(tileMap.resources) == bytes(generated.resources)
+    tileMap.close()
+
+
+@pytest.mark.parametrize("data, message", [
+    (b'ACM', "too short"),
+    (b'NOPE' + bytes(mapfile.HEADER.size), "not a map file"),
+    (mapfile.HEADER.pack(mapfile.MAGIC, mapfile.MAP_VERSION + 1, 1, 2, 2) + bytes(4), "map version"),
+    (mapfile.HEADER.pack(mapfile.MAGIC, mapfile.MAP_VERSION, 3, 2, 2) + bytes(6), "truncated"),
+])
+def test_bad_files_are_refused(tmp_path, data, message):
+    fileName = str(tmp_path / "bad.map")
+    with open(fileName, 'wb') as badFile:
+        badFile.write(data)
+    with pytest.raises(mapfile.MapFileError, match = message):
+        mapfile.load(fileName)
@@ -0,0 +1,103 @@
+import random
+import pytest
+from array import array
+import mapgen
+import model
+
+
+def naivePlacement(terrain, draws, table):
+    return array('B', (mapgen.pickResource(table[tileId], draw) if table[tileId] else 0
+        for tileId, draw in zip(terrain, draws)))
+
+
+def randomTerrain(rand, count):
+    return array('B', (rand.randrange(256) for i in range(count)))
+
+
+def borderDraws(rand, table, count):
+    """
+    Random draws, half of them on or next to a limit of the table.
+    """
+    limits = [limit for thresholds in table if thresholds for limit, recId in thresholds]
+    draws = array('H')
+    for i in range(count):
+        if limits and i % 2:
+            draws.append(max(0, min(mapgen.DRAW_RANGE - 1, rand.choice(limits) + rand.randrange(-2, 3))))
+        else:
+            draws.append(rand.randrange(mapgen.DRAW_RANGE))
+    return draws
+
+
+def randomDistributions(rand, tileCount, chanceCount):
+    distributions = {}
+    for tileId in rand.sample(range(256), tileCount):
+        chances = []
+        left = 1.0
+        for i in range(chanceCount):
+            probability = rand.uniform(0, left)
+            left -= probability
+            chances.append((rand.randrange(1, 4), probability))
+        distributions[tileId] = tuple(chances)
+    return distributions
+
+
+def test_place_resources_matches_naive_pick():
+    rand = random.Random(1)
+    table = mapgen.buildThresholdTable(mapgen.RESOURCE_DISTRIBUTIONS)
+    assert mapgen.buildPlacementTables(table) is not None
+    terrain = array('B', (rand.choice((model.GRASSLAND, model.PLAINS, model.TUNDRA, model.OCEAN))
+        for i in range(50000)))
+    draws = borderDraws(rand, table, len(terrain))
+    assert mapgen.placeResources(terrain, draws, table) == naivePlacement(terrain, draws, table)
+
+
+@pytest.mark.parametrize("tileCount, chanceCount", [(1, 1), (3, 2), (15, 1), (5, 3), (16, 1), (4, 5)])
+def test_place_resources_matches_naive_pick_for_any_table(tileCount, chanceCount):
+    # 16 terrain classes or more than 7 limits take the fallback
+    rand = random.Random(tileCount * 10 + chanceCount)
+    table = mapgen.buildThresholdTable(randomDistributions(rand, tileCount, chanceCount))
+    terrain = randomTerrain(rand, 20000)
+    draws = borderDraws(rand, table, len(terrain))
+    assert mapgen.placeResources(terrain, draws, table) == naivePlacement(terrain, draws, table)
+
+
+def test_place_resources_across_bands(monkeypatch):
+    monkeypatch.setattr(mapgen, 'PLACE_BAND', 1000)
+    rand = random.Random(2)
+    table = mapgen.buildThresholdTable(mapgen.RESOURCE_DISTRIBUTIONS)
+    terrain = randomTerrain(rand, 4321)
+    draws = borderDraws(rand, table, len(terrain))
+    assert mapgen.placeResources(terrain, draws, table) == naivePlacement(terrain, draws, table)
+
+
+def test_generated_chunks_meet_seamlessly():
+    whole, seed = mapgen.generateTileMap(512, 256, seed = 5, chunkSize = 256, workers = 1)
+    small, seed = mapgen.generateTileMap(512, 256, seed = 5, chunkSize = 128, workers = 1)
+    assert bytes(whole.terrain) == bytes(small.terrain)
+    assert bytes(whole.resources) == bytes(small.resources)
+
+
+def test_placement_codes():
+    # the example of buildPlacementTables
+    table = [None] * 256
+    table[model.PLAINS] = ((0x0710, model.WHEAT), (0x3300, model.MOUNTAIN))
+    classTable, codeTable, recIdTable, ambiguousTable = mapgen.buildPlacementTables(table)
+    assert classTable[model.PLAINS] == 1 << 4 and classTable[model.OCEAN] == 0
+    assert [codeTable[high] for high in (0x00, 0x06, 0x07, 0x08, 0x32, 0x33, 0x34, 0xff)] == [0, 0, 1, 2, 2, 3, 4, 4]
+    assert [recIdTable[1 << 4 | code] for code in (0, 2, 4)] == [model.WHEAT, model.MOUNTAIN, 0]
+    assert [ambiguousTable[1 << 4 | code] for code in range(5)] == [0, 1, 0, 1, 0]
+
+
+def test_worker_pool_is_reused():
+    try:
+        first, seed = mapgen.generateTileMap(512, 256, seed = 6, workers = 2)
+        pool = mapgen.workerPool
+        assert pool is not None
+        second, seed = mapgen.generateTileMap(512, 256, seed = 6, workers = 2)
+        assert mapgen.workerPool is pool
+        single, seed = mapgen.generateTileMap(512, 256, seed = 6, workers = 1)
+        assert bytes(first.terrain) == bytes(second.terrain) == bytes(single.terrain)
+        assert bytes(first.resources) == bytes(single.resources)
+    finally:
+        mapgen.shutdownWorkerPool()
+    assert mapgen.workerPool is None
@@ -0,0 +1,32 @@
+import eventmanager
+import model
+import pathfinding
+
+
+def makeFinder(tileMap):
+    evManager = eventmanager.EventManager()
+    gameModel = model.GameEngine(evManager)
+    gameModel.tileMap = tileMap
+    return pathfinding.Pathfinder(evManager, gameModel)
+
+
+def test_long_path_from_a_border_entrance():
+    # a start on a cluster border whose only way out is its own entrance
+    tileMap = model.TileMap(32, 16)
+    for row in range(16):
+        if row != 5:
+            tileMap.terrain[row * 32 + 15] = model.OCEAN
+    finder = makeFinder(tileMap)
+    path = finder.findLongPath((15, 5), (20, 5))
+    assert path is not None
+    assert path[0] == (15, 5) and path[-1] == (20, 5)
+
+
+def test_paths_go_around_water():
+    tileMap = model.TileMap(48, 48)
+    for row in range(40):
+        tileMap.terrain[row * 48 + 20] = model.OCEAN
+    finder = makeFinder(tileMap)
+    assert finder.findLongPath((2, 2), (40, 2)) is not None
+    assert finder.findPath((2, 2), (40, 2)) is not None
+    assert finder.findPath((2, 2), (20, 2)) is None
@@ -0,0 +1,50 @@
+import csv
+import json
+import profiler
+
+
+def makeProfiler():
+    stats = profiler.Profiler(windowSize = 4)
+    for seconds in (0.0005, 0.0015, 0.0016, 0.5, 0.0001):
+        stats.record('tick', seconds)
+    stats.record('render', 0.002)
+    return stats
+
+
+def test_rolling_window():
+    histogram = makeProfiler().histograms['tick']
+    assert list(histogram.samples) == [0.0015, 0.0016, 0.5, 0.0001]
+    assert histogram.total == 5
+    assert histogram.maximum() == 0.5
+    assert histogram.percentile(0.5) == 0.0015
+    # the last bucket counts every larger sample
+    assert histogram.buckets()[:3] == [1, 2, 0]
+    assert histogram.buckets()[-1] == 1
+
+
+def test_summary_slowest_first():
+    rows = makeProfiler().summary()
+    assert [row[0] for row in rows] == ['tick', 'render']
+    assert rows[0][1] == 4
+
+
+def test_export_csv(tmp_path):
+    fileName = str(tmp_path / "profile.csv")
+    makeProfiler().export(fileName)
+    with open(fileName, newline = '') as csvFile:
+        rows = list(csv.reader(csvFile))
+    assert rows[0][:7] == ['name', 'count', 'mean', 'p50', 'p95', 'p99', 'max']
+    assert rows[0][7] == '0ms' and rows[0][-1] == '19ms+'
+    assert rows[1][0] == 'tick'
+    assert [int(count) for count in rows[1][7:]] == makeProfiler().histograms['tick'].buckets()
+
+
+def test_export_json(tmp_path):
+    fileName = str(tmp_path / "profile.json")
+    makeProfiler().export(fileName)
+    with open(fileName) as jsonFile:
+        trace = json.load(jsonFile)
+    assert trace['bucketSize'] == profiler.BUCKET_SIZE
+    assert trace['buckets']['render'][2] == 1
+    assert trace['samples']['render'] == [0.002]
+    assert trace['summary'][0]['name'] == 'tick'
@@ -0,0 +1,80 @@
+import os
+import pygame
+import pytest
+import benchmark
+import controller
+import replay
+import savegame
+
+
+def test_log_round_trip(tmp_path):
+    log = replay.InputLog(seed = 12, mapFileName = "assets/maps/classic-medium.csv")
+    log.ticks.append(((10, 20), set([pygame.K_w, pygame.K_d]), [
+        pygame.event.Event(pygame.KEYDOWN, key = pygame.K_SPACE, mod = 1, unicode = ' '),
+        pygame.event.Event(pygame.KEYUP, key = pygame.K_a, mod = 0, unicode = 'é'),
+        pygame.event.Event(pygame.MOUSEMOTION, pos = (5, 6), rel = (-1, 2), buttons = (True, False, True)),
+        pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos = (7, 8), button = 3),
+        pygame.event.Event(pygame.MOUSEBUTTONUP, pos = (9, 10), button = 1),
+        pygame.event.Event(pygame.MOUSEWHEEL, x = 0, y = -1),
+        pygame.event.Event(pygame.QUIT),
+    ]))
+    log.ticks.append(((0, 0), set(), []))
+    fileName = str(tmp_path / "session.rec")
+    replay.writeLog(fileName, log)
+    loaded = replay.readLog(fileName)
+    assert (loaded.seed, loaded.mapFileName) == (12, "assets/maps/classic-medium.csv")
+    assert len(loaded) == 2
+    for (mousePos, pressed, events), (loadedPos, loadedPressed, loadedEvents) in zip(log.ticks, loaded.ticks):
+        assert (mousePos, pressed) == (loadedPos, loadedPressed)
+        assert [(event.type, event.dict) for event in events] == \
+            [(event.type, event.dict) for event in loadedEvents]
+
+
+def test_bad_log_is_refused(tmp_path):
+    fileName = str(tmp_path / "bad.rec")
+    with open(fileName, 'wb') as badFile:
+        badFile.write(b'NOPE' + bytes(replay.HEADER.size))
+    with pytest.raises(replay.ReplayFileError, match = "not a replay log"):
+        replay.readLog(fileName)
+
+
+@pytest.mark.parametrize("render", [True, False])
+def test_replay_ends_where_the_session_did(tmp_path, render):
+    source = controller.ScriptedInput()
+    recorder = replay.InputRecorder(source, seed = 1)
+    bench = benchmark.FrameBench(seed = 1, inputSource = recorder)
+    bench.run(240, lambda bench, frame: benchmark.sessionScript(source, frame))
+    fileName = str(tmp_path / "session.rec")
+    replay.writeLog(fileName, recorder.log)
+    replayed = replay.replay(replay.readLog(fileName), render)
+    camera = replayed.model.camera
+    assert camera.rect == bench.model.camera.rect
+    assert camera.zoomLevel == bench.model.camera.zoomLevel
+    assert replayed.model.state.statestack == bench.model.state.statestack
+
+
+def test_replayed_saves_stay_out_of_the_save_game(tmp_path):
+    source = controller.ScriptedInput()
+    recorder = replay.InputRecorder(source, seed = 1)
+    bench = benchmark.FrameBench(seed = 1, inputSource = recorder, saveFileName = str(tmp_path / "game.sav"))
+
+    def script(bench, frame):
+        if frame == 0:
+            source.post(pygame.event.Event(pygame.KEYDOWN, key = pygame.K_SPACE, mod = 0, unicode = ' '))
+        elif frame == 2:
+            source.post(pygame.event.Event(pygame.KEYDOWN, key = pygame.K_F5, mod = 0, unicode = ''))
+        elif frame == 20:
+            source.post(pygame.event.Event(pygame.KEYDOWN, key = pygame.K_F9, mod = 0, unicode = ''))
+        source.pressed = set([pygame.K_d]) if 3 <= frame < 15 else set()
+
+    bench.run(30, script)
+    bench.stopSaving()
+    saved = os.path.getmtime(savegame.SAVE_FILE_NAME) if os.path.exists(savegame.SAVE_FILE_NAME) else None
+    replayed = replay.replay(recorder.log, False)
+    assert replayed.model.camera.rect == bench.model.camera.rect
+    # F9 took the camera back to where F5 saved it
+    assert bench.model.camera.rect.topleft == savegame.load(str(tmp_path / "game.sav")).cameraPos
+    if saved is None:
+        assert not os.path.exists(savegame.SAVE_FILE_NAME)
+    else:
+        assert os.path.getmtime(savegame.SAVE_FILE_NAME) == saved
@@ -0,0 +1,200 @@
+import os
+import time
+from array import array
+import pytest
+import ecs
+import eventmanager
+import mapfile
+import mapgen
+import model
+import savegame
+import streaming
+import yields
+
+
+def makeGame(tmp_path, tileMap = None, queued = False):
+    evManager = eventmanager.EventManager(queued = queued)
+    gameModel = model.GameEngine(evManager)
+    if tileMap is None:
+        tileMap, gameModel.seed = mapgen.generateTileMap(96, 64, seed = 2, workers = 1)
+    gameModel.tileMap = tileMap
+    gameModel.state.push(model.STATE_MENU)
+    gameModel.state.push(model.STATE_PLAY)
+    economy = yields.YieldEngine(evManager, gameModel)
+    saves = savegame.SaveManager(evManager, gameModel, str(tmp_path / "game.sav"), autosaveTicks = 0,
+        economy = economy)
+    return evManager, gameModel, saves
+
+
+def test_snapshot_round_trip(tmp_path):
+    evManager, gameModel, saves = makeGame(tmp_path)
+    gameModel.entities.create(3, 4, owner = 2, structure = ecs.MINE, rate = 5, health = 80)
+    gameModel.camera.rect.topleft = (320, 96)
+    saves.save(full = True)
+    saves.writer.flush()
+    saveData = savegame.load(saves.fileName)
+    tileMap = gameModel.tileMap
+    assert (saveData.width, saveData.height) == (tileMap.width, tileMap.height)
+    assert bytes(saveData.terrain) == bytes(tileMap.terrain)
+    assert bytes(saveData.resources) == bytes(tileMap.resources)
+    assert saveData.seed == gameModel.seed
+    assert saveData.cameraPos == (320, 96)
+    assert saveData.states == [model.STATE_MENU, model.STATE_PLAY]
+    assert [list(components) for components in saveData.entities] == \
+        [list(components) for components in gameModel.entities.getArrays()]
+
+
+def test_delta_round_trip(tmp_path):
+    evManager, gameModel, saves = makeGame(tmp_path)
+    saves.save(full = True)
+    gameModel.changeTile(5, 6, model.DESERT, model.WHEAT)
+    gameModel.changeTile(95, 63, model.SNOW, 0)
+    saves.save()
+    saves.writer.flush()
+    assert os.path.exists(savegame.deltaFileName(saves.fileName))
+    saveData = savegame.load(saves.fileName)
+    tileMap = gameModel.tileMap
+    assert sorted(saveData.changed) == [6 * 96 + 5, 63 * 96 + 95]
+    assert bytes(saveData.terrain) == bytes(tileMap.terrain)
+    assert bytes(saveData.resources) == bytes(tileMap.resources)
+    # a new snapshot drops the delta
+    saves.save(full = True)
+    saves.writer.flush()
+    assert not os.path.exists(savegame.deltaFileName(saves.fileName))
+
+
+def test_entities_saved_in_a_delta(tmp_path):
+    evManager, gameModel, saves = makeGame(tmp_path)
+    saves.save(full = True)
+    entity = gameModel.entities.create(10, 11, owner = 3, structure = ecs.TOWN, rate = 2, health = 50)
+    saves.save()
+    saves.writer.flush()
+    evManager.Post(eventmanager.LoadEvent())
+    entities = gameModel.entities
+    assert len(entities) == 1
+    assert entities.getEntitiesAt(10, 11) == [entity]
+    assert entities.getOwner(entity) == 3
+    assert entities.health[entity] == 50
+    assert entities.getOwnerProduction(3) == 2
+
+
+def test_load_restores_the_game(tmp_path):
+    evManager, gameModel, saves = makeGame(tmp_path)
+    saves.save(full = True)
+    saves.writer.flush()
+    terrain = bytes(gameModel.tileMap.terrain)
+    gameModel.changeTile(1, 1, model.OCEAN)
+    gameModel.camera.rect.topleft = (640, 0)
+    evManager.Post(eventmanager.LoadEvent())
+    assert bytes(gameModel.tileMap.terrain) == terrain
+    assert gameModel.camera.rect.topleft != (640, 0)
+
+
+def test_quit_saves_a_streamed_map_before_it_is_closed(tmp_path):
+    mapFileName = str(tmp_path / "world.map")
+    mapgen.generateMapFile(mapFileName, 256, 192, seed = 4, workers = 1)
+    tileMap = streaming.StreamingTileMap(mapFileName)
+    evManager, gameModel, saves = makeGame(tmp_path, tileMap, queued = True)
+    gameModel.changeTile(7, 9, model.DESERT)
+    evManager.Post(eventmanager.QuitEvent())
+    # the quit is handled on the first Pump, the map is closed after the loop
+    gameModel.run()
+    saveData = savegame.load(saves.fileName)
+    assert saveData.terrain[9 * 256 + 7] == model.DESERT
+    with mapfile.load(mapFileName) as mapped:
+        assert bytes(saveData.terrain) == bytes(mapped.terrain)
+
+
+def test_quit_only_saves_changes(tmp_path):
+    evManager, gameModel, saves = makeGame(tmp_path)
+    gameModel.camera.rect.topleft = (640, 0)
+    saves.onQuit(eventmanager.QuitEvent())
+    assert not os.path.exists(saves.fileName)
+    evManager, gameModel, saves = makeGame(tmp_path)
+    gameModel.entities.create(3, 4)
+    saves.onQuit(eventmanager.QuitEvent())
+    assert os.path.exists(saves.fileName)
+    # quitting again after loading it saves nothing new
+    evManager, gameModel, saves = makeGame(tmp_path)
+    evManager.Post(eventmanager.LoadEvent())
+    modified = os.path.getmtime(saves.fileName)
+    saves.onQuit(eventmanager.QuitEvent())
+    assert os.path.getmtime(saves.fileName) == modified
+    assert not os.path.exists(savegame.deltaFileName(saves.fileName))
+
+
+def test_owners_and_stocks_round_trip(tmp_path):
+    evManager, gameModel, saves = makeGame(tmp_path)
+    economy = saves.economy
+    economy.build(gameModel.tileMap)
+    economy.setOwner(3, 4, 1)
+    economy.setOwner(10, 10, 2)
+    economy.stocks = {1: [5.0, 2.5], 2: [0.5, 0.0]}
+    saves.save(full = True)
+    economy.setOwner(3, 4, yields.UNOWNED)
+    economy.setOwner(95, 63, 1)
+    saves.save()
+    saves.writer.flush()
+    owners = economy.getOwners()
+    ownerRates = economy.getOwnerRates(1)
+    economy.setOwner(50, 50, 3)
+    economy.stocks = {}
+    evManager.Post(eventmanager.LoadEvent())
+    assert economy.getOwners() == owners == {10 * 96 + 10: 2, 63 * 96 + 95: 1}
+    assert economy.getStock(1) == [5.0, 2.5]
+    assert not saves.hasUnsavedChanges()
+    deadline = time.time() + 10
+    while economy.tileMap is not gameModel.tileMap and time.time() < deadline:
+        evManager.Post(eventmanager.TickEvent())
+        time.sleep(0.001)
+    assert economy.owners == owners
+    assert economy.getOwnerRates(1) == ownerRates
+
+
+def test_delta_outside_the_map_is_refused(tmp_path):
+    evManager, gameModel, saves = makeGame(tmp_path)
+    saves.save(full = True)
+    saves.writer.flush()
+    savegame.writeDelta(saves.fileName, saves.saveId, savegame.packGame(gameModel),
+        savegame.packEntities(gameModel.entities), None, array('I', [5, 96 * 64]), b'\0\0', b'\0\0')
+    with pytest.raises(savegame.SaveFileError, match = "outside the map"):
+        savegame.load(saves.fileName)
+
+
+def test_load_restores_a_streamed_map_into_its_file(tmp_path):
+    mapFileName = str(tmp_path / "world.map")
+    mapgen.generateMapFile(mapFileName, 256, 192, seed = 4, workers = 1)
+    evManager, gameModel, saves = makeGame(tmp_path, streaming.StreamingTileMap(mapFileName))
+    original = gameModel.tileMap.getTile(200, 150).tileId
+    saves.save(full = True)
+    gameModel.changeTile(7, 9, model.DESERT)
+    saves.save()
+    saves.writer.flush()
+    gameModel.changeTile(7, 9, model.OCEAN)
+    gameModel.changeTile(200, 150, model.SNOW)
+    evManager.Post(eventmanager.LoadEvent())
+    tileMap = gameModel.tileMap
+    assert isinstance(tileMap, streaming.StreamingTileMap)
+    assert tileMap.fileName == mapFileName
+    assert tileMap.getTile(7, 9).tileId == model.DESERT
+    assert tileMap.getTile(200, 150).tileId == original
+    saveData = savegame.load(saves.fileName)
+    tileMap.close()
+    with mapfile.load(mapFileName) as mapped:
+        assert bytes(mapped.terrain) == bytes(saveData.terrain)
+        assert bytes(mapped.resources) == bytes(saveData.resources)
+
+
+@pytest.mark.parametrize("data, message", [
+    (b'AC', "too short"),
+    (b'NOPE' + bytes(savegame.HEADER.size), "not a save file"),
+    (savegame.HEADER.pack(savegame.MAGIC, savegame.SAVE_VERSION, savegame.DELTA, 1), "not a snapshot"),
+    (savegame.HEADER.pack(savegame.MAGIC, savegame.SAVE_VERSION, savegame.SNAPSHOT, 1)
+        + savegame.SECTION.pack(b'GAME', 100), "truncated"),
+])
+def test_bad_files_are_refused(tmp_path, data, message):
+    fileName = str(tmp_path / "bad.sav")
+    with open(fileName, 'wb') as badFile:
+        badFile.write(data)
+    with pytest.raises(savegame.SaveFileError, match = message):
+        savegame.load(fileName)
@@ -0,0 +1,45 @@
+import asyncio
+import struct
+import pytest
+import ecs
+import model
+import server
+
+
+@pytest.mark.parametrize("msgType, body", [
+    (server.MSG_CAMERA, b'\1\2'),
+    (server.MSG_INPUT, server.INPUT.pack(0, 0, 0, 2) + b'\xff\xfe'),
+])
+def test_bad_message_drops_the_client(msgType, body):
+    async def run():
+        gameServer = server.createServer(port = 0, seed = 1)
+        await gameServer.start()
+        client = server.RemoteClient()
+        await client.connect('127.0.0.1', gameServer.port)
+        client.send(msgType, body)
+        assert await asyncio.wait_for(client.receive(), 10) is None
+        assert not gameServer.sessions
+        await client.close()
+        await gameServer.close()
+    asyncio.run(run())
+
+
+def updateBody(tileMap, entities, tileRange, oldRange):
+    regions = server.subtractRange(tileRange, oldRange)
+    frame = server.packUpdate(1, 0.0, tileMap, tileRange, regions, [], entities, regions, [])
+    return frame[server.FRAME.size:]
+
+
+def test_client_drops_the_entities_its_camera_left():
+    tileMap = model.TileMap(64, 64)
+    entities = ecs.EntityStore()
+    entities.create(2, 2, owner = 1, structure = ecs.FARM)
+    entities.create(12, 12, owner = 2, structure = ecs.TOWN)
+    client = server.RemoteClient()
+    client.tileMap = model.TileMap(64, 64)
+    client.applyUpdate(updateBody(tileMap, entities, (0, 0, 16, 16), None))
+    assert len(client.entities) == 2
+    client.applyUpdate(updateBody(tileMap, entities, (8, 8, 24, 24), (0, 0, 16, 16)))
+    assert [(client.entities.cols[entity], client.entities.rows[entity])
+        for entity in client.entities.getEntitiesInRange((0, 0, 64, 64))] == [(12, 12)]
+    assert client.tileRange == (8, 8, 24, 24)
@@ -0,0 +1,75 @@
+import time
+import pytest
+import mapgen
+import model
+import streaming
+
+
+@pytest.fixture
+def tileMap(tmp_path):
+    fileName = str(tmp_path / "world.map")
+    mapgen.generateMapFile(fileName, 200, 150, seed = 8, workers = 1)
+    tileMap = streaming.StreamingTileMap(fileName, chunkTiles = 32)
+    yield tileMap
+    tileMap.close()
+
+
+def waitForLoads(tileMap):
+    """
+    Collects from the loader until it has answered every request.
+    """
+    deadline = time.time() + 10
+    while tileMap.requested and time.time() < deadline:
+        time.sleep(0.001)
+        tileMap.collect()
+    assert not tileMap.requested
+
+
+def test_slices_match_a_plain_map(tileMap):
+    plain, seed = mapgen.loadTileMap(tileMap.source.mapFile.name)
+    for index in (slice(0, 200), slice(150, 1234), slice(0, 5000, 3), slice(4999, 10, -7), slice(300, 100, 2)):
+        assert tileMap.terrain[index] == bytes(plain.terrain[index])
+        assert tileMap.resources[index] == bytes(plain.resources[index])
+    plain.close()
+
+
+def test_hover_survives_eviction(tileMap):
+    tile = tileMap.getTile(40, 40)
+    tile.hovered = True
+    key = (1, 1)
+    tileMap.evict(key)
+    assert key not in tileMap.chunks
+    tileMap.request(key)
+    waitForLoads(tileMap)
+    assert key in tileMap.chunks
+    assert tileMap.getTile(40, 40).hovered
+    assert not tileMap.getTile(41, 40).hovered
+
+
+def test_changes_survive_eviction(tileMap):
+    key = (2, 2)
+    tileMap.getTile(70, 70).tileId = model.SNOW
+    stalls = tileMap.stalls
+    tileMap.evict(key)
+    # asked for again before it is saved
+    tileMap.request(key)
+    assert tileMap.getTile(70, 70).tileId == model.SNOW
+    assert tileMap.stalls == stalls
+
+
+def test_a_stale_load_is_not_adopted(tileMap):
+    key = (3, 1)
+    tileMap.request(key)
+    # wait until the loader has read the chunk, without adopting it
+    deadline = time.time() + 10
+    while tileMap.loader.loaded.empty() and time.time() < deadline:
+        time.sleep(0.001)
+    # the chunk is used before the load is collected, changed and evicted
+    tileMap.getTile(100, 40).tileId = model.DESERT
+    tileMap.evict(key)
+    tileMap.request(key)
+    tileMap.evict(key)
+    # asked for again: the first load predates the change and must be ignored
+    tileMap.request(key)
+    waitForLoads(tileMap)
+    assert tileMap.getTile(100, 40).tileId == model.DESERT
@@ -0,0 +1,37 @@
+import random
+import pygame
+import pytest
+import benchmark
+import mapgen
+import model
+
+
+def scaledPixels(surface):
+    return pygame.image.tostring(surface, 'RGB')
+
+
+@pytest.mark.parametrize("width, height", [(96, 64), (2100, 300)])
+def test_patched_minimap_matches_a_full_rescale(width, height):
+    tileMap, seed = mapgen.generateTileMap(width, height, seed = 3, workers = 1)
+    bench = benchmark.FrameBench(tileMap = tileMap)
+    bench.model.state.push(model.STATE_PLAY)
+    bench.run(1)
+    view = bench.view
+    scaled = view.minimapScaled
+    assert scaled is not None
+    shuffle = random.Random(4)
+    for i in range(40):
+        col, row = shuffle.randrange(width), shuffle.randrange(height)
+        bench.model.changeTile(col, row, tileId = shuffle.randrange(4))
+        # a whole tile range, as a streamed chunk loads
+        firstCol, firstRow = shuffle.randrange(width), shuffle.randrange(height)
+        endCol = min(width, firstCol + shuffle.randint(1, 70))
+        endRow = min(height, firstRow + shuffle.randint(1, 70))
+        for row in range(firstRow, endRow):
+            for col in range(firstCol, endCol):
+                tileMap.terrain[row * width + col] = shuffle.randrange(4)
+        view.patchMinimapRanges([(firstCol, firstRow, endCol, endRow)])
+        bench.run(1)
+    assert view.minimapScaled is scaled
+    rescaled = pygame.transform.scale(view.minimapSurface, scaled.get_size()).convert()
+    assert scaledPixels(scaled) == scaledPixels(rescaled)
@@ -0,0 +1,102 @@
+import time
+import pytest
+import eventmanager
+import mapgen
+import model
+import streaming
+import yields
+
+
+def makeEngine(tileMap):
+    evManager = eventmanager.EventManager()
+    gameModel = model.GameEngine(evManager)
+    gameModel.tileMap = tileMap
+    return evManager, gameModel, yields.YieldEngine(evManager, gameModel)
+
+
+def tickUntilBuilt(evManager, economy, tileMap):
+    deadline = time.time() + 10
+    while economy.tileMap is not tileMap and time.time() < deadline:
+        evManager.Post(eventmanager.TickEvent())
+        time.sleep(0.001)
+    assert economy.tileMap is tileMap
+
+
+def naiveRates(tileMap, yieldType):
+    return [yields.TERRAIN_YIELDS.get(tileMap.terrain[index], (0, 0))[yieldType] +
+            yields.RESOURCE_YIELDS.get(tileMap.resources[index], (0, 0))[yieldType]
+            for index in range(len(tileMap))]
+
+
+def assertSameYields(economy, other):
+    assert economy.rates == other.rates
+    assert economy.regionRates == other.regionRates
+    assert economy.ownerRates == other.ownerRates
+    assert economy.owners == other.owners
+
+
+def test_build_matches_naive_rates():
+    tileMap, seed = mapgen.generateTileMap(200, 150, seed = 5, workers = 1)
+    evManager, gameModel, economy = makeEngine(tileMap)
+    economy.build(tileMap)
+    for yieldType in range(len(yields.YIELD_NAMES)):
+        rates = naiveRates(tileMap, yieldType)
+        assert list(economy.rates[yieldType]) == rates
+        assert sum(economy.regionRates[yieldType]) == sum(rates)
+        assert economy.getRegionRates(17, 33)[yieldType] == sum(rates[row * 200 + col]
+            for row in range(32, 48) for col in range(16, 32))
+
+
+def test_changes_during_a_background_build_are_replayed():
+    tileMap, seed = mapgen.generateTileMap(200, 150, seed = 5, workers = 1)
+    evManager, gameModel, economy = makeEngine(tileMap)
+    evManager.Post(eventmanager.TickEvent())
+    assert economy.building is not None
+    gameModel.changeTile(3, 4, model.GRASSLAND, model.WHEAT)
+    evManager.Post(eventmanager.ClaimTileEvent(3, 4, model.LOCAL_PLAYER))
+    evManager.Post(eventmanager.ClaimTileEvent(199, 149, 2))
+    tickUntilBuilt(evManager, economy, tileMap)
+    expected = makeEngine(tileMap)[2]
+    expected.build(tileMap)
+    expected.setOwner(3, 4, model.LOCAL_PLAYER)
+    expected.setOwner(199, 149, 2)
+    assertSameYields(economy, expected)
+    assert economy.getOwnerRates(model.LOCAL_PLAYER) == [4, 0]
+
+
+def test_replaced_map_is_built_instead():
+    tileMap, seed = mapgen.generateTileMap(200, 150, seed = 5, workers = 1)
+    evManager, gameModel, economy = makeEngine(tileMap)
+    evManager.Post(eventmanager.TickEvent())
+    oldBuild = economy.building
+    gameModel.tileMap, seed = mapgen.generateTileMap(100, 70, seed = 6, workers = 1)
+    tickUntilBuilt(evManager, economy, gameModel.tileMap)
+    assert oldBuild.cancelled
+    assert len(economy.rates[0]) == 100 * 70
+
+
+def test_streamed_map_has_yields(tmp_path):
+    fileName = str(tmp_path / "world.map")
+    mapgen.generateMapFile(fileName, 200, 150, seed = 8, workers = 1)
+    tileMap = streaming.StreamingTileMap(fileName, chunkTiles = 32)
+    tileMap.getTile(40, 40).tileId = model.DESERT
+    evManager, gameModel, economy = makeEngine(tileMap)
+    tickUntilBuilt(evManager, economy, tileMap)
+    tileMap.close()
+    plain, seed = mapgen.loadTileMap(fileName)
+    expected = makeEngine(plain)[2]
+    expected.build(plain)
+    assert economy.rates == expected.rates
+    assert economy.regionRates == expected.regionRates
+    plain.close()
+
+
+def test_owners_beyond_a_byte_are_refused():
+    tileMap, seed = mapgen.generateTileMap(64, 64, seed = 5, workers = 1)
+    evManager, gameModel, economy = makeEngine(tileMap)
+    economy.build(tileMap)
+    with pytest.raises(ValueError):
+        economy.setOwner(1, 1, 256)
+    with pytest.raises(ValueError):
+        evManager.Post(eventmanager.ClaimTileEvent(1, 1, -1))
+    assert economy.getOwners() == {}
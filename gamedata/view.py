@@ -1,56 +1,568 @@
+import os
+import time
 import pygame
 import model
+import assets
+import ecs
 from eventmanager import *
-from copy import *
+from collections import OrderedDict
+
+# tiles drawn this small or smaller are flat terrain colors instead of textures
+FLAT_TILE_PIXELS = 4
+# largest side of the minimap surface, bigger maps are sampled
+MINIMAP_MAX_PIXELS = 1024
+# entities are not drawn on tiles smaller than this
+ENTITY_MIN_PIXELS = 4
+# entity color of each owner, owners past the end wrap around
+OWNER_COLORS = ((128, 128, 128), (200, 40, 40), (40, 80, 220), (230, 200, 40),
+    (150, 60, 200), (240, 130, 30), (30, 180, 170), (240, 240, 240))
+
+def makeTerrainSurface(tileMap, palette, firstCol, firstRow, cols, rows, step = 1):
+    """
+    Returns a surface with one pixel per tile of the cols x rows tiles from
+    (firstCol, firstRow), colored by tileId through palette.
+    With a step over 1 only every step-th tile of every step-th row is used,
+    so the surface is cols x rows pixels covering step times as many tiles each way.
+    It is written straight from the terrain array, without drawing tile by tile.
+    Pixels outside the map get palette index assets.OUTSIDE_COLOR_INDEX.
+    """
+    surface = pygame.Surface((cols, rows), 0, 8)
+    surface.set_palette(palette)
+    pitch = surface.get_pitch()
+    outside = bytes([assets.OUTSIDE_COLOR_INDEX])
+    buffer = surface.get_buffer()
+    lineTiles = cols * step
+    for y in range(rows):
+        row = firstRow + y * step
+        if 0 <= row < tileMap.height and firstCol < tileMap.width:
+            start = row * tileMap.width
+            lineStart = max(0, firstCol)
+            lineEnd = min(tileMap.width, firstCol + lineTiles)
+            line = (outside * (lineStart - firstCol)
+                + bytes(tileMap.terrain[start + lineStart:start + lineEnd])
+                + outside * (firstCol + lineTiles - lineEnd))
+            if step > 1:
+                line = line[::step]
+        else:
+            line = outside * cols
+        buffer.write(line, y * pitch)
+    del buffer
+    return surface
+
+class ChunkRenderer(object):
+    """
+    Draws the terrain and resources of a TileMap from pre-baked chunk surfaces.
+    A chunk is a square of tiles baked into one surface the first time it is seen,
+    so a frame costs one blit per visible chunk instead of one or two blits per
+    visible tile. Each zoom level has its own chunks, all chunkSize tiles of the
+    nearest zoom wide on screen, so zooming out does not add blits.
+    """
+
+    def __init__(self, assets, chunkSize = 16, maxBytes = 64 * 1024 * 1024):
+        """
+        assets (AssetManager): holds the texture atlas tiles are baked from.
+        chunkSize (int): width and height of a chunk in tiles at the nearest zoom.
+        maxBytes (int): memory budget of the cached surfaces.
+        The least recently drawn chunks are evicted once it is exceeded.
+        """
+        self.assets = assets
+        self.chunkSize = chunkSize
+        self.maxBytes = maxBytes
+        self.usedBytes = 0
+        # (tilePixels, chunkCol, chunkRow): Surface, ordered from least to most recently used
+        self.chunks = OrderedDict()
+        # tilePixels: chunk width in tiles, for every zoom drawn so far
+        self.chunkTiles = {}
+
+    def clear(self):
+        """
+        Forgets every baked chunk. Use when a new TileMap is loaded.
+        """
+        self.chunks.clear()
+        self.usedBytes = 0
+
+    def getChunkTiles(self, tileMap, tilePixels):
+        """
+        Returns the width in tiles of a chunk drawn with tilePixels wide tiles.
+        """
+        chunkTiles = self.chunkTiles.get(tilePixels)
+        if chunkTiles is None:
+            chunkTiles = max(1, self.chunkSize * tileMap.tileSize // tilePixels)
+            self.chunkTiles[tilePixels] = chunkTiles
+        return chunkTiles
+
+    def invalidate(self, col, row):
+        """
+        Drops the chunks holding the tile at (col, row) so they are baked again.
+        """
+        for tilePixels, chunkTiles in self.chunkTiles.items():
+            key = (tilePixels, col // chunkTiles, row // chunkTiles)
+            surface = self.chunks.pop(key, None)
+            if surface:
+                self.usedBytes -= self.surfaceBytes(surface)
+
+    def surfaceBytes(self, surface):
+        w, h = surface.get_size()
+        return w * h * surface.get_bytesize()
+
+    def bake(self, tileMap, tilePixels, chunkCol, chunkRow):
+        """
+        Returns a new surface with the terrain and resources of one chunk.
+        """
+        chunkTiles = self.getChunkTiles(tileMap, tilePixels)
+        chunkPixels = chunkTiles * tilePixels
+        firstCol = chunkCol * chunkTiles
+        firstRow = chunkRow * chunkTiles
+        if tilePixels <= FLAT_TILE_PIXELS:
+            surface = makeTerrainSurface(tileMap, self.assets.getTerrainPalette(),
+                firstCol, firstRow, chunkTiles, chunkTiles)
+            if tilePixels > 1:
+                surface = pygame.transform.scale(surface.convert(), (chunkPixels, chunkPixels))
+            elif pygame.display.get_surface():
+                return surface.convert()
+            else:
+                return surface
+        else:
+            surface = pygame.Surface((chunkPixels, chunkPixels))
+            surface.fill((0, 0, 0))
+        if pygame.display.get_surface():
+            surface = surface.convert()
+        endCol = min(firstCol + chunkTiles, tileMap.width)
+        terrain = tileMap.terrain
+        resources = tileMap.resources
+        atlas = self.assets.getAtlas(tilePixels)
+        getTerrainArea = self.assets.getTerrainArea
+        getResourceArea = self.assets.getResourceArea
+        for row in range(firstRow, min(firstRow + chunkTiles, tileMap.height)):
+            y = (row - firstRow) * tilePixels
+            start = row * tileMap.width
+            for col in range(firstCol, endCol):
+                x = (col - firstCol) * tilePixels
+                index = start + col
+                if tilePixels > FLAT_TILE_PIXELS:
+                    surface.blit(atlas, (x, y), getTerrainArea(terrain[index], tilePixels))
+                if resources[index]:
+                    surface.blit(atlas, (x, y), getResourceArea(resources[index], tilePixels))
+        return surface
+
+    def getChunk(self, tileMap, tilePixels, chunkCol, chunkRow):
+        """
+        Returns the baked surface of a chunk, baking it if it is not cached.
+        """
+        key = (tilePixels, chunkCol, chunkRow)
+        surface = self.chunks.get(key)
+        if surface:
+            self.chunks.move_to_end(key)
+            return surface
+        surface = self.bake(tileMap, tilePixels, chunkCol, chunkRow)
+        self.chunks[key] = surface
+        self.usedBytes += self.surfaceBytes(surface)
+        # evict least recently used chunks, but never the one just baked
+        while self.usedBytes > self.maxBytes and len(self.chunks) > 1:
+            oldKey, oldSurface = self.chunks.popitem(last = False)
+            self.usedBytes -= self.surfaceBytes(oldSurface)
+        return surface
+
+    def render(self, screen, tileMap, cameraRect, tilePixels = None, area = None):
+        """
+        Blits every chunk that overlaps cameraRect onto screen,
+        with tiles tilePixels wide (the map's tile size if None).
+        If a screen rect area is given, only the chunks overlapping it are blitted.
+        """
+        if tilePixels is None:
+            tilePixels = tileMap.tileSize
+        chunkTiles = self.getChunkTiles(tileMap, tilePixels)
+        # chunk size in map pixels, and the camera position in screen pixels
+        chunkMapPixels = chunkTiles * tileMap.tileSize
+        chunkPixels = chunkTiles * tilePixels
+        offsetx = cameraRect.x * tilePixels // tileMap.tileSize
+        offsety = cameraRect.y * tilePixels // tileMap.tileSize
+        firstCol = max(0, cameraRect.left // chunkMapPixels)
+        firstRow = max(0, cameraRect.top // chunkMapPixels)
+        endCol = min(-(-tileMap.width // chunkTiles), cameraRect.right // chunkMapPixels + 1)
+        endRow = min(-(-tileMap.height // chunkTiles), cameraRect.bottom // chunkMapPixels + 1)
+        if area is not None:
+            firstCol = max(firstCol, (area.left + offsetx) // chunkPixels)
+            firstRow = max(firstRow, (area.top + offsety) // chunkPixels)
+            endCol = min(endCol, (area.right - 1 + offsetx) // chunkPixels + 1)
+            endRow = min(endRow, (area.bottom - 1 + offsety) // chunkPixels + 1)
+        for chunkRow in range(firstRow, endRow):
+            y = chunkRow * chunkPixels - offsety
+            for chunkCol in range(firstCol, endCol):
+                x = chunkCol * chunkPixels - offsetx
+                screen.blit(self.getChunk(tileMap, tilePixels, chunkCol, chunkRow), (x, y))
+
+
+class SurfaceCache(object):
+    """
+    Bounded cache of rendered surfaces, such as text and GUI widgets.
+    The least recently used surface is evicted once maxEntries are cached.
+    """
+
+    def __init__(self, maxEntries = 256):
+        self.maxEntries = maxEntries
+        # key: Surface, ordered from least to most recently used
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, make):
+        """
+        Returns the surface cached for key, calling make() to render it if there is none.
+        """
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        self.misses += 1
+        surface = make()
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.maxEntries:
+            self.surfaces.popitem(last = False)
+        return surface
+
+    def renderText(self, font, text, antialias, color):
+        """
+        Returns font.render(text, antialias, color), rendering it only once.
+        """
+        key = ('text', font, text, antialias, tuple(color))
+        return self.get(key, lambda: font.render(text, antialias, color))
+
+    def clear(self):
+        self.surfaces.clear()
 
 class GraphicalView(object):
     """
     Draws the model state onto the screen.
     """
 
-    def __init__(self, evManager, model):
+    def __init__(self, evManager, model, dirtyRectMode = True, headless = False):
         """
         evManager (EventManager): Allows posting messages to the event queue.
         model (GameEngine): a strong reference to the game Model.
+        dirtyRectMode (bool): only redraw and push the parts of the screen that changed.
+        headless (bool): draw to an offscreen surface with SDL's dummy video driver
+        instead of opening a fullscreen window.
                 
         Attributes:
         isinitialized (bool): pygame is ready to draw.
         screen (pygame.Surface): the screen surface.
-        clock (pygame.time.Clock): keeps the fps constant.
+        clock (pygame.time.Clock): measures the fps.
         smallfont (pygame.Font): a small font.
+        assets (AssetManager): textures, images and fonts.
+        surfaceCache (SurfaceCache): rendered text and buttons.
+        dirtyRects (list): screen rects to redraw on the next frame.
+        fullRedraw (bool): redraw the whole screen on the next frame.
+        debugSurface (pygame.Surface): profiler stats drawn by the debug overlay.
         """
         
         self.evManager = evManager
-        evManager.RegisterListener(self)
+        evManager.Subscribe(InitializeEvent, self.onInitialize)
+        evManager.Subscribe(QuitEvent, self.onQuit)
+        evManager.Subscribe(RenderEvent, self.onRender)
+        evManager.Subscribe(TileChangeEvent, self.onTileChange)
         self.model = model
         self.isinitialized = False
         self.screen = None
         self.clock = None
         self.smallfont = None
+        self.assets = assets.AssetManager()
+        self.chunkRenderer = ChunkRenderer(self.assets)
+        self.surfaceCache = SurfaceCache()
+        self.dirtyRectMode = dirtyRectMode
+        self.headless = headless
+        self.dirtyRects = []
+        self.fullRedraw = True
+        # what was on screen last frame, compared to find what changed
+        self.lastState = None
+        self.lastCameraPos = None
+        self.lastTileMap = None
+        # screen pixels to scroll the last frame by before drawing this one, see findScroll()
+        self.scroll = None
+        self.lastButtonsHovered = None
+        self.fpsString = None
+        self.fpsSurface = None
+        self.fpsRect = pygame.Rect(0, 0, 0, 0)
+        # camera rect and tile width on screen of the frame being drawn
+        self.cameraRect = model.camera.rect.copy()
+        self.tilePixels = model.camera.getTilePixels()
+        # time spent in renderTiles() this frame
+        self.tileTime = 0.0
+        self.debugSurface = None
+        self.debugRect = pygame.Rect(0, 0, 0, 0)
+        self.debugRefreshTime = 0.0
+        # one pixel per tile (per step tiles on big maps) of minimapTileMap,
+        # and the same scaled to the minimap's screen rect
+        self.minimapSurface = None
+        self.minimapScaled = None
+        self.minimapTileMap = None
+        self.minimapStep = 1
+        self.lastMinimapVisible = None
     
-    def notify(self, event):
-        """
-        Receive events posted to the message queue. 
-        """
-
-        if isinstance(event, InitializeEvent):
-            self.initialize()
-        elif isinstance(event, QuitEvent):
-            # shut down the pygame graphics
-            self.isinitialized = False
-            pygame.quit()
-        elif isinstance(event, TickEvent):
-            if not self.isinitialized:
-                return
-            currentstate = self.model.state.peek()
-            if currentstate == model.STATE_MENU:
-                self.rendermenu()
-            if currentstate == model.STATE_PLAY:
-                self.renderplay()
-            if currentstate == model.STATE_HELP:
-                self.renderhelp()
-            # limit the redraw speed to 30 frames per second
-            self.clock.tick(30)
+    def onInitialize(self, event):
+        """
+        Called by an InitializeEvent in the message queue.
+        """
+
+        self.initialize()
+
+    def onQuit(self, event):
+        """
+        Called by a QuitEvent in the message queue.
+        """
+
+        # shut down the pygame graphics
+        self.isinitialized = False
+        pygame.quit()
+
+    def onRender(self, event):
+        """
+        Called by a RenderEvent in the message queue. Renders the current state
+        with the camera interpolated between the last two ticks.
+        """
+
+        if not self.isinitialized:
+            return
+        self.cameraRect = self.model.camera.getRenderRect(event.interpolation)
+        self.tilePixels = self.model.camera.getTilePixels()
+        currentstate = self.model.state.peek()
+        if currentstate == model.STATE_MENU:
+            self.render(currentstate, self.rendermenu)
+        if currentstate == model.STATE_PLAY:
+            self.render(currentstate, self.renderplay)
+        if currentstate == model.STATE_HELP:
+            self.render(currentstate, self.renderhelp)
+        # the engine limits the frame rate, the clock only measures it
+        self.clock.tick()
+
+    def onTileChange(self, event):
+        """
+        Called by a TileChangeEvent in the message queue.
+        Drops the baked chunks of the changed tiles, marks them dirty
+        and updates their pixels on the minimap.
+        """
+
+        for col, row in event.positions:
+            self.chunkRenderer.invalidate(col, row)
+            tile = self.model.tileMap.getTile(col, row)
+            if tile:
+                self.markTileDirty(tile)
+                self.patchMinimap(tile)
+
+    def markDirty(self, rect):
+        """
+        Marks a screen rect to be redrawn on the next frame.
+        """
+        self.dirtyRects.append(pygame.Rect(rect))
+
+    def markTileDirty(self, tile):
+        """
+        Marks the screen area of a tile to be redrawn on the next frame.
+        """
+        self.markDirty(self.getTileScreenRect(tile))
+
+    def getTileScreenRect(self, tile):
+        """
+        Returns the rect of a tile on screen for the frame being drawn.
+        """
+        tilePixels = self.tilePixels
+        tileSize = self.model.tileMap.tileSize
+        x = tile.col * tilePixels - self.cameraRect.x * tilePixels // tileSize
+        y = tile.row * tilePixels - self.cameraRect.y * tilePixels // tileSize
+        return pygame.Rect(x, y, tilePixels, tilePixels)
+
+    def findChanges(self, currentstate):
+        """
+        Compares the model with the last frame and marks what changed as dirty.
+        """
+        if currentstate != self.lastState:
+            self.lastState = currentstate
+            self.fullRedraw = True
+            # show fresh stats on the new screen
+            self.debugRefreshTime = 0.0
+        if self.model.tileMap is not self.lastTileMap:
+            # a new map was loaded, none of the baked chunks show it
+            self.lastTileMap = self.model.tileMap
+            self.chunkRenderer.clear()
+            self.fullRedraw = True
+        if self.model.minimap.visible != self.lastMinimapVisible:
+            self.lastMinimapVisible = self.model.minimap.visible
+            self.fullRedraw = True
+        self.findScroll(currentstate)
+        for tile in self.model.tileHover.popChangedTiles():
+            self.markTileDirty(tile)
+        loadedRanges = self.model.tileMap.popLoadedRanges()
+        if loadedRanges:
+            self.patchMinimapRanges(loadedRanges)
+        changedTiles = self.model.entities.popChangedTiles()
+        if changedTiles is None:
+            self.fullRedraw = True
+        else:
+            for col, row in changedTiles:
+                tile = self.model.tileMap.getTile(col, row)
+                if tile:
+                    self.markTileDirty(tile)
+        if currentstate == model.STATE_MENU:
+            buttons = self.model.mainMenu.buttons
+            buttonsHovered = [button.hovered for button in buttons]
+            if self.lastButtonsHovered:
+                for button, hovered in zip(buttons, self.lastButtonsHovered):
+                    if button.hovered != hovered:
+                        self.markDirty(button.rect)
+            self.lastButtonsHovered = buttonsHovered
+        if currentstate in (model.STATE_MENU, model.STATE_PLAY):
+            self.updateFps()
+        self.updateDebugStats(currentstate)
+
+    def findScroll(self, currentstate):
+        """
+        Compares the camera with the last frame. If it only panned while playing,
+        the last frame is scrolled by the same amount and only the strips it
+        uncovers and the GUI drawn over the tiles are marked dirty, so panning
+        costs the exposed area instead of the screen. Anything else redraws it all.
+        """
+        tileSize = self.model.tileMap.tileSize
+        cameraPos = (self.cameraRect.x * self.tilePixels // tileSize,
+            self.cameraRect.y * self.tilePixels // tileSize, self.tilePixels)
+        lastCameraPos = self.lastCameraPos
+        self.lastCameraPos = cameraPos
+        self.scroll = None
+        if cameraPos == lastCameraPos or self.fullRedraw:
+            return
+        width, height = self.screen.get_size()
+        scrollx = lastCameraPos[0] - cameraPos[0]
+        scrolly = lastCameraPos[1] - cameraPos[1]
+        if (not self.dirtyRectMode or currentstate != model.STATE_PLAY or cameraPos[2] != lastCameraPos[2]
+                or abs(scrollx) >= width or abs(scrolly) >= height):
+            self.fullRedraw = True
+            return
+        self.scroll = (scrollx, scrolly)
+        # what was marked before this frame moves with the scroll
+        for rect in self.dirtyRects:
+            rect.move_ip(scrollx, scrolly)
+        if scrollx > 0:
+            self.markDirty((0, 0, scrollx, height))
+        elif scrollx < 0:
+            self.markDirty((width + scrollx, 0, -scrollx, height))
+        if scrolly > 0:
+            self.markDirty((0, 0, width, scrolly))
+        elif scrolly < 0:
+            self.markDirty((0, height + scrolly, width, -scrolly))
+        # the GUI scrolled away with the tiles, redraw it where it was and where it goes
+        guiRects = [self.fpsRect]
+        if self.debugSurface:
+            guiRects.append(self.debugRect)
+        if self.model.minimap.visible:
+            guiRects.append(self.model.minimap.getRect(self.model.tileMap).inflate(2, 2))
+        for rect in guiRects:
+            self.markDirty(rect)
+            self.markDirty(rect.move(scrollx, scrolly))
+        tile = self.model.tileHover.tile
+        if tile:
+            self.markTileDirty(tile)
+
+    def updateFps(self):
+        """
+        Renders the fps text again if it changed at display precision and marks it dirty.
+        """
+        fpsString = "FPS: %.1f" % self.clock.get_fps()
+        if fpsString == self.fpsString:
+            return
+        self.fpsString = fpsString
+        self.markDirty(self.fpsRect)
+        # fpsSurface is its own one entry cache, a new string each time would only evict the cached buttons
+        self.fpsSurface = self.smallfont.render(fpsString, True, (255,0,255))
+        self.fpsRect = self.fpsSurface.get_rect()
+        self.markDirty(self.fpsRect)
+
+    def updateDebugStats(self, currentstate):
+        """
+        Renders the profiler and event queue stats of the debug overlay again,
+        twice a second, and marks them dirty. They are shown on the help screen, and on the menu
+        and play screens while the model's showDebugOverlay is on.
+        """
+        show = currentstate == model.STATE_HELP or (self.model.showDebugOverlay
+            and currentstate in (model.STATE_MENU, model.STATE_PLAY))
+        if not show:
+            if self.debugSurface:
+                self.markDirty(self.debugRect)
+                self.debugSurface = None
+            return
+        now = time.perf_counter()
+        if self.debugSurface and now - self.debugRefreshTime < 0.5:
+            return
+        self.debugRefreshTime = now
+        profiler = self.evManager.profiler
+        if profiler:
+            lines = ['%-7s %-7s %-7s name' % ('mean', 'p95', 'max')]
+            rows = profiler.summary()
+            for name, count, mean, p50, p95, p99, maximum in rows[:20]:
+                lines.append('%7.3f %7.3f %7.3f %s' % (mean * 1000, p95 * 1000, maximum * 1000, name))
+            # how the slowest one's times spread, per ms
+            if rows:
+                buckets = profiler.histograms[rows[0][0]].buckets()
+                lines.append('ms 0-%d+ %s' % (len(buckets) - 1, ' '.join(str(count) for count in buckets)))
+        else:
+            lines = ['profiler off']
+        if self.evManager.queued:
+            lines.append('queue %s' % self.evManager.stats)
+        surfaces = [self.smallfont.render(line, True, (0, 255, 0)) for line in lines]
+        width = max(surface.get_width() for surface in surfaces)
+        lineHeight = self.smallfont.get_linesize()
+        debugSurface = pygame.Surface((width + 8, lineHeight * len(surfaces) + 8))
+        debugSurface.fill((0, 0, 0))
+        for i, surface in enumerate(surfaces):
+            debugSurface.blit(surface, (4, 4 + i * lineHeight))
+        self.markDirty(self.debugRect)
+        self.debugSurface = debugSurface
+        self.debugRect = debugSurface.get_rect(topleft = (0, 20))
+        self.markDirty(self.debugRect)
+
+    def render(self, currentstate, draw):
+        """
+        Draws a frame with the draw function and pushes it to the display.
+        In dirty rect mode only the dirty rects are redrawn and pushed,
+        and nothing is done at all if nothing changed.
+        The time spent on tiles, the rest of the drawing (gui) and pushing
+        to the display (flip) is recorded in the profiler.
+        """
+        self.findChanges(currentstate)
+        self.tileTime = 0.0
+        start = time.perf_counter()
+        if not self.dirtyRectMode or self.fullRedraw:
+            draw()
+            drawn = time.perf_counter()
+            pygame.display.flip()
+        elif self.dirtyRects:
+            if self.scroll:
+                self.screen.scroll(*self.scroll)
+            for rect in self.dirtyRects:
+                self.screen.set_clip(rect)
+                draw()
+            self.screen.set_clip(None)
+            drawn = time.perf_counter()
+            if self.scroll:
+                # every pixel moved
+                pygame.display.flip()
+            else:
+                pygame.display.update(self.dirtyRects)
+        else:
+            drawn = None
+        profiler = self.evManager.profiler
+        if drawn and profiler and profiler.enabled:
+            profiler.record('render tiles', self.tileTime)
+            profiler.record('render gui', drawn - start - self.tileTime)
+            profiler.record('render flip', time.perf_counter() - drawn)
+        self.dirtyRects = []
+        self.fullRedraw = False
+
+    def renderDebugStats(self):
+        """
+        Render the debug overlay if it is shown.
+        """
+        if self.debugSurface:
+            self.screen.blit(self.debugSurface, self.debugRect)
     
     def rendermenu(self):
         """
@@ -59,37 +571,26 @@ class GraphicalView(object):
         menu = self.model.mainMenu
         self.screen.fill((0, 0, 0))
         # render tiles
-        for tile in self.model.tileMap.tilesOnScreen:
-           self.renderTile(tile)
+        self.renderTiles()
         # render title image
-        self.screen.blit(model.guiImages['TITLE_TEXT'], (0,0))
+        self.screen.blit(self.assets.getImage('TITLE_TEXT'), (0,0))
         # render buttons
         for button in menu.buttons:
             self.renderPrimButton(button)
         # render fps
-        fpsText = self.smallfont.render(
-            "FPS: " + str(self.clock.get_fps()),
-            True, (255,0,255)
-            )
-        self.screen.blit(fpsText, (0, 0))
-        pygame.display.flip()
+        self.screen.blit(self.fpsSurface, (0, 0))
+        self.renderDebugStats()
         
     def renderplay(self):
         """
         Render the game play.
         """
         self.screen.fill((0,0,0))
-        for tile in self.model.tileMap.tilesOnScreen:
-           self.renderTile(tile)
+        self.renderTiles()
+        self.renderMinimap()
         # render fps
-        fpsText = self.smallfont.render(
-            "FPS: " + str(self.clock.get_fps()),
-            True, (255,0,255)
-            )
-        self.screen.blit(fpsText, (0, 0))
-        pygame.display.flip()
-
-        
+        self.screen.blit(self.fpsSurface, (0, 0))
+        self.renderDebugStats()
         
     def renderhelp(self):
         """
@@ -97,63 +598,243 @@ class GraphicalView(object):
         """
 
         self.screen.fill((0, 0, 0))
-        somewords = self.smallfont.render(
+        somewords = self.surfaceCache.renderText(self.smallfont,
                     'DEBUG', 
                     True, (0, 255, 0))
         self.screen.blit(somewords, (0, 0))
-        pygame.display.flip()
+        self.renderDebugStats()
 
     def renderPrimButton(self, primButton):
         """
-        Render PrimitiveButton object as a rect with text that reacts to hovering
+        Render PrimitiveButton object as a rect with text that reacts to hovering.
+        The normal and hover looks are each rendered once and then blitted from the cache.
         """
+        self.screen.blit(self.getPrimButtonSurface(primButton, primButton.hovered), primButton.rect)
+
+    def getPrimButtonSurface(self, primButton, hovered):
+        """
+        Returns the cached surface of a PrimitiveButton, normal or hovered.
+        """
+        key = ('button', primButton.rect.size, tuple(primButton.color), tuple(primButton.hoverColor),
+            primButton.text, primButton.font, primButton.stroke, hovered)
+        return self.surfaceCache.get(key, lambda: self.makePrimButtonSurface(primButton, hovered))
+
+    def makePrimButtonSurface(self, primButton, hovered):
+        """
+        Renders a PrimitiveButton onto a new surface the size of its rect.
+        """
+        surface = pygame.Surface(primButton.rect.size).convert()
+        rect = surface.get_rect()
         # change color if hovered
-        buttonColor = deepcopy(primButton.color)
-        if primButton.hovered:
-            buttonColor = deepcopy(primButton.hoverColor)
+        buttonColor = primButton.hoverColor if hovered else primButton.color
         # render button
-        pygame.draw.rect(self.screen, buttonColor, primButton.rect)
-        textSurface = primButton.font.render(primButton.text, False, pygame.Color(255,255,255))
+        surface.fill(buttonColor)
+        font = self.assets.getFont(*primButton.font)
+        textSurface = self.surfaceCache.renderText(font, primButton.text, False, pygame.Color(255,255,255))
         # center text
-        textW, textH = primButton.font.size(primButton.text)
-        textX = primButton.rect.centerx
-        textY = primButton.rect.centery
-        textX -= textW/2
-        textY -= textH/2
-        self.screen.blit(textSurface, (textX, textY))
+        textW, textH = textSurface.get_size()
+        surface.blit(textSurface, (int(rect.centerx - textW/2), int(rect.centery - textH/2)))
         # render stroke
         if primButton.stroke :
-            pygame.draw.rect(self.screen, (0, 0,0), primButton.rect, 3)
+            pygame.draw.rect(surface, (0, 0,0), rect, 3)
+        return surface
+
+    def prerenderMenu(self):
+        """
+        Renders the normal and hover looks of every menu button ahead of time.
+        """
+        for button in self.model.mainMenu.buttons:
+            self.getPrimButtonSurface(button, False)
+            self.getPrimButtonSurface(button, True)
     
-    def renderTile(self, tile):
-        """
-        Render Tile object's terrain, resource, and structure in that order.
-        Render rect over tile if hovered
-        """
-        # offset x and y depending on camera position
-        xoffset = self.model.camera.rect.x
-        yoffset = self.model.camera.rect.y
-        x, y = (tile.rect.x - xoffset), (tile.rect.y - yoffset)
-        w, h = tile.size, tile.size
-        # determine which image to display based on tileId and blit it
-        img = model.terrainTextures[tile.tileId]
-        self.screen.blit(img,(x, y))
-        # draw resource if tile has one
-        if tile.resource: 
-             img = model.resourceTextures[tile.resource.recId]
-             self.screen.blit(img,(x,y))
-        # if hovered, draw rect
-        if tile.hovered:
-            pygame.draw.rect(self.screen, pygame.Color(0, 0, 0), pygame.Rect(x, y, w, h), 1)
+    def renderTiles(self):
+        """
+        Render the tiles inside the camera from the chunk cache, the entities
+        on them and the rect over the hovered tile.
+        """
+        start = time.perf_counter()
+        self.chunkRenderer.render(self.screen, self.model.tileMap, self.cameraRect, self.tilePixels,
+            self.screen.get_clip())
+        self.renderEntities()
+        tile = self.model.tileHover.tile
+        if tile:
+            pygame.draw.rect(self.screen, pygame.Color(0, 0, 0), self.getTileScreenRect(tile), 1)
+        self.tileTime += time.perf_counter() - start
+
+    def renderEntities(self):
+        """
+        Render the entities on the tiles of the screen area being drawn, found through
+        the spatial index, as a square in their owner's color. Damaged ones get a health bar.
+        """
+        tilePixels = self.tilePixels
+        entities = self.model.entities
+        if tilePixels < ENTITY_MIN_PIXELS or not len(entities):
+            return
+        tileMap = self.model.tileMap
+        offsetx = self.cameraRect.x * tilePixels // tileMap.tileSize
+        offsety = self.cameraRect.y * tilePixels // tileMap.tileSize
+        area = self.screen.get_clip()
+        tileRange = (max(0, (area.left + offsetx) // tilePixels),
+            max(0, (area.top + offsety) // tilePixels),
+            min(tileMap.width, (area.right - 1 + offsetx) // tilePixels + 1),
+            min(tileMap.height, (area.bottom - 1 + offsety) // tilePixels + 1))
+        inset = tilePixels // 4
+        size = tilePixels - 2 * inset
+        cols = entities.cols
+        rows = entities.rows
+        masks = entities.masks
+        owners = entities.owners
+        fill = self.screen.fill
+        Rect = pygame.Rect
+        for entity in sorted(entities.getEntitiesInRange(tileRange)):
+            x = cols[entity] * tilePixels - offsetx + inset
+            y = rows[entity] * tilePixels - offsety + inset
+            owner = owners[entity] if masks[entity] & ecs.OWNER else ecs.UNOWNED
+            # fill() does not clip rects sticking out left or top of the screen, clip() does
+            fill(OWNER_COLORS[owner % len(OWNER_COLORS)], Rect(x, y, size, size).clip(area))
+            if masks[entity] & ecs.HEALTH and entities.health[entity] < entities.maxHealth[entity]:
+                width = size * entities.health[entity] // max(1, entities.maxHealth[entity])
+                fill((0, 0, 0), Rect(x, y + size, size, max(1, inset // 2)).clip(area))
+                fill((0, 220, 0), Rect(x, y + size, width, max(1, inset // 2)).clip(area))
+
+    def renderMinimap(self):
+        """
+        Render the minimap and the outline of the camera on it, if it is shown.
+        """
+        minimap = self.model.minimap
+        if not minimap.visible:
+            return
+        tileMap = self.model.tileMap
+        rect = minimap.getRect(tileMap)
+        if self.minimapScaled is None or tileMap is not self.minimapTileMap:
+            self.minimapScaled = pygame.transform.scale(self.getMinimapSurface(), rect.size).convert()
+        self.screen.blit(self.minimapScaled, rect)
+        viewRect = minimap.getViewRect(self.cameraRect, tileMap).clip(rect)
+        if viewRect.width and viewRect.height:
+            pygame.draw.rect(self.screen, pygame.Color(255, 255, 255), viewRect, 1)
+        pygame.draw.rect(self.screen, pygame.Color(0, 0, 0), rect.inflate(2, 2), 1)
+
+    def getMinimapSurface(self):
+        """
+        Returns the one pixel per tile minimap surface, built in bulk from the
+        terrain array when the map changed. Maps wider or taller than
+        MINIMAP_MAX_PIXELS tiles are sampled every minimapStep tiles.
+        A streamed map starts blank and shows its chunks as they load,
+        see patchMinimapRanges(), so building it never reads the whole world.
+        """
+        tileMap = self.model.tileMap
+        if tileMap is not self.minimapTileMap:
+            step = max(1, -(-max(tileMap.width, tileMap.height) // MINIMAP_MAX_PIXELS))
+            cols = -(-tileMap.width // step)
+            rows = -(-tileMap.height // step)
+            loadedRanges = tileMap.popLoadedRanges()
+            if loadedRanges is None:
+                self.minimapSurface = makeTerrainSurface(tileMap, self.assets.getTerrainPalette(),
+                    0, 0, cols, rows, step)
+            else:
+                self.minimapSurface = pygame.Surface((cols, rows), 0, 8)
+                self.minimapSurface.set_palette(self.assets.getTerrainPalette())
+                self.minimapSurface.fill(assets.OUTSIDE_COLOR_INDEX)
+            self.minimapTileMap = tileMap
+            self.minimapStep = step
+            self.minimapScaled = None
+            if loadedRanges:
+                self.patchMinimapRanges(loadedRanges)
+        return self.minimapSurface
+
+    def patchMinimapRanges(self, tileRanges):
+        """
+        Writes the pixels of (firstCol, firstRow, endCol, endRow) ranges of tiles,
+        all in memory, into the minimap surface and its scaled copy and marks
+        the minimap dirty.
+        """
+        tileMap = self.model.tileMap
+        surface = self.getMinimapSurface()
+        step = self.minimapStep
+        pitch = surface.get_pitch()
+        buffer = surface.get_buffer()
+        areas = []
+        for firstCol, firstRow, endCol, endRow in tileRanges:
+            # the first sampled column and row of the range
+            firstCol = -(-firstCol // step) * step
+            firstRow = -(-firstRow // step) * step
+            if firstCol >= endCol:
+                continue
+            for row in range(firstRow, endRow, step):
+                start = row * tileMap.width
+                line = tileMap.terrain[start + firstCol:start + endCol][::step]
+                buffer.write(bytes(line), row // step * pitch + firstCol // step)
+            areas.append(pygame.Rect(firstCol // step, firstRow // step,
+                -(-endCol // step) - firstCol // step, -(-endRow // step) - firstRow // step))
+        del buffer
+        for area in areas:
+            self.patchMinimapScaled(area)
+        if self.model.minimap.visible:
+            self.markDirty(self.model.minimap.getRect(tileMap).inflate(2, 2))
+
+    def patchMinimap(self, tile):
+        """
+        Writes a changed tile's pixel into the minimap surface, if the minimap shows it,
+        and marks the minimap dirty.
+        """
+        step = self.minimapStep
+        if self.minimapTileMap is not tile.tileMap or tile.col % step or tile.row % step:
+            return
+        buffer = self.minimapSurface.get_buffer()
+        buffer.write(bytes([tile.tileId]), tile.row // step * self.minimapSurface.get_pitch() + tile.col // step)
+        del buffer
+        self.patchMinimapScaled(pygame.Rect(tile.col // step, tile.row // step, 1, 1))
+        if self.model.minimap.visible:
+            self.markDirty(self.model.minimap.getRect(tile.tileMap).inflate(2, 2))
+
+    def patchMinimapScaled(self, area):
+        """
+        Copies the pixels of area, a rect of the minimap surface, into the scaled
+        minimap. Only the scaled pixels showing area are redrawn, picked the same
+        way pygame.transform.scale picks them, so the result matches scaling the
+        whole minimap again.
+        """
+        if self.minimapScaled is None:
+            return
+        surface = self.minimapSurface
+        cols, rows = surface.get_size()
+        width, height = self.minimapScaled.get_size()
+        # scaled pixel (x, y) shows pixel (x * cols // width, y * rows // height)
+        firstX = -(-area.left * width // cols)
+        endX = -(-area.right * width // cols)
+        firstY = -(-area.top * height // rows)
+        endY = -(-area.bottom * height // rows)
+        if firstX >= endX or firstY >= endY:
+            return
+        sourceCols = [x * cols // width for x in range(firstX, endX)]
+        pixels = surface.get_view('1').raw
+        pitch = surface.get_pitch()
+        block = pygame.Surface((endX - firstX, endY - firstY), 0, 8)
+        block.set_palette(surface.get_palette())
+        blockPitch = block.get_pitch()
+        buffer = block.get_buffer()
+        for y in range(firstY, endY):
+            start = y * rows // height * pitch
+            buffer.write(bytes([pixels[start + x] for x in sourceCols]), (y - firstY) * blockPitch)
+        del buffer
+        self.minimapScaled.blit(block, (firstX, firstY))
 
     def initialize(self):
         """
         Set up the pygame graphical display and loads graphical resources.
         """
-        result = pygame.init()
+        if self.headless:
+            # must be set before the display is initialized
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        pygame.init()
         pygame.font.init()
         pygame.display.set_caption('demo game')
-        self.screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN | pygame.DOUBLEBUF)
+        if self.headless:
+            self.screen = pygame.display.set_mode((model.SCREEN_WIDTH, model.SCREEN_HEIGHT))
+        else:
+            self.screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN | pygame.DOUBLEBUF)
+        self.assets.initialize()
         self.clock = pygame.time.Clock()
-        self.smallfont = pygame.font.Font(None, 20)
+        self.smallfont = self.assets.getFont(None, 20)
+        self.prerenderMenu()
         self.isinitialized = True
\ No newline at end of file
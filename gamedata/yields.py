@@ -0,0 +1,377 @@
+"""
+Resource yields: what every tile makes per second, summed per owner and per region.
+
+A tile's yield rates come from its terrain and its resource through TERRAIN_YIELDS
+and RESOURCE_YIELDS. They are kept in one byte array per yield type, built for the
+whole map at once. Rates only ever add up, so the engine also keeps their sums per
+owner and per REGION_TILES square region, and patches a sum whenever one of its
+tiles changes. A tick then advances every owner's stock from its summed rate,
+which accounts for every tile without visiting any of them.
+
+Building the rates reads every tile, so a YieldBuild thread does it in the background,
+reading the map a band of rows at a time. A streamed map, see streaming.py,
+is read from its map file that way instead of being loaded chunk by chunk.
+Tiles change and get claimed while the build runs, these are replayed once it is done.
+"""
+import threading
+from array import array
+from collections import deque
+import ecs
+import lanes
+import model
+from eventmanager import *
+
+# yield types, the index of each in rate and stock lists
+FOOD = 0
+PRODUCTION = 1
+YIELD_NAMES = ("food", "production")
+
+# yields per second of each terrain type and resource, as (food, production)
+TERRAIN_YIELDS = {
+    model.GRASSLAND: (2, 0),
+    model.PLAINS: (1, 1),
+    model.DESERT: (0, 0),
+    model.GRAVEL: (0, 1),
+    model.SNOW: (0, 0),
+    model.LAKE: (1, 0),
+    model.OCEAN: (1, 0),
+    model.TUNDRA: (1, 0),
+}
+RESOURCE_YIELDS = {
+    model.WHEAT: (2, 0),
+    model.MOUNTAIN: (0, 2),
+}
+
+# owner of tiles no player owns, they yield nothing to anyone
+UNOWNED = 0
+# regions are REGION_TILES by REGION_TILES tiles
+REGION_TILES = 16
+
+
+def buildYieldTable(yields, yieldType):
+    """
+    Returns a bytes.translate() table giving the yield of one type for each id in yields.
+    """
+    return bytes(yields[id][yieldType] if id in yields else 0 for id in range(256))
+
+
+def sumRegionBand(rates, width):
+    """
+    Returns the summed rates of each region of a band of up to REGION_TILES rows.
+    The rows are added as packed lanes first, so only one slice is summed per region.
+    """
+    band = sum(lanes.pack(rates[start:start + width]) for start in range(0, len(rates), width))
+    # REGION_TILES rows of byte rates can not overflow a lane
+    sums = lanes.unpackWords(band, width)
+    return [sum(sums[col:col + REGION_TILES]) for col in range(0, width, REGION_TILES)]
+
+
+class YieldBuild(threading.Thread):
+    """
+    Background thread working out the rates of every tile of a map and their sums.
+    It reads the map a band of rows at a time, see TileMap.readLayers(), and never
+    works on more than a band at once, so the game thread gets to run its ticks in between.
+    """
+
+    def __init__(self, tileMap, terrainTables, resourceTables):
+        """
+        tileMap (TileMap): the map to build.
+        terrainTables, resourceTables (list): a yield table per yield type, see buildYieldTable.
+
+        Attributes:
+        rates (list): an array per yield type with the rate of each tile, once built.
+        regionRates (list): an array per yield type with the summed rate of each region, once built.
+        changes (list): (method, args) YieldEngine calls made on the map while it was built.
+        error (Exception): what stopped the build, None if nothing did.
+        """
+        threading.Thread.__init__(self, name = "YieldBuild", daemon = True)
+        self.tileMap = tileMap
+        self.width = tileMap.width
+        self.height = tileMap.height
+        self.layers = tileMap.readLayers()
+        self.terrainTables = terrainTables
+        self.resourceTables = resourceTables
+        self.rates = None
+        self.regionRates = None
+        self.changes = []
+        self.error = None
+        self.cancelled = False
+
+    def run(self):
+        try:
+            self.build()
+        except Exception as error:
+            # a map replaced during the build may be closed under it, its build is cancelled anyway
+            self.error = error
+
+    def cancel(self):
+        """
+        Stops the build at the next band, its map is not used any more.
+        """
+        self.cancelled = True
+
+    def build(self):
+        """
+        Looks up the rates of a yield type for a band of tiles at once with bytes.translate,
+        adding the terrain and resource parts as packed lanes, see lanes.py.
+        The terrain bands are kept until the resource bands of the same rows come.
+        """
+        width = self.width
+        count = width * self.height
+        terrain = deque()
+        size = 0
+        rates = [array('B') for table in self.terrainTables]
+        for band in self.layers:
+            if self.cancelled:
+                return
+            if size < count:
+                terrain.append(band)
+                size += len(band)
+                continue
+            terrainBand = terrain.popleft()
+            for yieldType, (terrainTable, resourceTable) in enumerate(zip(self.terrainTables, self.resourceTables)):
+                total = lanes.pack(terrainBand.translate(terrainTable)) + lanes.pack(band.translate(resourceTable))
+                rates[yieldType].frombytes(lanes.unpack(total, len(band)))
+        regionRates = [array('L') for table in self.terrainTables]
+        bandSize = REGION_TILES * width
+        for start in range(0, count, bandSize):
+            if self.cancelled:
+                return
+            for yieldType, typeRates in enumerate(rates):
+                regionRates[yieldType].extend(sumRegionBand(typeRates[start:start + bandSize], width))
+        self.rates = rates
+        self.regionRates = regionRates
+
+
+class YieldEngine(object):
+    """
+    Tracks the yields of every tile of the model's map and the stocks they pay into.
+    """
+
+    def __init__(self, evManager, model):
+        """
+        evManager (EventManager): Allows posting messages to the event queue.
+        model (GameEngine): a strong reference to the game Model.
+
+        Attributes:
+        tileMap (TileMap): the map the rates are built for, None while none are.
+        building (YieldBuild): the build of the model's map running in the background, if any.
+        rates (list): an array per yield type with the rate of each tile.
+        owners (dict): tile index: owner of the tiles somebody owns.
+        ownerRates (dict): owner: summed rate per yield type of the tiles it owns.
+        regionRates (list): an array per yield type with the summed rate of each region.
+        stocks (dict): owner: amount per yield type it has made so far.
+        """
+        self.evManager = evManager
+        evManager.Subscribe(TickEvent, self.onTick)
+        evManager.Subscribe(TileChangeEvent, self.onTileChange)
+        evManager.Subscribe(ClaimTileEvent, self.onClaimTile)
+        self.model = model
+        self.tileMap = None
+        self.building = None
+        self.rates = []
+        self.owners = {}
+        self.ownerRates = {}
+        self.regionRates = []
+        self.regionCols = 0
+        self.stocks = {}
+        self.terrainTables = [buildYieldTable(TERRAIN_YIELDS, yieldType) for yieldType in range(len(YIELD_NAMES))]
+        self.resourceTables = [buildYieldTable(RESOURCE_YIELDS, yieldType) for yieldType in range(len(YIELD_NAMES))]
+
+    def onTick(self, event):
+        """
+        Called for each simulation tick. Starts building the rates of a new map,
+        adopts them once built, and pays one tick of yields into the stocks.
+        Until the rates are built only structures produce anything.
+        """
+        tileMap = self.model.tileMap
+        if tileMap is not None and tileMap is not self.tileMap:
+            if self.building is None or self.building.tileMap is not tileMap:
+                self.startBuild(tileMap)
+            elif not self.building.is_alive():
+                self.adopt(self.building)
+        self.step(self.model.scheduler.tickTime)
+
+    def onTileChange(self, event):
+        """
+        Called by a TileChangeEvent in the message queue. Updates the changed tiles' rates
+        and the sums they are part of.
+        """
+        tileMap = self.model.tileMap
+        if not self.tracks(tileMap):
+            return
+        for col, row in event.positions:
+            tile = tileMap.getTile(col, row)
+            if tile:
+                self.whenBuilt(self.updateTile, tile.index, tile.tileId, tileMap.resources[tile.index])
+
+    def onClaimTile(self, event):
+        """
+        Called by a ClaimTileEvent in the message queue. Gives the tile to its new owner.
+        """
+        ecs.checkOwner(event.owner)
+        tileMap = self.model.tileMap
+        if 0 <= event.col < tileMap.width and 0 <= event.row < tileMap.height:
+            self.whenBuilt(self.setOwner, event.col, event.row, event.owner)
+
+    def whenBuilt(self, method, *args):
+        """
+        Calls method with args on the rates of the model's map, now if they are built,
+        once they are if they are being built. Calls for other maps are dropped.
+        """
+        tileMap = self.model.tileMap
+        if self.building is not None and self.building.tileMap is tileMap:
+            self.building.changes.append((method, args))
+        elif tileMap is not None and tileMap is self.tileMap:
+            method(*args)
+
+    def tracks(self, tileMap):
+        """
+        Returns True if the rates of tileMap are built or being built.
+        """
+        return tileMap is self.tileMap or (self.building is not None and self.building.tileMap is tileMap)
+
+    def startBuild(self, tileMap):
+        """
+        Drops the rates of the old map and starts building those of tileMap in the background.
+        """
+        if self.building is not None:
+            self.building.cancel()
+        self.tileMap = None
+        self.rates = []
+        self.owners = {}
+        self.ownerRates = {}
+        self.regionRates = []
+        self.building = YieldBuild(tileMap, self.terrainTables, self.resourceTables)
+        self.building.start()
+
+    def build(self, tileMap):
+        """
+        Works out the rates of every tile of tileMap and their sums on this thread,
+        see YieldBuild. Every tile starts unowned.
+        """
+        if self.building is not None:
+            self.building.cancel()
+        building = YieldBuild(tileMap, self.terrainTables, self.resourceTables)
+        building.run()
+        self.adopt(building)
+
+    def adopt(self, building):
+        """
+        Takes the rates of a finished build, then replays the changes made while it ran.
+        """
+        self.building = None
+        if building.error is not None:
+            raise building.error
+        self.tileMap = building.tileMap
+        self.rates = building.rates
+        self.owners = {}
+        self.regionCols = -(-building.width // REGION_TILES)
+        self.regionRates = building.regionRates
+        self.ownerRates = {UNOWNED: [sum(regionRates) for regionRates in self.regionRates]}
+        for method, args in building.changes:
+            method(*args)
+
+    def step(self, seconds):
+        """
+        Pays seconds worth of yields from every owned tile into its owner's stock,
+        and the production of the structures it owns, see ecs.EntityStore.
+        """
+        for owner, rates in self.ownerRates.items():
+            if owner == UNOWNED:
+                continue
+            stock = self.stocks.setdefault(owner, [0.0] * len(rates))
+            for yieldType, rate in enumerate(rates):
+                stock[yieldType] += rate * seconds
+        for owner, rate in self.model.entities.ownerProduction.items():
+            if owner == UNOWNED or not rate:
+                continue
+            stock = self.stocks.setdefault(owner, [0.0] * len(YIELD_NAMES))
+            stock[PRODUCTION] += rate * seconds
+
+    def getRegion(self, index):
+        """
+        Returns the index of the region a tile is in.
+        """
+        row, col = divmod(index, self.tileMap.width)
+        return row // REGION_TILES * self.regionCols + col // REGION_TILES
+
+    def updateTile(self, index, tileId, recId):
+        """
+        Sets a tile's rates from its terrain and resource, patching its owner's and region's sums.
+        """
+        ownerRates = self.ownerRates[self.owners.get(index, UNOWNED)]
+        region = self.getRegion(index)
+        for yieldType, rates in enumerate(self.rates):
+            rate = self.terrainTables[yieldType][tileId] + self.resourceTables[yieldType][recId]
+            change = rate - rates[index]
+            if change:
+                rates[index] = rate
+                ownerRates[yieldType] += change
+                self.regionRates[yieldType][region] += change
+
+    def setOwner(self, col, row, owner):
+        """
+        Gives the tile at (col, row) to owner (UNOWNED for nobody), moving its rates
+        from the old owner's sums to the new owner's. Owners are those of ecs.py,
+        up to ecs.MAX_OWNER.
+        """
+        ecs.checkOwner(owner)
+        index = row * self.tileMap.width + col
+        oldRates = self.ownerRates[self.owners.get(index, UNOWNED)]
+        newRates = self.ownerRates.setdefault(owner, [0] * len(self.rates))
+        for yieldType, rates in enumerate(self.rates):
+            oldRates[yieldType] -= rates[index]
+            newRates[yieldType] += rates[index]
+        if owner == UNOWNED:
+            self.owners.pop(index, None)
+        else:
+            self.owners[index] = owner
+
+    def getOwners(self):
+        """
+        Returns the owner of every owned tile as a dict of tile index: owner,
+        with the claims waiting for the rates to be built already made.
+        """
+        owners = dict(self.owners)
+        if self.building is not None:
+            width = self.building.width
+            for method, args in self.building.changes:
+                if method == self.setOwner:
+                    col, row, owner = args
+                    if owner == UNOWNED:
+                        owners.pop(row * width + col, None)
+                    else:
+                        owners[row * width + col] = owner
+        return owners
+
+    def restore(self, owners, stocks):
+        """
+        Puts loaded tile owners (tile index: owner) and stocks (owner: amount per yield type) back.
+        The tiles are given to their owners once the rates of the model's map are built.
+        """
+        self.stocks = dict((owner, list(amounts)) for owner, amounts in stocks.items())
+        tileMap = self.model.tileMap
+        if not self.tracks(tileMap):
+            self.startBuild(tileMap)
+        for index, owner in sorted(owners.items()):
+            self.whenBuilt(self.setOwner, index % tileMap.width, index // tileMap.width, owner)
+
+    def getOwnerRates(self, owner):
+        """
+        Returns the summed rate per yield type of the tiles owner has.
+        """
+        return list(self.ownerRates.get(owner, [0] * len(self.rates)))
+
+    def getRegionRates(self, col, row):
+        """
+        Returns the summed rate per yield type of the region holding the tile at (col, row).
+        """
+        region = self.getRegion(row * self.tileMap.width + col)
+        return [regionRates[region] for regionRates in self.regionRates]
+
+    def getStock(self, owner):
+        """
+        Returns the amount per yield type owner has made so far.
+        """
+        return list(self.stocks.get(owner, [0.0] * len(YIELD_NAMES)))